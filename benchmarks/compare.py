@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Comparison of two results of benchmarks/run.py. Prints median times and queries of operations of both runs,
+exits with status 1 if any operation is slower than `--threshold` times or makes more queries:
+
+    python benchmarks/compare.py before.json after.json --threshold 1.2
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+
+
+def load(filename):
+    with open(filename) as result:
+        return dict([(operation['name'], operation) for operation in json.load(result)['results']])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Comparison of results of benchmarks of ManyToManyHistoryField')
+    parser.add_argument('before', help='File with results of the base run')
+    parser.add_argument('after', help='File with results of the compared run')
+    parser.add_argument('--threshold', type=float, default=1.2, help='Maximum allowed ratio of median times')
+    options = parser.parse_args()
+
+    before, after = load(options.before), load(options.after)
+    regressions = []
+    print('%-20s %12s %12s %8s %10s' % ('operation', 'before', 'after', 'ratio', 'queries'))
+    for name in sorted(set(before) & set(after)):
+        ratio = after[name]['median'] / before[name]['median'] if before[name]['median'] else float('inf')
+        print('%-20s %11.6fs %11.6fs %8.2f %4d -> %d' % (name, before[name]['median'], after[name]['median'], ratio,
+                                                         before[name]['queries'], after[name]['queries']))
+        if ratio > options.threshold or after[name]['queries'] > before[name]['queries']:
+            regressions.append(name)
+
+    if regressions:
+        print('Regressions: %s' % ', '.join(regressions), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
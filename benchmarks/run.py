@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of reads and writes of history of ManyToManyHistoryField on synthetic histories.
+
+Histories are generated in a test database of the backend from environment variable DB (sqlite, postgres, mysql),
+the same as for quicktest.py. Every operation is timed `--repeat` times with number of executed queries,
+results are printed or written to `--output` as JSON and can be compared by compare.py:
+
+    DB=postgres python benchmarks/run.py --instances 50 --members 1000 --versions 30 --output before.json
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+from datetime import datetime, timedelta
+from timeit import default_timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def get_database():
+    test_db = os.environ.get('DB', 'sqlite')
+    if test_db == 'mysql':
+        return {
+            'ENGINE': 'django.db.backends.mysql',
+            'NAME': 'django',
+            'USER': 'root',
+        }
+    elif test_db == 'postgres':
+        return {
+            'ENGINE': 'django.db.backends.postgresql_psycopg2',
+            'USER': 'postgres',
+            'NAME': 'django',
+        }
+    return {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(ROOT, 'database.db'),
+    }
+
+
+def setup():
+    from django.conf import settings
+    settings.configure(
+        DATABASES={'default': get_database()},
+        INSTALLED_APPS=(
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'm2m_history',
+            'm2m_history.test_app',
+        ),
+    )
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+
+
+class Benchmark(object):
+    """
+    Synthetic history of field of Article instances and timed operations over it
+    """
+    def __init__(self, options):
+        from m2m_history.test_app.models import Article, Publication
+
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.article_model = Article
+        self.publication_model = Publication
+        self.start = datetime(2015, 1, 1)
+        self.results = []
+
+    def get_manager(self, article, time=None):
+        manager = getattr(article, self.options.field)
+        manager.time = time
+        return manager
+
+    def get_version_time(self, version):
+        return self.start + timedelta(hours=version)
+
+    def churn(self, ids, pool):
+        """
+        Return ids with part of them, defined by churn rate, replaced by other ids from pool
+        """
+        number = int(round(len(ids) * self.options.churn))
+        removed = set(self.random.sample(sorted(ids), number))
+        added = set(self.random.sample(sorted(pool - ids), number))
+        return (ids - removed) | added
+
+    def generate(self):
+        """
+        Make instances and versions of their items. Every instance starts with `members` items of pool,
+        twice as big, and every next version replaces part of them by other items of pool
+        """
+        options = self.options
+        self.publication_model.objects.bulk_create([self.publication_model(title='Publication %d' % i)
+                                                    for i in range(options.members * 2)])
+        pool = set(self.publication_model.objects.values_list('pk', flat=True))
+
+        self.articles = []
+        self.items = {}
+        for i in range(options.instances):
+            article = self.article_model.objects.create(headline='Article %d' % i)
+            ids = set(self.random.sample(sorted(pool), options.members))
+            for version in range(options.versions):
+                if version:
+                    ids = self.churn(ids, pool)
+                self.get_manager(article, self.get_version_time(version)).set(sorted(ids))
+            self.articles.append(article)
+            self.items[article.pk] = ids
+        self.pool = pool
+        self.time = self.get_version_time(options.versions)
+
+    def measure(self, name, prepare, operation):
+        """
+        Time operation `repeat` times with number of queries. `prepare` returns arguments of the operation,
+        it's not timed
+        """
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        times, queries = [], []
+        for i in range(self.options.repeat):
+            args = prepare()
+            with CaptureQueriesContext(connection) as context:
+                started = default_timer()
+                operation(*args)
+                times.append(default_timer() - started)
+            queries.append(len(context.captured_queries))
+
+        times.sort()
+        result = {
+            'name': name,
+            'runs': len(times),
+            'min': times[0],
+            'median': times[len(times) // 2],
+            'mean': sum(times) / len(times),
+            'max': times[-1],
+            'queries': max(queries),
+        }
+        self.results.append(result)
+        if self.options.verbosity:
+            print('%-20s median %.6fs, min %.6fs, %d queries' % (
+                name, result['median'], result['min'], result['queries']), file=sys.stderr)
+        return result
+
+    def random_article(self):
+        return self.random.choice(self.articles)
+
+    def random_time(self):
+        return self.get_version_time(self.random.randrange(self.options.versions)) + timedelta(minutes=30)
+
+    def random_interval(self):
+        time_from = self.random_time()
+        return time_from, time_from + timedelta(hours=self.random.randint(1, max(self.options.versions // 4, 1)))
+
+    def next_time(self):
+        self.time += timedelta(hours=1)
+        return self.time
+
+    def run_writes(self):
+        number = max(int(round(self.options.members * self.options.churn)), 1)
+
+        def prepare_add():
+            article = self.random_article()
+            candidates = sorted(self.pool - self.items[article.pk])
+            ids = sorted(self.random.sample(candidates, min(number, len(candidates))))
+            self.items[article.pk].update(ids)
+            return self.get_manager(article, self.next_time()), ids
+
+        def prepare_remove():
+            article = self.random_article()
+            candidates = sorted(self.items[article.pk])
+            ids = sorted(self.random.sample(candidates, min(number, len(candidates))))
+            self.items[article.pk].difference_update(ids)
+            return self.get_manager(article, self.next_time()), ids
+
+        def prepare_set():
+            article = self.random_article()
+            self.items[article.pk] = self.churn(self.items[article.pk], self.pool)
+            return self.get_manager(article, self.next_time()), sorted(self.items[article.pk])
+
+        self.measure('add', prepare_add, lambda manager, ids: manager.add(*ids))
+        self.measure('remove', prepare_remove, lambda manager, ids: manager.remove(*ids))
+        self.measure('set', prepare_set, lambda manager, ids: manager.set(ids))
+
+    def run_reads(self):
+        def prepare_time():
+            return self.get_manager(self.random_article()), self.random_time()
+
+        def prepare_interval():
+            return (self.get_manager(self.random_article()),) + self.random_interval()
+
+        def prepare_version():
+            return self.random.choice(list(self.get_manager(self.random_article()).versions.order_by('time'))),
+
+        self.measure('were_at', prepare_time, lambda manager, time: list(manager.were_at(time, only_pk=True)))
+        for name in ['were_between', 'added_between', 'removed_between']:
+            self.measure(name, prepare_interval, lambda manager, time_from, time_to, name=name: list(
+                getattr(manager, name)(time_from, time_to, only_pk=True)))
+        self.measure('version.items', prepare_version, lambda version: list(version.items(only_pk=True)))
+        self.measure('last_update_time', lambda: (self.get_manager(self.random_article()),),
+                     lambda manager: manager.last_update_time())
+        self.measure('version.delete', prepare_version, lambda version: version.delete())
+
+    def run(self):
+        from django.db import connection
+
+        started = default_timer()
+        self.generate()
+        generation = default_timer() - started
+        self.run_writes()
+        self.run_reads()
+        return {
+            'environment': {
+                'vendor': connection.vendor,
+                'django': __import__('django').get_version(),
+                'python': platform.python_version(),
+            },
+            'options': vars(self.options),
+            'generation': generation,
+            'results': self.results,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of history of ManyToManyHistoryField')
+    parser.add_argument('--instances', type=int, default=20, help='Number of instances with history')
+    parser.add_argument('--members', type=int, default=200, help='Number of items of every instance')
+    parser.add_argument('--versions', type=int, default=20, help='Number of versions of every instance')
+    parser.add_argument('--churn', type=float, default=0.1, help='Part of items, replaced in every version')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of runs of every operation')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of random generator of history')
+    parser.add_argument('--field', default='publications', help='Field of Article model from m2m_history.test_app')
+    parser.add_argument('--output', help='File for results in JSON, printed if omitted')
+    parser.add_argument('--verbosity', type=int, default=1)
+    options = parser.parse_args()
+    if not 0 <= options.churn <= 1:
+        parser.error('Argument churn should be between 0 and 1')
+
+    setup()
+    from django.db import connection
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        result = Benchmark(options).run()
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(result, output, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(result, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Set algebra of items of ManyToManyHistoryField at moments of time. Sets of different instances, fields and times
+are combined by operators & (intersection), | (union) and - (difference) and compiled into one query
+with subqueries of the through tables:
+
+    >>> moved = HistorySet(group_a.members, time1) & HistorySet(group_b.members, time2) \
+    ...     - HistorySet(group_b.members, time1)
+    >>> moved.queryset()
+"""
+from django.db.models import Q
+
+__all__ = ['HistorySet']
+
+
+class HistorySet(object):
+    """
+    Items of manager of ManyToManyHistoryField at the time, current items if time is None
+    """
+    def __init__(self, manager, time=None):
+        self.manager = manager
+        self.time = time
+
+    @property
+    def model(self):
+        return self.manager.model
+
+    @property
+    def db(self):
+        return self.manager.db
+
+    def get_q(self):
+        """
+        Return condition of primary keys of items by subquery of the through table
+        """
+        if self.time is None:
+            ids = self.manager.get_queryset(only_pk=True)
+        else:
+            ids = self.manager.were_at(self.time, only_pk=True)
+        return Q(pk__in=ids)
+
+    def queryset(self, only_pk=False):
+        """
+        Return lazy queryset of items of the set
+        """
+        qs = self.model._default_manager.using(self.db).filter(self.get_q())
+        if only_pk:
+            qs = qs.values_list('pk', flat=True)
+        return qs
+
+    def combine(self, other, operator):
+        if not isinstance(other, HistorySet):
+            return NotImplemented
+        return HistorySetOperation(self, other, operator)
+
+    def __and__(self, other):
+        return self.combine(other, '&')
+
+    def __or__(self, other):
+        return self.combine(other, '|')
+
+    def __sub__(self, other):
+        return self.combine(other, '-')
+
+
+class HistorySetOperation(HistorySet):
+    """
+    Intersection (&), union (|) or difference (-) of two sets of items of the same model
+    """
+    def __init__(self, lhs, rhs, operator):
+        if lhs.model is not rhs.model:
+            raise ValueError("Sets of items of different models %s and %s can not be combined" % (
+                lhs.model._meta.object_name, rhs.model._meta.object_name))
+        self.lhs = lhs
+        self.rhs = rhs
+        self.operator = operator
+
+    @property
+    def model(self):
+        return self.lhs.model
+
+    @property
+    def db(self):
+        return self.lhs.db
+
+    def get_q(self):
+        if self.operator == '&':
+            return self.lhs.get_q() & self.rhs.get_q()
+        elif self.operator == '|':
+            return self.lhs.get_q() | self.rhs.get_q()
+        # primary keys of items are never NULL, so NOT IN is exact
+        return self.lhs.get_q() & ~self.rhs.get_q()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Aggregates of history of ManyToManyHistoryField over all the instances, computed by one query in database
+"""
+from django.conf import settings
+from django.db import connections
+from django.db.models import DateTimeField
+from django.utils import timezone
+
+__all__ = ['PERIODS', 'get_period_sql', 'to_period', 'through_churn', 'get_duration_sql', 'through_tenure']
+
+# periods of series, supported by `datetime_trunc_sql` of all backends
+PERIODS = ['minute', 'hour', 'day', 'month', 'year']
+
+
+def get_period_sql(connection, period, column):
+    """
+    Return tuple (sql, params) of start of period of datetime column in the current time zone
+    """
+    if period not in PERIODS:
+        raise ValueError("Argument period should be one of: %s" % ', '.join(PERIODS))
+    tzname = timezone.get_current_timezone_name() if settings.USE_TZ else None
+    return connection.ops.datetime_trunc_sql(period, column, tzname)
+
+
+def to_period(value):
+    """
+    Convert start of period, selected by raw query or extra select, to datetime of the current time zone
+    """
+    value = DateTimeField().to_python(value)
+    if value is not None and settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_current_timezone())
+    return value
+
+
+def through_churn(field, period, time_from=None, time_to=None, using=None):
+    """
+    Return list of dictionaries with start of period and numbers of added and removed items of all the instances
+    per period, computed from the through table of the field by one aggregate query. Optional times limit changes
+    """
+    connection = connections[using or 'default']
+    qn = connection.ops.quote_name
+    table = qn(field.rel.through._meta.db_table)
+
+    selects, params = [], []
+    for column, added, removed in [('time_from', 1, 0), ('time_to', 0, 1)]:
+        period_sql, period_params = get_period_sql(connection, period, '%s.%s' % (table, qn(column)))
+        where = ['%s.%s IS NOT NULL' % (table, qn(column))]
+        params += period_params
+        for operator, time in [('>=', time_from), ('<=', time_to)]:
+            if time is not None:
+                where.append('%s.%s %s %%s' % (table, qn(column), operator))
+                params.append(field.rel.through._meta.get_field(column).get_db_prep_value(time, connection))
+        selects.append('SELECT %s AS period, %d AS added, %d AS removed FROM %s WHERE %s' % (
+            period_sql, added, removed, table, ' AND '.join(where)))
+
+    cursor = connection.cursor()
+    cursor.execute('''SELECT churn.period, SUM(churn.added), SUM(churn.removed) FROM (%s) churn
+        GROUP BY churn.period ORDER BY churn.period''' % ' UNION ALL '.join(selects), params)
+    return [{'period': to_period(period), 'added': int(added), 'removed': int(removed)}
+            for period, added, removed in cursor.fetchall()]
+
+
+def get_duration_sql(connection, table):
+    """
+    Return SQL of duration of rows of the through table in seconds with one parameter: time, when open rows end
+    """
+    time_to = 'COALESCE(%s.time_to, %%s)' % table
+    if connection.vendor == 'postgresql':
+        return 'EXTRACT(EPOCH FROM (%s - %s.time_from))' % (time_to, table)
+    elif connection.vendor == 'sqlite':
+        return '((julianday(%s) - julianday(%s.time_from)) * 86400.0)' % (time_to, table)
+    elif connection.vendor == 'mysql':
+        return 'TIMESTAMPDIFF(SECOND, %s.time_from, %s)' % (table, time_to)
+    raise NotImplementedError("Durations of rows are not supported by %s backend" % connection.vendor)
+
+
+def through_tenure(field, group_by=None, now=None, sources=None, targets=None, percentiles=(), min_duration=None,
+                   using=None):
+    """
+    Return list of dictionaries with aggregates of durations of intervals of items in seconds: `count`, `sum`,
+    `avg`, `min`, `max` and percentiles as `p50` for 0.5 (PostgreSQL only), computed from the through table of the
+    field by one query. Open intervals last till `now`, intervals without `time_from` are skipped.
+    Intervals are grouped by `id` of instance (`group_by='source'`) or of item (`group_by='target'`) or not grouped,
+    filtered by primary keys of `sources` and `targets` and groups by `min_duration` (timedelta) of their sum
+    """
+    connection = connections[using or 'default']
+    qn = connection.ops.quote_name
+    opts = field.rel.through._meta
+    table = qn(opts.db_table)
+    columns = {
+        'source': qn(opts.get_field(field.m2m_field_name()).column),
+        'target': qn(opts.get_field(field.m2m_reverse_field_name()).column),
+    }
+    if group_by not in [None, 'source', 'target']:
+        raise ValueError("Argument group_by should be 'source', 'target' or None")
+    if percentiles and connection.vendor != 'postgresql':
+        raise NotImplementedError("Percentiles of durations are supported only by PostgreSQL")
+
+    where = ['%s.time_from IS NOT NULL' % table]
+    params = [opts.get_field('time_to').get_db_prep_value(now or timezone.now(), connection)]
+    for name, ids in [('source', sources), ('target', targets)]:
+        if ids is not None:
+            ids = list(ids)
+            if not ids:
+                return []
+            where.append('%s.%s IN (%s)' % (table, columns[name], ', '.join(['%s'] * len(ids))))
+            params += ids
+
+    select = ['COUNT(*)'] + ['%s(tenure.duration)' % function for function in ['SUM', 'AVG', 'MIN', 'MAX']]
+    names = ['count', 'sum', 'avg', 'min', 'max']
+    for percentile in percentiles:
+        select.append('percentile_cont(%f) WITHIN GROUP (ORDER BY tenure.duration)' % float(percentile))
+        names.append('p%g' % (float(percentile) * 100))
+    if group_by is not None:
+        select.insert(0, 'tenure.%s' % group_by)
+        names.insert(0, 'id')
+
+    sql = 'SELECT %s FROM (SELECT %s AS source, %s AS target, %s AS duration FROM %s WHERE %s) tenure' % (
+        ', '.join(select), columns['source'], columns['target'], get_duration_sql(connection, table), table,
+        ' AND '.join(where))
+    if group_by is not None:
+        sql += ' GROUP BY tenure.%s' % group_by
+        if min_duration is not None:
+            sql += ' HAVING SUM(tenure.duration) >= %s'
+            params.append(min_duration.total_seconds())
+        sql += ' ORDER BY tenure.%s' % group_by
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    result = []
+    for row in cursor.fetchall():
+        values = dict(zip(names, row))
+        if not values['count']:
+            continue
+        for name in names:
+            if name not in ['id', 'count']:
+                values[name] = float(values[name])
+        result.append(values)
+    return result
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Audit of health of the through table and versions of ManyToManyHistoryField. Instances are walked by batches
+of primary keys, only sampled batches are examined by grouped queries, which use index of source column,
+so the audit is safe for large tables. Totals are estimated by the sampled part of instances
+"""
+import heapq
+import random
+from datetime import timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .bulk import iter_batches
+from .models import ManyToManyHistoryVersion
+
+__all__ = ['audit', 'explain']
+
+
+def explain(queryset):
+    """
+    Return tuple (uses index, lines of plan) of the queryset, uses index is None if backend is not supported
+    """
+    connection = connections[queryset.db]
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.execute('EXPLAIN ' + sql, params)
+        plan = [row[0] for row in cursor.fetchall()]
+        return any(['Index' in line for line in plan]), plan
+    elif connection.vendor == 'sqlite':
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = [row[-1] for row in cursor.fetchall()]
+        return any(['INDEX' in line for line in plan]), plan
+    elif connection.vendor == 'mysql':
+        cursor.execute('EXPLAIN ' + sql, params)
+        columns = [column[0] for column in cursor.description]
+        plan = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        return any([row['key'] for row in plan]), [repr(row) for row in plan]
+    return None, []
+
+
+def get_temporal_querysets(field, id, using=None):
+    """
+    Return dictionary with querysets of the through table of temporal queries of the instance,
+    the same as by manager of the field without checkpoints, caches and `time_range`
+    """
+    source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    qs = field.rel.through._default_manager.using(using).filter(**{source: id})
+    time = timezone.now()
+    time_from = time - timedelta(days=1)
+    querysets = {
+        'were_at': qs.filter(Q(time_from=None, time_to=None) | Q(time_from=None, time_to__gt=time) |
+                             Q(time_from__lte=time, time_to=None) | Q(time_from__lte=time, time_to__gt=time)),
+        'added_between': qs.filter(time_from__gte=time_from, time_from__lte=time),
+        'removed_between': qs.filter(time_to__gte=time_from, time_to__lte=time),
+        'current': qs.filter(time_to=None),
+    }
+    return dict([(name, queryset.values_list(target, flat=True)) for name, queryset in querysets.items()])
+
+
+def audit(field, batch_size=1000, sample=1., seed=None, top=10, explain_queries=True):
+    """
+    Return dictionary with health of the through table and versions of the field: numbers of all and open rows
+    and their ratio, estimated totals, the largest histories of instances, duplicate open pairs (source, target),
+    numbers of versions per instance and indexes of temporal queries by EXPLAIN. Batches of `batch_size` instances
+    are examined with probability `sample`
+    """
+    if not 0 < sample <= 1:
+        raise ValueError("Argument sample should be more than 0 and not more than 1")
+    through = field.rel.through
+    using = router.db_for_read(through)
+    source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    rows = through._default_manager.using(using)
+    versions = ManyToManyHistoryVersion.objects.filter(
+        content_type=ContentType.objects.get_for_model(field.model), field_name=field.name)
+    generator = random.Random(seed)
+
+    result = {
+        'instances': 0,
+        'sampled_instances': 0,
+        'instances_with_history': 0,
+        'rows': 0,
+        'open_rows': 0,
+        'duplicate_open_pairs': 0,
+        'versions': 0,
+        'max_versions': 0,
+    }
+    largest = []
+    for batch in iter_batches(field.model._default_manager.using(using), 'pk', batch_size):
+        result['instances'] += len(batch)
+        if sample < 1 and generator.random() >= sample:
+            continue
+        result['sampled_instances'] += len(batch)
+        qs = rows.filter(**{'%s__in' % source: batch})
+
+        counts = dict(qs.values_list(source).annotate(Count('pk')).order_by())
+        result['instances_with_history'] += len(counts)
+        result['rows'] += sum(counts.values())
+        for id, count in counts.items():
+            if len(largest) < top:
+                heapq.heappush(largest, (count, id))
+            elif count > largest[0][0]:
+                heapq.heapreplace(largest, (count, id))
+
+        result['open_rows'] += qs.filter(time_to=None).count()
+        result['duplicate_open_pairs'] += qs.filter(time_to=None).values(source, target).annotate(
+            rows=Count('pk')).filter(rows__gt=1).order_by().count()
+
+        if field.versions:
+            for id, count in versions.filter(object_id__in=batch).values_list('object_id').annotate(
+                    Count('pk')).order_by():
+                result['versions'] += count
+                result['max_versions'] = max(result['max_versions'], count)
+
+    result['closed_rows'] = result['rows'] - result['open_rows']
+    result['closed_to_open_ratio'] = float(result['closed_rows']) / result['open_rows'] \
+        if result['open_rows'] else None
+    ratio = float(result['instances']) / result['sampled_instances'] if result['sampled_instances'] else 0
+    for name in ['rows', 'open_rows', 'duplicate_open_pairs', 'versions']:
+        result['estimated_%s' % name] = int(round(result[name] * ratio))
+    result['versions_per_instance'] = float(result['versions']) / result['instances_with_history'] \
+        if result['instances_with_history'] else None
+    result['largest_histories'] = [{'id': id, 'rows': count} for count, id in sorted(largest, reverse=True)]
+
+    result['explain'] = {}
+    if explain_queries and largest:
+        # plans of the largest history are the most representative
+        for name, queryset in get_temporal_querysets(field, max(largest)[1], using=using).items():
+            uses_index, plan = explain(queryset)
+            result['explain'][name] = {'index': uses_index, 'plan': plan}
+    return result
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Set-based backfill of versions of ManyToManyHistoryField, which got argument `versions` after history was collected.
+Every distinct `time_from` and `time_to` of rows of the through table is a version of the instance. Versions
+of a range of instances are derived and inserted by one INSERT ... SELECT: numbers of added and removed items
+are grouped by time, count of items is a running sum of changes by window function (by correlated subquery
+on backends without window functions). Ranges are processed by pool of processes
+"""
+import multiprocessing
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router
+
+from .bulk import atomic, iter_batches
+from .models import ManyToManyHistorySummary, ManyToManyHistoryVersion, supports_window_functions
+
+__all__ = ['get_ranges', 'backfill_range', 'backfill_versions']
+
+
+def get_ranges(field, batch_size=10000):
+    """
+    Return list of tuples (first, last) of primary keys of instances with rows in the through table,
+    every range has `batch_size` instances
+    """
+    return [(batch[0], batch[-1]) for batch in iter_batches(
+        field.rel.through._default_manager.all(), field.m2m_field_name(), batch_size)]
+
+
+def backfill_range(field, first, last):
+    """
+    Insert versions of instances with primary keys from first to last, which are absent yet, by one query.
+    Summaries of instances are deleted, they are made again on the next access. Return number of versions
+    """
+    through = field.rel.through
+    using = router.db_for_write(ManyToManyHistoryVersion)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = through._meta
+    params = {
+        'through': qn(opts.db_table),
+        'source': qn(opts.get_field(field.m2m_field_name()).column),
+        'versions': qn(ManyToManyHistoryVersion._meta.db_table),
+    }
+    content_type = ContentType.objects.get_for_model(field.model)
+
+    # changes of every instance grouped by time
+    events_sql = '''SELECT changes.source, changes.time, SUM(changes.added) AS added, SUM(changes.removed) AS removed
+        FROM (
+            SELECT %(source)s AS source, time_from AS time, 1 AS added, 0 AS removed FROM %(through)s
+            WHERE time_from IS NOT NULL AND %(source)s BETWEEN %%s AND %%s
+            UNION ALL
+            SELECT %(source)s AS source, time_to AS time, 0 AS added, 1 AS removed FROM %(through)s
+            WHERE time_to IS NOT NULL AND %(source)s BETWEEN %%s AND %%s
+        ) changes GROUP BY changes.source, changes.time''' % params
+    if supports_window_functions(connection):
+        # items without `time_from` are present since the beginning
+        count_sql = '''COALESCE((SELECT COUNT(*) FROM %(through)s initial
+            WHERE initial.%(source)s = events.source AND initial.time_from IS NULL), 0)
+            + SUM(events.added - events.removed) OVER (PARTITION BY events.source ORDER BY events.time
+                ROWS UNBOUNDED PRECEDING)''' % params
+    else:
+        count_sql = '''(SELECT COUNT(*) FROM %(through)s counted WHERE counted.%(source)s = events.source
+            AND (counted.time_from IS NULL OR counted.time_from <= events.time)
+            AND (counted.time_to IS NULL OR counted.time_to > events.time))''' % params
+
+    sql = '''INSERT INTO %(versions)s (content_type_id, object_id, field_name, time, count, added_count, removed_count)
+        SELECT %%s, versions.source, %%s, versions.time, versions.count, versions.added, versions.removed FROM (
+            SELECT events.source, events.time, events.added, events.removed, %(count)s AS count
+            FROM (%(events)s) events
+        ) versions
+        WHERE NOT EXISTS (SELECT 1 FROM %(versions)s existing WHERE existing.content_type_id = %%s
+            AND existing.object_id = versions.source AND existing.field_name = %%s
+            AND existing.time = versions.time)''' % dict(params, count=count_sql, events=events_sql)
+
+    with atomic(using=using):
+        cursor = connection.cursor()
+        cursor.execute(sql, [content_type.pk, field.name] + [first, last] * 2 + [content_type.pk, field.name])
+        count = cursor.rowcount
+        if field.summary:
+            ManyToManyHistorySummary.objects.using(using).filter(
+                content_type=content_type, field_name=field.name, object_id__gte=first, object_id__lte=last).delete()
+    return count
+
+
+def close_connections():
+    # connections of parent process can't be shared with processes of pool
+    for connection in connections.all():
+        connection.close()
+
+
+def backfill_worker(args):
+    from .fields import get_history_fields
+    label, first, last = args
+    return backfill_range(get_history_fields([label])[0], first, last)
+
+
+def backfill_versions(field, batch_size=10000, processes=1):
+    """
+    Backfill versions of all instances of the field by ranges of `batch_size` instances, every range in own
+    transaction. Ranges are processed by pool of `processes` forked processes, if more than one.
+    Return number of inserted versions
+    """
+    ranges = get_ranges(field, batch_size=batch_size)
+    if processes <= 1 or len(ranges) <= 1:
+        return sum([backfill_range(field, first, last) for first, last in ranges])
+
+    label = '%s.%s.%s' % (field.model._meta.app_label, field.model._meta.object_name, field.name)
+    close_connections()
+    pool = multiprocessing.Pool(processes, initializer=close_connections)
+    try:
+        return sum(pool.map(backfill_worker, [(label, first, last) for first, last in ranges]))
+    finally:
+        pool.close()
+        pool.join()
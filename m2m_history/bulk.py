@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Set-based operations with rows of through tables, which don't load all the rows into memory
+"""
+import uuid
+from contextlib import contextmanager
+from itertools import islice
+from timeit import default_timer
+
+from django.conf import settings
+from django.db.models import DateTimeField
+from django.utils import six, timezone
+from django.utils.six import StringIO
+
+from .instrumentation import get_queries_log, queries_logged
+
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    from django.db.transaction import commit_on_success as atomic
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_batches(queryset, field_name, batch_size):
+    """
+    Yield lists of distinct values of the field of queryset in ascending order by batches of keyset pagination
+    """
+    values = queryset.values_list(field_name, flat=True).distinct().order_by(field_name)
+    last = None
+    while True:
+        batch = list((values if last is None else values.filter(**{'%s__gt' % field_name: last}))[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last = batch[-1]
+
+
+@contextmanager
+def temporary_table(connection, columns):
+    """
+    Create temporary table with columns as list of (name, db_type) and drop it on exit
+    """
+    qn = connection.ops.quote_name
+    name = 'm2m_history_%s' % uuid.uuid4().hex[:16]
+    cursor = connection.cursor()
+    cursor.execute('CREATE TEMPORARY TABLE %s (%s)' % (
+        qn(name), ', '.join(['%s %s' % (qn(column), db_type) for column, db_type in columns])))
+    try:
+        yield name
+    finally:
+        cursor.execute('DROP TABLE %s' % qn(name))
+
+
+def log_query(connection, sql, time):
+    """
+    Log query, executed without cursor of Django, the same way as cursor of Django does it
+    """
+    if queries_logged(connection):
+        get_queries_log(connection).append({'sql': sql, 'time': '%.3f' % time})
+
+
+def copy_rows(connection, table, columns, rows, chunk_size=10000):
+    """
+    Insert rows (tuples of values, prepared for database) into the table by COPY FROM STDIN by chunks.
+    PostgreSQL only
+    """
+    cursor = connection.cursor()
+    for chunk in chunked(rows, chunk_size):
+        data = u'\n'.join([u'\t'.join([u'\\N' if value is None else six.text_type(value) for value in row])
+                           for row in chunk])
+        started = default_timer()
+        cursor.copy_from(StringIO(data), table, columns=columns)
+        # COPY is not logged by cursor of Django
+        log_query(connection, 'COPY %s (%s) FROM STDIN' % (table, ', '.join(columns)), default_timer() - started)
+
+
+def load_ids(connection, table, column, ids, chunk_size=10000):
+    """
+    Load ids from iterable into the column of table by chunks: COPY on PostgreSQL and batched INSERT elsewhere.
+    Index on the column is created after loading
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        copy_rows(connection, table, [column], ((id,) for id in ids), chunk_size=chunk_size)
+    else:
+        for chunk in chunked(ids, chunk_size):
+            cursor.executemany('INSERT INTO %s (%s) VALUES (%%s)' % (qn(table), qn(column)), [(id,) for id in chunk])
+    cursor.execute('CREATE INDEX %s ON %s (%s)' % (qn('%s_%s' % (table, column)), qn(table), qn(column)))
+
+
+@contextmanager
+def staged_ids(connection, ids, db_type, chunk_size=10000):
+    """
+    Stage ids from iterable into temporary table with one column `id` and return name of the table
+    """
+    with temporary_table(connection, [('id', db_type)]) as table:
+        load_ids(connection, table, 'id', ids, chunk_size=chunk_size)
+        yield table
+
+
+def to_datetime(value):
+    """
+    Convert datetime value of raw query, which is not converted by backend
+    """
+    value = DateTimeField().to_python(value)
+    if value is not None and settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.utc)
+    return value
+
+
+def utc_tzinfo_factory(offset):
+    return timezone.utc
+
+
+def iter_rows(connection, sql, params, chunk_size=2000):
+    """
+    Iterate rows of query by chunks: by server-side cursor in transaction on PostgreSQL
+    and by fetchmany() of cursor elsewhere
+    """
+    if connection.vendor == 'postgresql':
+        with atomic(using=connection.alias):
+            connection.ensure_connection()
+            cursor = connection.connection.cursor(name='m2m_history_%s' % uuid.uuid4().hex)
+            cursor.itersize = chunk_size
+            # the same conversion of datetimes as by cursors of backend
+            cursor.tzinfo_factory = utc_tzinfo_factory if settings.USE_TZ else None
+            try:
+                cursor.execute(sql, params)
+                for row in cursor:
+                    yield row
+            finally:
+                cursor.close()
+    else:
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row
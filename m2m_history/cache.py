@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of primary keys of current items of ManyToManyHistoryField with argument `cache`. Keys of items are versioned
+by generation of the instance: every change makes a new generation, so an entry, stored by concurrent reader
+with previous generation, could never be read as actual.
+
+Results of history methods of the field with argument `history_cache` for time windows before the last update
+are cached without timeout, because the past doesn't change. Their generation is changed only by deleting of
+versions, compaction and changes with time not later than the last update
+
+Changes of `sync()` pass lazy querysets of primary keys to signals, they aren't loaded: instead of generations of
+instances the whole other side of the through table gets a new generation, which is a part of every key too.
+
+Generations are changed inside of transaction of the change, so concurrent reader could store the state before
+commit with the new generation. They are changed again after commit, if hooks of transactions are available
+(Django 1.9+ or django-transaction-hooks backends). Otherwise values, stored during
+`M2M_HISTORY_CACHE_UNCOMMITTED_TIMEOUT` seconds (60 by default) after the change, expire after that timeout
+"""
+import uuid
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models.query import QuerySet
+from django.dispatch import receiver
+
+from .signals import m2m_history_changed
+
+try:
+    from django.core.cache import caches
+
+    def get_cache(alias):
+        return caches[alias]
+except ImportError:
+    from django.core.cache import get_cache
+
+__all__ = ['get_cached_ids', 'invalidate', 'cached_history', 'invalidate_history', 'invalidate_manager_history']
+
+
+def get_field_cache(field, option='cache'):
+    """
+    Return cache of the field by option `cache` or `history_cache`, None if it's disabled
+    """
+    alias = getattr(field, option)
+    if not alias:
+        return None
+    return get_cache('default' if alias is True else alias)
+
+
+def get_side_prefix(through, reverse):
+    """
+    Return prefix of keys of one side of the through table
+    """
+    return 'm2m_history:%s:%s' % (through._meta.db_table, 'reverse' if reverse else 'forward')
+
+
+def get_prefix(through, reverse, pk):
+    """
+    Return prefix of keys of the instance at one side of the through table
+    """
+    return '%s:%s' % (get_side_prefix(through, reverse), pk)
+
+
+def in_transaction(connection):
+    if hasattr(connection, 'in_atomic_block'):
+        return connection.in_atomic_block or not connection.get_autocommit()
+    # Django 1.5
+    return connection.is_managed()
+
+
+def repeat_after_commit(using, function):
+    """
+    Register function to be called again after commit of the current transaction of the database.
+    Return False, if there is a transaction and hooks of transactions are not available
+    """
+    connection = connections[using]
+    if not in_transaction(connection):
+        return True
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(function, using=using)
+    elif hasattr(connection, 'on_commit'):
+        # backends of django-transaction-hooks
+        connection.on_commit(function)
+    else:
+        return False
+    return True
+
+
+def get_uncommitted_timeout():
+    return getattr(settings, 'M2M_HISTORY_CACHE_UNCOMMITTED_TIMEOUT', 60)
+
+
+def change_generations(cache, through, prefixes, name, deleted_keys=()):
+    """
+    Delete keys and make new generations of instances with prefixes now and after commit of the current transaction
+    """
+    def change():
+        cache.delete_many(list(deleted_keys))
+        cache.set_many(dict([('%s:%s' % (prefix, name), uuid.uuid4().hex) for prefix in prefixes]), None)
+
+    if not repeat_after_commit(router.db_for_write(through), change):
+        cache.set_many(dict([('%s:%s:uncommitted' % (prefix, name), True) for prefix in prefixes]),
+                       get_uncommitted_timeout())
+    change()
+
+
+def get_timeout(cache, prefixes, timeout, name='generation'):
+    """
+    Return timeout of value of the current generations of prefixes, short one if any of them could be made
+    before commit of the change
+    """
+    if cache.get_many(['%s:%s:uncommitted' % (prefix, name) for prefix in prefixes]):
+        return get_uncommitted_timeout() if timeout is None else min(timeout, get_uncommitted_timeout())
+    return timeout
+
+
+def get_generation(cache, prefix, name='generation'):
+    key = '%s:%s' % (prefix, name)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        # another process could add it concurrently
+        generation = cache.get(key)
+    return generation
+
+
+def get_generations(cache, prefixes, name='generation'):
+    return ':'.join([get_generation(cache, prefix, name) for prefix in prefixes])
+
+
+def get_cached_ids(manager, field, name, compute):
+    """
+    Return cached value of the manager by name, `compute` function makes it if there is no actual value
+    """
+    cache = get_field_cache(field)
+    prefix = get_prefix(manager.through, manager.reverse, manager.instance.pk)
+    prefixes = [get_side_prefix(manager.through, manager.reverse), prefix]
+    key = '%s:%s:%s' % (prefix, get_generations(cache, prefixes), name)
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        timeout = get_timeout(cache, prefixes, field.cache_timeout)
+        if timeout is None:
+            cache.set(key, value)
+        else:
+            cache.set(key, value, timeout)
+    return value
+
+
+def get_prefixes(through, reverse, pks):
+    """
+    Return prefixes of instances with primary keys at one side of the through table, prefix of the side
+    for not empty lazy queryset of primary keys
+    """
+    if isinstance(pks, QuerySet):
+        return [get_side_prefix(through, reverse)] if pks.exists() else []
+    return [get_prefix(through, reverse, pk) for pk in pks]
+
+
+def invalidate(field, through, reverse, pks):
+    """
+    Make new generations of instances with primary keys at one side of the through table
+    """
+    cache = get_field_cache(field)
+    if cache is not None:
+        prefixes = get_prefixes(through, reverse, pks)
+        if prefixes:
+            change_generations(cache, through, prefixes, 'generation')
+
+
+def cached_history(method):
+    """
+    Decorator of history method of manager with time arguments, which caches primary keys of result permanently,
+    if the time window is before the last update
+    """
+    @wraps(method)
+    def wrapper(manager, *args, **kwargs):
+        field = get_through_field(manager.through)
+        cache = get_field_cache(field, 'history_cache')
+        if cache is None or manager._get_prefetched(method.__name__, *args) is not None:
+            return method(manager, *args, **kwargs)
+
+        prefix = get_prefix(manager.through, manager.reverse, manager.instance.pk)
+        prefixes = [get_side_prefix(manager.through, manager.reverse), prefix]
+        last_update_time = cache.get(prefix + ':last_update_time')
+        if last_update_time is None:
+            try:
+                last_update_time = manager.last_update_time()
+            except IndexError:
+                return method(manager, *args, **kwargs)
+            cache.set(prefix + ':last_update_time', last_update_time,
+                      get_timeout(cache, prefixes, None, 'history_generation'))
+        if max(args) >= last_update_time:
+            return method(manager, *args, **kwargs)
+
+        unique = kwargs.get('unique', True)
+        key = '%s:%s:%s:%s:%s' % (prefix, get_generations(cache, prefixes, 'history_generation'), method.__name__,
+                                  ':'.join([time.isoformat() for time in args]), 'unique' if unique else 'all')
+        ids = cache.get(key)
+        if ids is None:
+            ids = list(method(manager, *args, only_pk=True, unique=unique))
+            cache.set(key, ids, get_timeout(cache, prefixes, None, 'history_generation'))
+        return manager._prepare_ids(ids, **kwargs)
+    return wrapper
+
+
+def invalidate_history(field, through, reverse, pks, time=None):
+    """
+    Make new history generations of instances with primary keys at one side of the through table.
+    If time of change is specified, only instances updated not before it are invalidated
+    """
+    cache = get_field_cache(field, 'history_cache')
+    if cache is None:
+        return
+    if isinstance(pks, QuerySet):
+        prefixes = get_prefixes(through, reverse, pks)
+        if prefixes:
+            change_generations(cache, through, prefixes, 'history_generation')
+        return
+    if not pks:
+        return
+    keys = dict([(get_prefix(through, reverse, pk) + ':last_update_time', pk) for pk in pks])
+    if time is not None:
+        last_update_times = cache.get_many(list(keys))
+        keys = dict([(key, pk) for key, pk in keys.items()
+                     if key not in last_update_times or time <= last_update_times[key]])
+    change_generations(cache, through, [get_prefix(through, reverse, pk) for pk in keys.values()],
+                       'history_generation', keys)
+
+
+def invalidate_manager_history(manager, queryset=None):
+    """
+    Make new history generations of the instance of manager and of items of rows of the through table queryset.
+    Should be called before changes of the rows
+    """
+    field = get_through_field(manager.through)
+    if field.history_cache:
+        invalidate_history(field, manager.through, manager.reverse, [manager.instance.pk])
+        if queryset is not None:
+            pks = list(queryset.values_list(manager.target_field_name, flat=True).distinct())
+            invalidate_history(field, manager.through, get_other_side(field, manager.reverse), pks)
+
+
+def update_last_update_time(field, through, reverse, pks, time):
+    """
+    Move cached time of the last update of instances forward to the time of change
+    """
+    cache = get_field_cache(field, 'history_cache')
+    if isinstance(pks, QuerySet):
+        # earlier cached time of the last update only makes less windows cached
+        return
+    keys = [get_prefix(through, reverse, pk) + ':last_update_time' for pk in pks]
+    if cache is not None and keys:
+        cache.set_many(dict([(key, time) for key, last_update_time in cache.get_many(keys).items()
+                             if time > last_update_time]), None)
+
+
+def get_through_field(through):
+    """
+    Return field of through model: of the model, which created it, or of models of its foreign keys,
+    if the through model is declared explicitly
+    """
+    opts = through._meta
+    models = [opts.auto_created] if opts.auto_created else [field.rel.to for field in opts.fields if field.rel]
+    for model in models:
+        for field in model._meta.many_to_many:
+            if field.rel.through is through:
+                return field
+
+
+def get_other_side(field, reverse):
+    # both sides of symmetrical relation are forward
+    return False if field.rel.symmetrical and field.rel.to == field.model else not reverse
+
+
+def get_accessor_name(field, reverse):
+    """
+    Return name of attribute of instance with manager of the field at the side
+    """
+    if not reverse:
+        return field.name
+    # `get_accessor_name` of relation is not present before Django 1.8
+    return (field.rel if hasattr(field.rel, 'get_accessor_name') else field.related).get_accessor_name()
+
+
+@receiver(m2m_history_changed)
+def invalidate_m2m_history_cache(sender, action, instance, reverse, pk_set, **kwargs):
+    # invalidate before the change too, otherwise other receivers of post signals could read stale items
+    if action in ['pre_add', 'pre_remove', 'pre_clear', 'post_add', 'post_remove', 'post_clear']:
+        field = get_through_field(sender)
+        if field is not None and field.cache:
+            invalidate(field, sender, reverse, [instance.pk])
+            invalidate(field, sender, get_other_side(field, reverse), pk_set)
+        if field is not None and field.history_cache:
+            for side, pks in [(reverse, [instance.pk]), (get_other_side(field, reverse), pk_set)]:
+                if action.startswith('pre_'):
+                    invalidate_history(field, sender, side, pks, kwargs['time'])
+                else:
+                    update_last_update_time(field, sender, side, pks, kwargs['time'])
+
+
+def invalidate_row(sender, instance, times=()):
+    """
+    Invalidate both sides of row of through table, changed at times, all the history if times are unknown
+    """
+    field = get_through_field(sender)
+    source_id = getattr(instance, '%s_id' % field.m2m_field_name())
+    target_id = getattr(instance, '%s_id' % field.m2m_reverse_field_name())
+    for side, pk in [(False, source_id), (get_other_side(field, False), target_id)]:
+        invalidate(field, sender, side, [pk])
+        invalidate_history(field, sender, side, [pk], min(times) if times else None)
+        if times:
+            update_last_update_time(field, sender, side, [pk], max(times))
+
+
+def invalidate_saved_row(sender, instance, **kwargs):
+    """
+    Invalidate both sides of row of through table, saved by its own manager, since the earliest time of the row.
+    Connected by fields with argument `cache` or `history_cache`
+    """
+    invalidate_row(sender, instance, [time for time in [instance.time_from, instance.time_to] if time is not None])
+
+
+def invalidate_deleted_row(sender, instance, **kwargs):
+    """
+    Invalidate both sides of row of through table, deleted with one of related instances.
+    Connected by fields with argument `cache` or `history_cache`
+    """
+    invalidate_row(sender, instance)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Compaction of history of ManyToManyHistoryField: merging of old versions into coarser periods, dropping of expired
+intervals and joining of adjacent intervals of the same item
+"""
+from collections import defaultdict
+
+from django.db import connections, models
+from django.db.models import Count
+from django.db.models.query import QuerySet
+
+from .bulk import atomic, temporary_table
+from .cache import invalidate_manager_history
+from .models import ManyToManyHistoryVersion
+
+__all__ = ['GRANULARITIES', 'compact']
+
+# key of period of time for every granularity of merged versions
+GRANULARITIES = {
+    'hour': lambda time: (time.date(), time.hour),
+    'day': lambda time: time.date(),
+    'week': lambda time: time.isocalendar()[:2],
+}
+
+
+def drop_expired(manager, time):
+    """
+    Delete intervals of items, closed before the time, with versions and checkpoints of that period.
+    Return number of deleted intervals
+    """
+    qs = manager.get_queryset_through().filter(time_to__lt=time)
+    count = qs.count()
+    qs.delete()
+    # versions are deleted without moving of their changes, because the changes are deleted already
+    QuerySet.delete(manager.versions.filter(time__lt=time))
+    manager.checkpoints.filter(time__lt=time).delete()
+    return count
+
+
+def merge_versions(manager, before, granularity):
+    """
+    Leave only the last version of every period before the time, changes of other versions are moved to it.
+    The first version is kept, because there is no previous version for its items. Return number of deleted versions
+    """
+    get_period = GRANULARITIES[granularity]
+    versions = list(manager.versions.filter(time__lt=before).order_by('time').values_list('pk', 'time'))
+    pks = [pk for (pk, time), (next_pk, next_time) in zip(versions[1:], versions[2:])
+           if get_period(time) == get_period(next_time)]
+    if pks:
+        ManyToManyHistoryVersion.objects.filter(pk__in=pks).delete()
+    return len(pks)
+
+
+def join_intervals(manager, before):
+    """
+    Join adjacent intervals of the same item, where one of them is closed and the next one is opened at the same
+    time before the argument. Every pass joins the last pair of each chain. Return number of joined intervals
+    """
+    connection = connections[manager.db]
+    qn = connection.ops.quote_name
+    opts = manager.through._meta
+    time_field = opts.get_field('time_to')
+    params = {
+        'through': qn(opts.db_table),
+        'pk': qn(opts.pk.column),
+        'source': qn(opts.get_field(manager.source_field_name).column),
+        'target': qn(opts.get_field(manager.target_field_name).column),
+    }
+    object_id = manager._fk_val
+    before = time_field.get_db_prep_value(before, connection)
+
+    joined = 0
+    # ids of earlier rows are copied to the second temporary table, because MySQL can not refer to temporary table
+    # twice in one query
+    id_type = models.BigIntegerField().db_type(connection)
+    with temporary_table(connection, [('id', id_type), ('earlier_id', id_type),
+                                      ('time_to', time_field.db_type(connection))]) as table, \
+            temporary_table(connection, [('id', id_type)]) as earlier_table:
+        params['joined'] = qn(table)
+        params['earlier'] = qn(earlier_table)
+        cursor = connection.cursor()
+        while True:
+            cursor.execute('DELETE FROM %(joined)s' % params)
+            cursor.execute('DELETE FROM %(earlier)s' % params)
+            cursor.execute('''INSERT INTO %(joined)s (id, earlier_id, time_to)
+                SELECT later.%(pk)s, earlier.%(pk)s, later.time_to FROM %(through)s later
+                JOIN %(through)s earlier ON earlier.%(source)s = later.%(source)s
+                    AND earlier.%(target)s = later.%(target)s AND earlier.time_to = later.time_from
+                WHERE later.%(source)s = %%s AND later.time_from < %%s AND NOT EXISTS (
+                    SELECT 1 FROM %(through)s following WHERE following.%(source)s = later.%(source)s
+                        AND following.%(target)s = later.%(target)s AND following.time_from = later.time_to
+                        AND following.time_from < %%s)''' % params, [object_id, before, before])
+            if not cursor.rowcount:
+                break
+            joined += cursor.rowcount
+            cursor.execute('INSERT INTO %(earlier)s (id) SELECT earlier_id FROM %(joined)s' % params)
+            # later rows are deleted before the end of earlier ones is moved, so unique open rows never clash
+            cursor.execute('DELETE FROM %(through)s WHERE %(pk)s IN (SELECT %(joined)s.id FROM %(joined)s)' % params)
+            cursor.execute('''UPDATE %(through)s SET time_to = (
+                    SELECT %(joined)s.time_to FROM %(joined)s WHERE %(joined)s.earlier_id = %(through)s.%(pk)s)
+                WHERE %(pk)s IN (SELECT %(earlier)s.id FROM %(earlier)s)''' % params)
+    return joined
+
+
+def recount_versions(manager):
+    """
+    Recompute `count`, `added_count` and `removed_count` of all versions from aggregated changes of items
+    """
+    qs = manager.get_queryset_through()
+    added = dict(qs.values_list('time_from').annotate(Count('pk')))
+    removed = dict(qs.exclude(time_to=None).values_list('time_to').annotate(Count('pk')))
+    changes = defaultdict(int)
+    for time, count in added.items():
+        if time is not None:
+            changes[time] += count
+    for time, count in removed.items():
+        changes[time] -= count
+    times = sorted(changes)
+
+    # count of items at the time of every version is a running sum of changes since items without `time_from`
+    count = added.get(None, 0)
+    i = 0
+    for version in manager.versions.order_by('time'):
+        while i < len(times) and times[i] <= version.time:
+            count += changes[times[i]]
+            i += 1
+        values = {
+            'count': count,
+            'added_count': added.get(version.time, 0),
+            'removed_count': removed.get(version.time, 0),
+        }
+        if values != dict([(name, getattr(version, name)) for name in values]):
+            ManyToManyHistoryVersion.objects.filter(pk=version.pk).update(**values)
+
+
+def compact(manager, before, granularity=None, expire=None):
+    """
+    Compact history of the instance in one transaction:
+     * drop intervals closed before `expire` time;
+     * merge versions before `before` time into periods of `granularity`: 'hour', 'day' or 'week';
+     * join adjacent intervals of the same item before `before` time;
+     * recompute counts of versions;
+     * delete summary of the instance, it's made again on the next access.
+    Return dictionary with numbers of expired intervals, merged versions and joined intervals
+    """
+    if granularity is not None and granularity not in GRANULARITIES:
+        raise ValueError("Argument granularity should be one of: %s" % ', '.join(sorted(GRANULARITIES)))
+
+    result = {'expired': 0, 'merged': 0, 'joined': 0}
+    with atomic(using=manager.db):
+        invalidate_manager_history(manager, manager.get_queryset_through().filter(
+            time_from__lt=before if expire is None else max(before, expire)))
+        if expire is not None:
+            result['expired'] = drop_expired(manager, expire)
+        if granularity is not None:
+            result['merged'] = merge_versions(manager, before, granularity)
+        result['joined'] = join_intervals(manager, before)
+        if manager.versions.exists():
+            recount_versions(manager)
+        manager.delete_summary()
+    return result
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Set-based deleting of many versions of ManyToManyHistoryField. Versions of every field are deleted by the same
+number of statements, whatever the number of versions is: deleted versions are staged with the next kept version
+of the instance into temporary table, changes of their items are moved to it or reverted by UPDATE and DELETE
+with subqueries. MySQL can't refer to temporary table twice in one statement, so copies are used, where it's needed
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, models
+
+from .bulk import atomic, temporary_table
+from .cache import get_other_side, get_through_field, invalidate, invalidate_history
+from .instrumentation import instrumented
+from .models import ManyToManyHistoryCheckpoint, ManyToManyHistoryVersion
+from .summary import refresh_summaries
+
+__all__ = ['delete_versions']
+
+# conditions on staged version `moves`: changes of version are moved to the next kept version,
+# changes of the first version of instance are kept as they are, changes after the last kept version are reverted
+MERGED = '%(moves)s.next_time IS NOT NULL AND %(moves)s.is_first = 0'
+REVERTED = '%(moves)s.next_time IS NULL'
+
+
+def delete_versions(queryset):
+    """
+    Delete versions of the queryset with the same result as deleting of them one by one from the latest:
+    changes of items of version are moved to the next kept version, changes after the last kept version
+    are reverted, all rows of instances without kept versions are deleted
+    """
+    queryset = queryset.order_by()
+    with atomic(using=queryset.db):
+        for content_type_id, field_name in list(queryset.values_list('content_type', 'field_name').distinct()):
+            qs = queryset.filter(content_type=content_type_id, field_name=field_name)
+            # manager of any instance knows through table and columns of the field at its side
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            manager = getattr(model(pk=qs.values_list('object_id', flat=True)[0]), field_name)
+            delete_field_versions(manager, qs)
+
+
+@instrumented('versions.delete')
+def delete_field_versions(manager, queryset):
+    connection = connections[manager.db]
+    qn = connection.ops.quote_name
+    opts = manager.through._meta
+    time_type = opts.get_field('time_to').db_type(connection)
+    source_type = opts.get_field(manager.source_field_name).db_type(connection)
+    target_type = opts.get_field(manager.target_field_name).db_type(connection)
+    id_type = models.BigIntegerField().db_type(connection)
+    flag_type = models.IntegerField().db_type(connection)
+    deleted_sql, deleted_params = queryset.values_list('pk', flat=True).query.sql_with_params()
+    params = {
+        'through': qn(opts.db_table),
+        'pk': qn(opts.pk.column),
+        'source': qn(opts.get_field(manager.source_field_name).column),
+        'target': qn(opts.get_field(manager.target_field_name).column),
+        'versions': qn(ManyToManyHistoryVersion._meta.db_table),
+        'checkpoints': qn(ManyToManyHistoryCheckpoint._meta.db_table),
+        'time': qn('time'),
+        'deleted': deleted_sql,
+    }
+    moves_columns = [('version_id', id_type), ('object_id', source_type), ('deleted_time', time_type),
+                     ('next_time', time_type), ('is_first', flag_type), ('has_kept', flag_type)]
+    rows_columns = [('row_id', id_type), ('object_id', source_type), ('target', target_type),
+                    ('time_from', time_type), ('time_to', time_type), ('from_moved', flag_type),
+                    ('to_moved', flag_type), ('joined', flag_type), ('continued', flag_type)]
+    rows_names = ', '.join([name for name, db_type in rows_columns])
+
+    with temporary_table(connection, moves_columns) as moves, \
+            temporary_table(connection, moves_columns) as moves_copy, \
+            temporary_table(connection, [('object_id', source_type)]) as objects, \
+            temporary_table(connection, rows_columns) as rows, \
+            temporary_table(connection, rows_columns) as rows_copy:
+        params.update(moves=qn(moves), moves_copy=qn(moves_copy), objects=qn(objects), rows=qn(rows),
+                      rows_copy=qn(rows_copy), rows_names=rows_names)
+        params.update(merged=MERGED % {'moves': 'moves'}, merged_copy=MERGED % {'moves': 'moves_copy'},
+                      reverted=REVERTED % {'moves': 'moves'})
+        cursor = connection.cursor()
+
+        # every deleted version with time of the next kept version of the instance
+        cursor.execute('''INSERT INTO %(moves)s (version_id, object_id, deleted_time, next_time, is_first, has_kept)
+            SELECT deleted.id, deleted.object_id, deleted.%(time)s,
+                (SELECT MIN(kept.%(time)s) FROM %(versions)s kept WHERE kept.content_type_id = deleted.content_type_id
+                    AND kept.object_id = deleted.object_id AND kept.field_name = deleted.field_name
+                    AND kept.%(time)s > deleted.%(time)s AND kept.id NOT IN (%(deleted)s)),
+                CASE WHEN EXISTS (SELECT 1 FROM %(versions)s earlier
+                    WHERE earlier.content_type_id = deleted.content_type_id AND earlier.object_id = deleted.object_id
+                        AND earlier.field_name = deleted.field_name AND earlier.%(time)s < deleted.%(time)s)
+                    THEN 0 ELSE 1 END,
+                CASE WHEN EXISTS (SELECT 1 FROM %(versions)s kept WHERE kept.content_type_id = deleted.content_type_id
+                    AND kept.object_id = deleted.object_id AND kept.field_name = deleted.field_name
+                    AND kept.id NOT IN (%(deleted)s)) THEN 1 ELSE 0 END
+            FROM %(versions)s deleted WHERE deleted.id IN (%(deleted)s)''' % params, deleted_params * 3)
+        cursor.execute('INSERT INTO %(moves_copy)s SELECT * FROM %(moves)s' % params)
+        cursor.execute('INSERT INTO %(objects)s (object_id) SELECT DISTINCT object_id FROM %(moves)s' % params)
+
+        # cached history of instances and of items, changed by the versions, is not valid anymore
+        cursor.execute('SELECT object_id FROM %(objects)s' % params)
+        object_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute('''SELECT DISTINCT %(target)s FROM %(through)s
+            WHERE %(source)s IN (SELECT object_id FROM %(objects)s) AND EXISTS (
+                SELECT 1 FROM %(moves)s moves WHERE moves.object_id = %(through)s.%(source)s AND (moves.has_kept = 0
+                    OR %(through)s.time_from IN (moves.deleted_time, moves.next_time)
+                    OR %(through)s.time_to IN (moves.deleted_time, moves.next_time)))''' % params)
+        target_ids = [row[0] for row in cursor.fetchall()]
+        field = get_through_field(manager.through)
+        for invalidate_side in [invalidate, invalidate_history]:
+            invalidate_side(field, manager.through, manager.reverse, object_ids)
+            invalidate_side(field, manager.through, get_other_side(field, manager.reverse), target_ids)
+
+        # instances without kept versions -> delete all
+        cursor.execute('''DELETE FROM %(through)s WHERE %(source)s IN (
+            SELECT object_id FROM %(moves)s WHERE has_kept = 0)''' % params)
+        # versions after the last kept version -> delete all entered items and all left items are not left
+        cursor.execute('''DELETE FROM %(through)s WHERE %(source)s IN (SELECT object_id FROM %(objects)s) AND EXISTS (
+            SELECT 1 FROM %(moves)s moves WHERE moves.object_id = %(through)s.%(source)s
+                AND moves.deleted_time = %(through)s.time_from AND %(reverted)s)''' % params)
+        cursor.execute('''UPDATE %(through)s SET time_to = NULL
+            WHERE %(source)s IN (SELECT object_id FROM %(objects)s) AND EXISTS (
+                SELECT 1 FROM %(moves)s moves WHERE moves.object_id = %(through)s.%(source)s
+                    AND moves.deleted_time = %(through)s.time_to AND %(reverted)s)''' % params)
+
+        # versions in the middle -> stage rows, which enter or leave in them, with times moved to the next kept
+        # version, and rows, which enter in the next kept version, to join intervals of the same item
+        cursor.execute('''INSERT INTO %(rows)s (%(rows_names)s)
+            SELECT %(through)s.%(pk)s, %(through)s.%(source)s, %(through)s.%(target)s,
+                CASE WHEN moves.version_id IS NULL THEN %(through)s.time_from ELSE moves.next_time END,
+                CASE WHEN moves_copy.version_id IS NULL THEN %(through)s.time_to ELSE moves_copy.next_time END,
+                CASE WHEN moves.version_id IS NULL THEN 0 ELSE 1 END,
+                CASE WHEN moves_copy.version_id IS NULL THEN 0 ELSE 1 END, 0, 0
+            FROM %(through)s
+            LEFT JOIN %(moves)s moves ON moves.object_id = %(through)s.%(source)s
+                AND moves.deleted_time = %(through)s.time_from AND %(merged)s
+            LEFT JOIN %(moves_copy)s moves_copy ON moves_copy.object_id = %(through)s.%(source)s
+                AND moves_copy.deleted_time = %(through)s.time_to AND %(merged_copy)s
+            WHERE %(through)s.%(source)s IN (SELECT object_id FROM %(objects)s)
+                AND (moves.version_id IS NOT NULL OR moves_copy.version_id IS NOT NULL)''' % params)
+        cursor.execute('''INSERT INTO %(rows)s (%(rows_names)s)
+            SELECT %(pk)s, %(source)s, %(target)s, time_from, time_to, 0, 0, 0, 0 FROM %(through)s
+            WHERE %(source)s IN (SELECT object_id FROM %(objects)s) AND EXISTS (
+                SELECT 1 FROM %(moves)s moves WHERE moves.object_id = %(through)s.%(source)s
+                    AND moves.next_time = %(through)s.time_from AND %(merged)s
+            ) AND NOT EXISTS (
+                SELECT 1 FROM %(moves_copy)s moves_copy WHERE moves_copy.object_id = %(through)s.%(source)s
+                    AND moves_copy.deleted_time = %(through)s.time_to AND %(merged_copy)s)''' % params)
+
+        # all, who entered and left between kept versions -> delete
+        cursor.execute('''DELETE FROM %(through)s WHERE %(pk)s IN (
+            SELECT row_id FROM %(rows)s WHERE time_from = time_to)''' % params)
+        cursor.execute('DELETE FROM %(rows)s WHERE time_from = time_to' % params)
+
+        # all, who left and entered again in the same kept version -> join intervals of the item: the first
+        # interval of every chain gets the end of the last one, the others are deleted
+        cursor.execute('INSERT INTO %(rows_copy)s SELECT * FROM %(rows)s' % params)
+        cursor.execute('''UPDATE %(rows)s SET joined = 1 WHERE EXISTS (
+            SELECT 1 FROM %(rows_copy)s earlier WHERE earlier.object_id = %(rows)s.object_id
+                AND earlier.target = %(rows)s.target AND earlier.time_to = %(rows)s.time_from
+                AND (earlier.to_moved = 1 OR %(rows)s.from_moved = 1))''' % params)
+        cursor.execute('''UPDATE %(rows)s SET continued = 1 WHERE EXISTS (
+            SELECT 1 FROM %(rows_copy)s later WHERE later.object_id = %(rows)s.object_id
+                AND later.target = %(rows)s.target AND later.time_from = %(rows)s.time_to
+                AND (%(rows)s.to_moved = 1 OR later.from_moved = 1))''' % params)
+        cursor.execute('DELETE FROM %(rows_copy)s' % params)
+        cursor.execute('INSERT INTO %(rows_copy)s SELECT * FROM %(rows)s' % params)
+        cursor.execute('''UPDATE %(rows)s SET time_to = (
+                SELECT chain_end.time_to FROM %(rows_copy)s chain_end WHERE chain_end.object_id = %(rows)s.object_id
+                    AND chain_end.target = %(rows)s.target AND chain_end.continued = 0
+                    AND chain_end.time_from > %(rows)s.time_from
+                ORDER BY chain_end.time_from LIMIT 1)
+            WHERE joined = 0 AND continued = 1''' % params)
+        cursor.execute('DELETE FROM %(through)s WHERE %(pk)s IN (SELECT row_id FROM %(rows)s WHERE joined = 1)'
+                       % params)
+        for column in ['time_from', 'time_to']:
+            cursor.execute('''UPDATE %(through)s SET %(column)s = (
+                    SELECT %(rows)s.%(column)s FROM %(rows)s WHERE %(rows)s.row_id = %(through)s.%(pk)s)
+                WHERE %(pk)s IN (SELECT row_id FROM %(rows_copy)s WHERE joined = 0)''' % dict(params, column=column))
+
+        # update counts of the next kept versions, checkpoints after the deleted versions are not valid anymore
+        cursor.execute('''UPDATE %(versions)s SET
+                added_count = (SELECT COUNT(*) FROM %(through)s WHERE %(through)s.%(source)s = %(versions)s.object_id
+                    AND %(through)s.time_from = %(versions)s.%(time)s),
+                removed_count = (SELECT COUNT(*) FROM %(through)s WHERE %(through)s.%(source)s = %(versions)s.object_id
+                    AND %(through)s.time_to = %(versions)s.%(time)s)
+            WHERE content_type_id = %%s AND field_name = %%s AND EXISTS (
+                SELECT 1 FROM %(moves)s moves WHERE moves.object_id = %(versions)s.object_id
+                    AND moves.next_time = %(versions)s.%(time)s AND %(merged)s)''' % params,
+                       [ContentType.objects.get_for_model(manager.instance).pk, manager.accessor_name])
+        cursor.execute('''DELETE FROM %(checkpoints)s WHERE content_type_id = %%s AND field_name = %%s
+            AND object_id IN (SELECT object_id FROM %(objects)s) AND EXISTS (
+                SELECT 1 FROM %(moves)s moves WHERE moves.object_id = %(checkpoints)s.object_id
+                    AND moves.deleted_time <= %(checkpoints)s.%(time)s)''' % params,
+                       [ContentType.objects.get_for_model(manager.instance).pk, manager.prefetch_cache_name])
+        cursor.execute('DELETE FROM %(versions)s WHERE id IN (SELECT version_id FROM %(moves)s)' % params)
+
+    # summaries of instances with changed rows: of the instances or of their items at the reverse side
+    refresh_summaries(field, object_ids if manager.has_summary else target_ids, using=manager.db)
@@ -3,13 +3,19 @@ import warnings
 import django
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
-from django.db.models import Q
+from django.db.models import F, Max, Q
 from django.db.models.fields.related import ManyRelatedObjectsDescriptor, ReverseManyRelatedObjectsDescriptor, \
-    cached_property, create_many_related_manager, router, signals
+    cached_property, connections, create_many_related_manager, router, signals
 from django.utils import timezone
 
-from .models import ManyToManyHistoryVersion
+from .analytics import through_tenure
+from .bulk import atomic, copy_rows, iter_rows, staged_ids, temporary_table, to_datetime
+from .cache import cached_history, get_accessor_name, get_cached_ids
+from .instrumentation import instrumented, record_rows
+from .models import ManyToManyHistoryCheckpoint, ManyToManyHistorySummary, ManyToManyHistoryVersion
+from .prefetch import PREDICATES, HistoryPrefetch, get_cache_name, get_window
 from .signals import m2m_history_changed
+from .summary import get_summaries, get_summary_values, refresh_summaries
 
 # compatibility with Django 1.9
 if django.VERSION[:2] >= (1, 9):
@@ -28,9 +34,19 @@ def create_many_related_history_manager(superclass, rel):
         def db(self):
             return router.db_for_write(self.through, instance=self.instance)
 
+        @property
+        def accessor_name(self):
+            return get_accessor_name(rel.field, self.reverse)
+
         @property
         def versions(self):
             return ManyToManyHistoryVersion.objects.filter(
+                content_type=ContentType.objects.get_for_model(self.instance),
+                object_id=self.instance.pk, field_name=self.accessor_name)
+
+        @property
+        def checkpoints(self):
+            return ManyToManyHistoryCheckpoint.objects.filter(
                 content_type=ContentType.objects.get_for_model(self.instance),
                 object_id=self.instance.pk, field_name=self.prefetch_cache_name)
 
@@ -39,15 +55,68 @@ def create_many_related_history_manager(superclass, rel):
                 self.time = timezone.now()
             return self.time
 
-        def last_update_time(self):
-            # TODO: refactor and optimize this method to one query
-            qs = self.get_queryset_through()
+        @property
+        def has_summary(self):
+            """
+            Return True if the instance has summary, kept for the forward side of the field with argument `summary`
+            """
+            return rel.field.summary and not self.reverse
+
+        @property
+        def summary(self):
+            """
+            Return summary of the instance. Until it's saved by the first change or rebuild_summaries(),
+            it's made from the through table and versions without saving, so reads don't write
+            """
+            lookup = {
+                'content_type': ContentType.objects.get_for_model(self.instance),
+                'object_id': self.instance.pk,
+                'field_name': self.prefetch_cache_name,
+            }
             try:
-                time_to = qs.exclude(time_to=None).order_by('-time_to')[0].time_to
-                time_from = qs.exclude(time_from=None).order_by('-time_from')[0].time_from
-                return time_to if time_to > time_from else time_from
-            except IndexError:
-                return qs.exclude(time_from=None).order_by('-time_from')[0].time_from
+                return ManyToManyHistorySummary.objects.get(**lookup)
+            except ManyToManyHistorySummary.DoesNotExist:
+                lookup.update(get_summary_values(rel.field, [self._fk_val], using=self.db)[self._fk_val])
+                return ManyToManyHistorySummary(**lookup)
+
+        def delete_summary(self):
+            """
+            Delete summary of the instance after changes of history, it's made again on the next access
+            """
+            if self.has_summary:
+                get_summaries(rel.field, [self.instance.pk]).delete()
+
+        def _change_summary(self, source_field_name, ids, count):
+            # every change of rows passes here, so they are counted by instrumentation too
+            record_rows(abs(count))
+            # change count of items in summary of the instance and move times of changes to the time of change.
+            # Changed rows of reverse and symmetrical relations belong to the instances with ids, their summaries
+            # are deleted and made again on the next access
+            if not rel.field.summary or not count:
+                return
+            if self.reverse or source_field_name != self.source_field_name:
+                get_summaries(rel.field, ids).delete()
+                return
+            time = self.get_time()
+            summaries = get_summaries(rel.field, [self.instance.pk])
+            if not summaries.update(count=F('count') + count):
+                # the first change saves summary, rows are changed already
+                refresh_summaries(rel.field, [self._fk_val], using=self.db)
+                return
+            summaries.filter(Q(last_update_time=None) | Q(last_update_time__lt=time)).update(last_update_time=time)
+            if count > 0:
+                summaries.filter(Q(first_time=None) | Q(first_time__gt=time)).update(first_time=time)
+
+        def last_update_time(self):
+            if self.has_summary:
+                summary = self.summary
+                if summary.first_time is None:
+                    raise IndexError("There are no changes of items with time")
+                return summary.last_update_time
+            times = self.get_queryset_through().aggregate(Max('time_from'), Max('time_to'))
+            if times['time_from__max'] is None:
+                raise IndexError("There are no changes of items with time")
+            return max([time for time in times.values() if time is not None])
 
         def _prepare_queryset(self, qs, only_pk=False, unique=True):
             qs = qs.values_list(self.target_field_name, flat=True)
@@ -62,6 +131,67 @@ def create_many_related_history_manager(superclass, rel):
                 qs = qs.distinct()
             return qs
 
+        def _prepare_ids(self, ids, only_pk=False, unique=True):
+            """
+            Return queryset of items with primary keys, already known before query
+            """
+            if not only_pk and unique is False:
+                raise ValueError("Argument `unique` should be True if argument only_pk is False")
+            qs = self.model._default_manager.using(self.db).filter(pk__in=ids)
+            if only_pk:
+                qs = qs.values_list('pk', flat=True)
+                qs._result_cache = list(ids)
+            return qs
+
+        def _prepare_prefetched(self, objs, only_pk=False, unique=True):
+            """
+            Return queryset with result, already fetched by HistoryPrefetch
+            """
+            if unique:
+                pks = set()
+                objs = [obj for obj in objs if not (obj.pk in pks or pks.add(obj.pk))]
+            qs = self._prepare_ids([obj.pk for obj in objs], only_pk=only_pk, unique=unique)
+            if not only_pk:
+                qs._result_cache = objs
+                qs._prefetch_done = True
+            return qs
+
+        def _get_prefetched(self, method, *args):
+            """
+            Return list of items of history method, prefetched by HistoryPrefetch, or None
+            """
+            try:
+                qs = self.instance._prefetched_objects_cache[
+                    get_cache_name(self.prefetch_cache_name, get_window(method, args))]
+            except (AttributeError, KeyError):
+                return None
+            predicate = PREDICATES[method]
+            return [obj for obj in qs if predicate(obj._m2m_history_time_from, obj._m2m_history_time_to, *args)]
+
+        def get_prefetch_queryset(self, instances, queryset=None):
+            """
+            Difference from super method is filtering of current items or items of time window of HistoryPrefetch
+            """
+            window = None
+            if isinstance(queryset, HistoryPrefetch):
+                window, queryset = queryset.window, queryset.queryset
+            result = list(super(ManyToManyHistoryThroughManager, self).get_prefetch_queryset(instances, queryset))
+
+            qn = connections[result[0].db].ops.quote_name
+            time_from, time_to = ['%s.%s' % (qn(self.through._meta.db_table), qn(name))
+                                  for name in ['time_from', 'time_to']]
+            if window is None:
+                result[0] = result[0].extra(where=['%s IS NULL' % time_to])
+            else:
+                # rows for all the history methods of the window, they are filtered by `_get_prefetched` later
+                result[0] = result[0].extra(
+                    select={'_m2m_history_time_from': time_from, '_m2m_history_time_to': time_to},
+                    where=['(%s IS NULL OR %s <= %%s) AND (%s IS NULL OR %s >= %%s)' % (
+                        time_from, time_from, time_to, time_to)],
+                    params=[window[-1], window[1]])
+                result[4] = get_cache_name(self.prefetch_cache_name, window)
+            return tuple(result)
+
         def get_query_set(self, **kwargs):
             warnings.warn("Backward compatibility. Use get_queryset() instead", DeprecationWarning)
             return self.get_queryset(**kwargs)
@@ -81,12 +211,62 @@ def create_many_related_history_manager(superclass, rel):
             return qs
 
         def get_queryset(self, **kwargs):
+            if not kwargs:
+                try:
+                    return self.instance._prefetched_objects_cache[self.prefetch_cache_name]
+                except (AttributeError, KeyError):
+                    pass
             qs = self.get_queryset_through().filter(time_to=None)
+            if rel.field.cache:
+                ids = get_cached_ids(self, rel.field, 'items', lambda: set(self._prepare_queryset(qs, only_pk=True)))
+                return self._prepare_ids(ids, **kwargs)
             return self._prepare_queryset(qs, **kwargs)
 
+        def count(self):
+            if self.has_summary and self.prefetch_cache_name not in getattr(
+                    self.instance, '_prefetched_objects_cache', {}):
+                return self.summary.count
+            if rel.field.cache:
+                # count of cached primary keys without query
+                return self.get_queryset(only_pk=True).count()
+            return super(ManyToManyHistoryThroughManager, self).count()
+
+        @property
+        def time_range(self):
+            """
+            Return True if through table has `time_range` column, maintained by operations.AddTimeRange
+            """
+            return rel.field.time_range and connections[self.db].vendor == 'postgresql'
+
+        @property
+        def unique_open(self):
+            """
+            Return True if through table has unique index of open rows, created by operations.AddHistoryIndexes,
+            and backend supports INSERT ... ON CONFLICT with it
+            """
+            return rel.field.unique_open and connections[self.db].vendor == 'postgresql'
+
+        def _filter_time_range(self, qs, where, params):
+            qn = connections[self.db].ops.quote_name
+            return qs.extra(where=['(%s)' % where % {'table': qn(self.through._meta.db_table)}], params=params)
+
+        @instrumented()
+        @cached_history
         def were_between(self, time_from, time_to, **kwargs):
             if time_to <= time_from:
                 raise ValueError('Argument time_to should be later, than time_from')
+            prefetched = self._get_prefetched('were_between', time_from, time_to)
+            if prefetched is not None:
+                return self._prepare_prefetched(prefetched, **kwargs)
+            if self.time_range:
+                # the same conditions as below: intervals with open bound should cover the period, closed ones
+                # should intersect it or lie inside of it (zero length intervals are empty ranges)
+                where = '''%(table)s.time_range @> tstzrange(%%s, %%s, '[)')
+                    OR %(table)s.time_from IS NOT NULL AND %(table)s.time_to IS NOT NULL
+                    AND (%(table)s.time_range && tstzrange(%%s, %%s, '()')
+                        OR %(table)s.time_from >= %%s AND %(table)s.time_to <= %%s)'''
+                qs = self._filter_time_range(self.get_queryset_through(), where, [time_from, time_to] * 3)
+                return self._prepare_queryset(qs, **kwargs)
             qs = self.get_queryset_through().filter(
                 Q(time_from=None, time_to=None) |
                 Q(time_from=None, time_to__gte=time_to) |
@@ -96,19 +276,64 @@ def create_many_related_history_manager(superclass, rel):
                 Q(time_from__lt=time_to, time_to__gt=time_from))
             return self._prepare_queryset(qs, **kwargs)
 
+        @instrumented()
+        @cached_history
         def added_between(self, time_from, time_to, **kwargs):
             if time_to <= time_from:
                 raise ValueError('Argument time_to should be later, than time_from')
+            prefetched = self._get_prefetched('added_between', time_from, time_to)
+            if prefetched is not None:
+                return self._prepare_prefetched(prefetched, **kwargs)
             qs = self.get_queryset_through().filter(time_from__gte=time_from, time_from__lte=time_to)
             return self._prepare_queryset(qs, **kwargs)
 
+        @instrumented()
+        @cached_history
         def removed_between(self, time_from, time_to, **kwargs):
             if time_to <= time_from:
                 raise ValueError('Argument time_to should be later, than time_from')
+            prefetched = self._get_prefetched('removed_between', time_from, time_to)
+            if prefetched is not None:
+                return self._prepare_prefetched(prefetched, **kwargs)
             qs = self.get_queryset_through().filter(time_to__gte=time_from, time_to__lte=time_to)
             return self._prepare_queryset(qs, **kwargs)
 
+        def _were_at_checkpoint(self, time):
+            """
+            Return set of primary keys of items at the time, restored from the nearest checkpoint before the time
+            and changes after it, or None if there is no such checkpoint
+            """
+            try:
+                checkpoint = self.checkpoints.filter(time__lte=time).latest()
+            except ManyToManyHistoryCheckpoint.DoesNotExist:
+                return None
+            ids = checkpoint.ids
+            changes = self.get_queryset_through().filter(
+                Q(time_from__gt=checkpoint.time, time_from__lte=time) |
+                Q(time_to__gt=checkpoint.time, time_to__lte=time)) \
+                .values_list(self.target_field_name, 'time_from', 'time_to')
+            added = set()
+            for item_id, time_from, time_to in changes:
+                if time_to is not None and time_to <= time:
+                    ids.discard(item_id)
+                else:
+                    added.add(item_id)
+            return ids | added
+
+        @instrumented()
+        @cached_history
         def were_at(self, time, **kwargs):
+            prefetched = self._get_prefetched('were_at', time)
+            if prefetched is not None:
+                return self._prepare_prefetched(prefetched, **kwargs)
+            if not self.reverse and (rel.field.checkpoints_every or rel.field.checkpoints_interval):
+                ids = self._were_at_checkpoint(time)
+                if ids is not None:
+                    return self._prepare_ids(ids, **kwargs)
+            if self.time_range:
+                qs = self._filter_time_range(self.get_queryset_through(), '%(table)s.time_range @> %%s::timestamptz',
+                                             [time])
+                return self._prepare_queryset(qs, **kwargs)
             qs = self.get_queryset_through().filter(
                 Q(time_from=None, time_to=None) |
                 Q(time_from=None, time_to__gt=time) |
@@ -116,14 +341,126 @@ def create_many_related_history_manager(superclass, rel):
                 Q(time_from__lte=time, time_to__gt=time))
             return self._prepare_queryset(qs, **kwargs)
 
+        @instrumented()
+        @cached_history
         def added_at(self, time, **kwargs):
+            prefetched = self._get_prefetched('added_at', time)
+            if prefetched is not None:
+                return self._prepare_prefetched(prefetched, **kwargs)
             qs = self.get_queryset_through().filter(time_from=time)
             return self._prepare_queryset(qs, **kwargs)
 
+        @instrumented()
+        @cached_history
         def removed_at(self, time, **kwargs):
+            prefetched = self._get_prefetched('removed_at', time)
+            if prefetched is not None:
+                return self._prepare_prefetched(prefetched, **kwargs)
             qs = self.get_queryset_through().filter(time_to=time)
             return self._prepare_queryset(qs, **kwargs)
 
+        def iter_states(self, chunk_size=2000):
+            """
+            Iterate tuples (time, added, removed, items) for every time of changes by one ordered scan of events
+            of the through table, sets of primary keys of items are changed incrementally. `items` is the same set,
+            changed by the next iteration, copy it to keep. Items without time of adding are in the first tuple
+            with time None
+            """
+            connection = connections[self.db]
+            qn = connection.ops.quote_name
+            opts = self.through._meta
+            params = {
+                'through': qn(opts.db_table),
+                'source': qn(opts.get_field(self.source_field_name).column),
+                'target': qn(opts.get_field(self.target_field_name).column),
+            }
+            # events of adding (1) and removing (-1) of items
+            sql = '''SELECT events.time, events.target, events.change FROM (
+                    SELECT time_from AS time, %(target)s AS target, 1 AS change FROM %(through)s
+                        WHERE %(source)s = %%s
+                    UNION ALL
+                    SELECT time_to AS time, %(target)s AS target, -1 AS change FROM %(through)s
+                        WHERE %(source)s = %%s AND time_to IS NOT NULL
+                ) events
+                ORDER BY CASE WHEN events.time IS NULL THEN 0 ELSE 1 END, events.time''' % params
+
+            # number of open intervals of every item, could be more than one
+            counters = {}
+            items = set()
+
+            def apply(changes):
+                added, removed = set(), set()
+                for pk, change in changes.items():
+                    before = counters.get(pk, 0)
+                    counters[pk] = before + change
+                    if before <= 0 < counters[pk]:
+                        added.add(pk)
+                    elif counters[pk] <= 0 < before:
+                        removed.add(pk)
+                    if not counters[pk]:
+                        del counters[pk]
+                items.update(added)
+                items.difference_update(removed)
+                return added, removed
+
+            time = changes = None
+            for row_time, pk, change in iter_rows(connection, sql, [self._fk_val] * 2, chunk_size=chunk_size):
+                row_time = to_datetime(row_time)
+                if changes is None or row_time != time:
+                    if changes:
+                        added, removed = apply(changes)
+                        if added or removed:
+                            yield time, added, removed, items
+                    time, changes = row_time, {}
+                changes[pk] = changes.get(pk, 0) + change
+            if changes:
+                added, removed = apply(changes)
+                if added or removed:
+                    yield time, added, removed, items
+
+        def iter_diffs(self, chunk_size=2000):
+            """
+            Iterate tuples (time, added, removed) of sets of primary keys of items for every time of changes,
+            see iter_states()
+            """
+            for time, added, removed, items in self.iter_states(chunk_size=chunk_size):
+                yield time, added, removed
+
+        def _tenure(self, group_by=False, **kwargs):
+            # aggregates of intervals of the instance, grouped by items if `group_by` is True
+            if self.reverse:
+                return through_tenure(rel.field, group_by='source' if group_by else None, targets=[self._fk_val],
+                                      using=self.db, **kwargs)
+            return through_tenure(rel.field, group_by='target' if group_by else None, sources=[self._fk_val],
+                                  using=self.db, **kwargs)
+
+        def tenure(self, now=None):
+            """
+            Return dictionary with total durations of membership of items in seconds, open intervals last till now
+            """
+            return dict([(values['id'], values['sum']) for values in self._tenure(group_by=True, now=now)])
+
+        def tenure_stats(self, now=None, percentiles=()):
+            """
+            Return dictionary with `count`, `sum`, `avg`, `min`, `max` and percentiles (PostgreSQL only) of durations
+            of all intervals of items in seconds, see analytics.through_tenure()
+            """
+            stats = self._tenure(now=now, percentiles=percentiles)
+            return stats[0] if stats else {'count': 0}
+
+        def longer_than(self, duration, now=None, **kwargs):
+            """
+            Return items with total duration of membership (timedelta) not less than duration
+            """
+            ids = [values['id'] for values in self._tenure(group_by=True, now=now, min_duration=duration)]
+            return self._prepare_ids(ids, **kwargs)
+
+        # Django < 1.7 doesn't make them for explicit through model
+        if hasattr(baseManagerClass, 'add'):
+            add = instrumented()(baseManagerClass.add)
+            remove = instrumented()(baseManagerClass.remove)
+
+        @instrumented()
         def clear(self, *objs):
             self._clear_items(self.source_field_name, self.target_field_name, *objs)
 
@@ -133,6 +470,49 @@ def create_many_related_history_manager(superclass, rel):
 
         clear.alters_data = True
 
+        @instrumented()
+        def set(self, objs):
+            """
+            Replace current items by objs. Current items are read once, all the changes get the same time
+            """
+            with atomic(using=self.db):
+                self._set_items(self.source_field_name, self.target_field_name, *objs)
+
+                # If this is a symmetrical m2m relation to self, set the mirror entry in the m2m table
+                if self.symmetrical:
+                    self._set_items(self.target_field_name, self.source_field_name, *objs)
+
+        set.alters_data = True
+
+        @instrumented()
+        def sync(self, ids, chunk_size=10000):
+            """
+            Replace current items by primary keys from iterable or generator of any size. Ids are staged by chunks
+            into temporary table and changes are made by set-based queries, so they are never loaded into memory.
+            Argument `pk_set` of signals is a lazy queryset of primary keys, staged in temporary table, which is
+            dropped after the change
+            """
+            connection = connections[self.db]
+            db_type = self.through._meta.get_field(self.target_field_name).db_type(connection)
+            with atomic(using=self.db):
+                with staged_ids(connection, ids, db_type, chunk_size=chunk_size) as table:
+                    self._sync_items(self.source_field_name, self.target_field_name, table)
+
+                    # If this is a symmetrical m2m relation to self, sync the mirror entry in the m2m table
+                    if self.symmetrical:
+                        self._sync_items(self.target_field_name, self.source_field_name, table)
+
+        sync.alters_data = True
+
+        def compact(self, before, granularity=None, expire=None):
+            """
+            Compact history of items before the time, see compaction.compact()
+            """
+            from .compaction import compact
+            return compact(self, before, granularity=granularity, expire=expire)
+
+        compact.alters_data = True
+
         def send_signal(self, source_field_name, action, ids):
             if self.reverse or source_field_name == self.source_field_name:
                 # Don't send the signal when we are inserting the
@@ -165,6 +545,74 @@ def create_many_related_history_manager(superclass, rel):
                     values.add(obj)
             return values
 
+        def _get_current_ids(self, source_field_name, target_field_name, ids=None):
+            qs = self.through._default_manager.using(self.db) \
+                .values_list(target_field_name, flat=True) \
+                .filter(**{
+                    source_field_name: self._fk_val,
+                    'time_to': None,
+                })
+            if ids is not None:
+                qs = qs.filter(**{'%s__in' % target_field_name: ids})
+            return set(qs)
+
+        def _insert_items(self, source_field_name, target_field_name, ids):
+            # open new rows for ids, all of them should be absent in current items
+            if not ids:
+                return
+            connection = connections[self.db]
+            if connection.vendor == 'postgresql':
+                # stream rows by COPY without model instances
+                opts = self.through._meta
+                time_from = opts.get_field('time_from').get_db_prep_value(self.get_time(), connection)
+                copy_rows(connection, opts.db_table, [
+                    opts.get_field(source_field_name).column,
+                    opts.get_field(target_field_name).column,
+                    'time_from',
+                ], ((self._fk_val, obj_id, time_from) for obj_id in ids))
+            else:
+                self.through._default_manager.using(self.db).bulk_create([
+                    self.through(**{
+                        '%s_id' % source_field_name: self._fk_val,
+                        '%s_id' % target_field_name: obj_id,
+                        'time_from': self.get_time(),
+                    }) for obj_id in ids
+                ])
+            self._change_summary(source_field_name, ids, len(ids))
+
+        def _upsert_items(self, source_field_name, target_field_name, ids):
+            # open new rows for ids, current items are skipped by unique index of open rows.
+            # Return set of actually added ids
+            if not ids:
+                return set()
+            connection = connections[self.db]
+            qn = connection.ops.quote_name
+            opts = self.through._meta
+            params = {
+                'table': qn(opts.db_table),
+                'source': qn(opts.get_field(source_field_name).column),
+                'target': qn(opts.get_field(target_field_name).column),
+                'type': opts.get_field(target_field_name).db_type(connection),
+            }
+            cursor = connection.cursor()
+            cursor.execute('''INSERT INTO %(table)s (%(source)s, %(target)s, time_from)
+                SELECT %%s, added.id, %%s FROM unnest(%%s::%(type)s[]) AS added(id)
+                ON CONFLICT (%(source)s, %(target)s) WHERE time_to IS NULL DO NOTHING
+                RETURNING %(target)s''' % params, [self._fk_val, self.get_time(), list(ids)])
+            ids = set([row[0] for row in cursor.fetchall()])
+            self._change_summary(source_field_name, ids, len(ids))
+            return ids
+
+        def _close_items(self, source_field_name, target_field_name, ids):
+            # close current rows of ids
+            if ids:
+                count = self.through._default_manager.using(self.db).filter(**{
+                    source_field_name: self._fk_val,
+                    'time_to': None,
+                    '%s__in' % target_field_name: ids,
+                }).update(time_to=self.get_time())
+                self._change_summary(source_field_name, ids, -count)
+
         def _add_items(self, source_field_name, target_field_name, *objs):
             # source_field_name: the PK fieldname in join table for the source object
             # target_field_name: the PK fieldname in join table for the target object
@@ -173,26 +621,18 @@ def create_many_related_history_manager(superclass, rel):
             # If there aren't any objects, there is nothing to do.
             if objs:
                 new_ids = self.get_set_of_values(objs, target_field_name, check_values=True)
-                current_ids = self.through._default_manager.using(self.db) \
-                    .values_list(target_field_name, flat=True) \
-                    .filter(**{
-                        source_field_name: self._fk_val,
-                        '%s__in' % target_field_name: new_ids,
-                        'time_to': None,
-                    })
-                # remove current from new, otherwise integrity error while bulk_create
-                new_ids = new_ids.difference(set(current_ids))
+                if self.unique_open:
+                    # current items are not read, so `pre_add` signal gets all the values
+                    self.send_signal(source_field_name, 'pre_add', new_ids)
+                    new_ids = self._upsert_items(source_field_name, target_field_name, new_ids)
+                else:
+                    # remove current from new, otherwise integrity error while bulk_create
+                    new_ids = new_ids.difference(self._get_current_ids(source_field_name, target_field_name, new_ids))
 
-                self.send_signal(source_field_name, 'pre_add', new_ids)
+                    self.send_signal(source_field_name, 'pre_add', new_ids)
 
-                # Add the ones that aren't there already
-                self.through._default_manager.using(self.db).bulk_create([
-                    self.through(**{
-                        '%s_id' % source_field_name: self._fk_val,
-                        '%s_id' % target_field_name: obj_id,
-                        'time_from': self.get_time(),
-                    }) for obj_id in new_ids
-                ])
+                    # Add the ones that aren't there already
+                    self._insert_items(source_field_name, target_field_name, new_ids)
 
                 self.send_signal(source_field_name, 'post_add', new_ids)
 
@@ -207,12 +647,7 @@ def create_many_related_history_manager(superclass, rel):
                 self.send_signal(source_field_name, 'pre_remove', old_ids)
 
                 # Remove the specified objects from the join table
-                qs = self.through._default_manager.using(self.db).filter(**{
-                    source_field_name: self._fk_val,
-                    'time_to': None,
-                    '%s__in' % target_field_name: old_ids,
-                })
-                qs.update(time_to=self.get_time())
+                self._close_items(source_field_name, target_field_name, old_ids)
 
                 self.send_signal(source_field_name, 'post_remove', old_ids)
 
@@ -222,23 +657,83 @@ def create_many_related_history_manager(superclass, rel):
             # *objs - objects to clear
 
             new_ids = self.get_set_of_values(objs, target_field_name, check_values=True)
-            current_ids = self.through._default_manager.using(self.db) \
-                .values_list(target_field_name, flat=True) \
-                .filter(**{
-                    source_field_name: self._fk_val,
-                    'time_to': None,
-                })
-            old_ids = set(current_ids).difference(new_ids)
+            old_ids = self._get_current_ids(source_field_name, target_field_name).difference(new_ids)
             self.send_signal(source_field_name, 'pre_clear', old_ids)
 
-            qs = self.through._default_manager.using(self.db).filter(**{
-                source_field_name: self._fk_val,
-                'time_to': None,
-                '%s__in' % target_field_name: old_ids,
-            })
-            qs.update(time_to=self.get_time())
+            self._close_items(source_field_name, target_field_name, old_ids)
+
+            self.send_signal(source_field_name, 'post_clear', old_ids)
+
+        def _set_items(self, source_field_name, target_field_name, *objs):
+            # source_field_name: the PK colname in join table for the source object
+            # target_field_name: the PK colname in join table for the target object
+            # *objs - objects to set
 
-            self.send_signal(source_field_name, 'post_clear', set(self.removed_at(self.get_time(), only_pk=True)))
+            new_ids = self.get_set_of_values(objs, target_field_name, check_values=True)
+            current_ids = self._get_current_ids(source_field_name, target_field_name)
+            old_ids = current_ids.difference(new_ids)
+            new_ids = new_ids.difference(current_ids)
+
+            self.send_signal(source_field_name, 'pre_clear', old_ids)
+            self._close_items(source_field_name, target_field_name, old_ids)
+            self.send_signal(source_field_name, 'post_clear', old_ids)
+
+            self.send_signal(source_field_name, 'pre_add', new_ids)
+            self._insert_items(source_field_name, target_field_name, new_ids)
+            self.send_signal(source_field_name, 'post_add', new_ids)
+
+        def _sync_items(self, source_field_name, target_field_name, table):
+            # source_field_name: the PK colname in join table for the source object
+            # target_field_name: the PK colname in join table for the target object
+            # table: temporary table with column `id` of staged primary keys
+
+            connection = connections[self.db]
+            qn = connection.ops.quote_name
+            opts = self.through._meta
+            db_type = opts.get_field(target_field_name).db_type(connection)
+            with temporary_table(connection, [('id', db_type)]) as closed, \
+                    temporary_table(connection, [('id', db_type)]) as added:
+                params = {
+                    'through': qn(opts.db_table),
+                    'source': qn(opts.get_field(source_field_name).column),
+                    'target': qn(opts.get_field(target_field_name).column),
+                    'staged': qn(table),
+                    'closed': qn(closed),
+                    'added': qn(added),
+                    'model': qn(self.model._meta.db_table),
+                    'pk': qn(self.model._meta.pk.column),
+                }
+                # ids of the change are staged before it, so rows, changed earlier at the same time, don't get there
+                cursor = connection.cursor()
+                cursor.execute('''INSERT INTO %(closed)s (id) SELECT DISTINCT %(through)s.%(target)s FROM %(through)s
+                    WHERE %(through)s.%(source)s = %%s AND %(through)s.time_to IS NULL AND NOT EXISTS (
+                        SELECT 1 FROM %(staged)s WHERE %(staged)s.id = %(through)s.%(target)s)''' % params,
+                               [self._fk_val])
+                cursor.execute('''INSERT INTO %(added)s (id) SELECT DISTINCT %(staged)s.id FROM %(staged)s
+                    WHERE NOT EXISTS (SELECT 1 FROM %(through)s WHERE %(through)s.%(source)s = %%s
+                        AND %(through)s.%(target)s = %(staged)s.id AND %(through)s.time_to IS NULL)''' % params,
+                               [self._fk_val])
+
+                def get_ids(name):
+                    return self.model._default_manager.using(self.db).values_list('pk', flat=True).extra(
+                        where=['%s.%s IN (SELECT id FROM %s)' % (params['model'], params['pk'], params[name])])
+
+                old_ids = get_ids('closed')
+                self.send_signal(source_field_name, 'pre_clear', old_ids)
+                count = self.through._default_manager.using(self.db).filter(
+                    **{source_field_name: self._fk_val, 'time_to': None}).extra(
+                    where=['%(through)s.%(target)s IN (SELECT id FROM %(closed)s)' % params]).update(
+                    time_to=self.get_time())
+                self._change_summary(source_field_name, old_ids, -count)
+                self.send_signal(source_field_name, 'post_clear', old_ids)
+
+                new_ids = get_ids('added')
+                self.send_signal(source_field_name, 'pre_add', new_ids)
+                time_from = opts.get_field('time_from').get_db_prep_value(self.get_time(), connection)
+                cursor.execute('INSERT INTO %(through)s (%(source)s, %(target)s, time_from) '
+                               'SELECT %%s, %(added)s.id, %%s FROM %(added)s' % params, [self._fk_val, time_from])
+                self._change_summary(source_field_name, new_ids, cursor.rowcount)
+                self.send_signal(source_field_name, 'post_add', new_ids)
 
         # compatibility with Django 1.7
         if django.VERSION[:2] >= (1, 7):
@@ -266,7 +761,7 @@ class ReverseManyRelatedObjectsHistoryDescriptor(ReverseManyRelatedObjectsDescri
 
     def __set__(self, instance, value):
         """
-        Difference from super method is send value to `clear` method as well as to `add` method
+        Difference from super method is using `set` method of manager, which keeps history of changes
         """
         if instance is None:
             raise AttributeError("Manager must be accessed via instance")
@@ -277,8 +772,7 @@ class ReverseManyRelatedObjectsHistoryDescriptor(ReverseManyRelatedObjectsDescri
                                  "Use %s.%s's Manager instead." % (opts.app_label, opts.object_name))
 
         manager = self.__get__(instance)
-        manager.clear(*value)
-        manager.add(*value)
+        manager.set(value)
 
 
 class ManyRelatedObjectsHistoryDescriptor(ManyRelatedObjectsDescriptor):
@@ -294,7 +788,7 @@ class ManyRelatedObjectsHistoryDescriptor(ManyRelatedObjectsDescriptor):
 
     def __set__(self, instance, value):
         """
-        Difference from super method is send value to `clear` method as well as to `add` method
+        Difference from super method is using `set` method of manager, which keeps history of changes
         """
         if instance is None:
             raise AttributeError("Manager must be accessed via instance")
@@ -305,5 +799,4 @@ class ManyRelatedObjectsHistoryDescriptor(ManyRelatedObjectsDescriptor):
                                  "Use %s.%s's Manager instead." % (opts.app_label, opts.object_name))
 
         manager = self.__get__(instance)
-        manager.clear(*value)
-        manager.add(*value)
+        manager.set(value)
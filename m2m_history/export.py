@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export of history of ManyToManyHistoryField: rows of the through table and versions are read by chunks
+of server-side cursor on PostgreSQL (fetchmany() elsewhere) as plain tuples without model instances,
+so memory doesn't depend on size of history:
+
+    >>> for row in iter_through_rows(field, instances=Article.objects.filter(...), time_from=time):
+    ...     row
+    {'field': 'app.Article.publications', 'instance': 1, 'item': 2, 'time_from': datetime(...), 'time_to': None}
+"""
+import csv
+import json
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.utils.six import StringIO
+
+from .bulk import iter_rows, to_datetime
+from .models import ManyToManyHistoryVersion
+
+__all__ = ['THROUGH_COLUMNS', 'VERSION_COLUMNS', 'FORMATS', 'iter_through_rows', 'iter_version_rows', 'serialize']
+
+THROUGH_COLUMNS = ['field', 'instance', 'item', 'time_from', 'time_to']
+VERSION_COLUMNS = ['field', 'instance', 'time', 'count', 'added_count', 'removed_count']
+FORMATS = ['ndjson', 'csv']
+
+
+def get_label(field):
+    return '%s.%s.%s' % (field.model._meta.app_label, field.model._meta.object_name, field.name)
+
+
+def filter_instances(queryset, lookup, instances):
+    """
+    Filter queryset by instances: queryset of owners (subquery) or list of their primary keys
+    """
+    if instances is None:
+        return queryset
+    if isinstance(instances, QuerySet):
+        instances = instances.values('pk')
+    return queryset.filter(**{'%s__in' % lookup: instances})
+
+
+def stream(queryset, chunk_size):
+    """
+    Iterate tuples of values_list queryset by chunks of cursor, compiled SQL is executed without the ORM
+    """
+    sql, params = queryset.query.sql_with_params()
+    return iter_rows(connections[queryset.db], sql, params, chunk_size=chunk_size)
+
+
+def iter_through_rows(field, instances=None, time_from=None, time_to=None, chunk_size=2000):
+    """
+    Iterate dictionaries of rows of the through table of the field, ordered by primary key. Rows are filtered
+    by instances (queryset or primary keys) and intervals intersecting the time window
+    """
+    through = field.rel.through
+    queryset = through._default_manager.using(router.db_for_read(through))
+    queryset = filter_instances(queryset, field.m2m_field_name(), instances)
+    if time_from is not None:
+        queryset = queryset.filter(Q(time_to=None) | Q(time_to__gte=time_from))
+    if time_to is not None:
+        queryset = queryset.filter(Q(time_from=None) | Q(time_from__lte=time_to))
+    queryset = queryset.order_by('pk').values_list(
+        field.m2m_field_name(), field.m2m_reverse_field_name(), 'time_from', 'time_to')
+
+    label = get_label(field)
+    for instance, item, row_time_from, row_time_to in stream(queryset, chunk_size):
+        yield {
+            'field': label,
+            'instance': instance,
+            'item': item,
+            'time_from': to_datetime(row_time_from),
+            'time_to': to_datetime(row_time_to),
+        }
+
+
+def iter_version_rows(field, instances=None, time_from=None, time_to=None, chunk_size=2000):
+    """
+    Iterate dictionaries of versions of the field, ordered by primary key. Versions are filtered
+    by instances (queryset or primary keys) and the time window
+    """
+    queryset = ManyToManyHistoryVersion.objects.using(router.db_for_read(ManyToManyHistoryVersion)).filter(
+        content_type=ContentType.objects.get_for_model(field.model), field_name=field.name)
+    queryset = filter_instances(queryset, 'object_id', instances)
+    if time_from is not None:
+        queryset = queryset.filter(time__gte=time_from)
+    if time_to is not None:
+        queryset = queryset.filter(time__lte=time_to)
+    queryset = queryset.order_by('pk').values_list('object_id', 'time', 'count', 'added_count', 'removed_count')
+
+    label = get_label(field)
+    for instance, time, count, added_count, removed_count in stream(queryset, chunk_size):
+        yield {
+            'field': label,
+            'instance': instance,
+            'time': to_datetime(time),
+            'count': count,
+            'added_count': added_count,
+            'removed_count': removed_count,
+        }
+
+
+def to_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+def serialize(rows, format, columns):
+    """
+    Iterate lines of rows in format `ndjson` or `csv` with header of columns
+    """
+    if format == 'ndjson':
+        for row in rows:
+            yield json.dumps(dict([(column, to_value(row[column])) for column in columns]), sort_keys=True) + '\n'
+    elif format == 'csv':
+        buffer = StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+
+        def line(values):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(values)
+            return buffer.getvalue()
+
+        yield line(columns)
+        for row in rows:
+            yield line(['' if row[column] is None else to_value(row[column]) for column in columns])
+    else:
+        raise ValueError("Argument format should be one of: %s" % ', '.join(FORMATS))
@@ -1,39 +1,192 @@
-from django.db import models
+from django.db import models, router
+from django.db.models.fields.related import add_lazy_relation
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.utils import six
 
+from .analytics import through_churn, through_tenure
+from .bulk import iter_batches
+from .cache import invalidate_deleted_row, invalidate_saved_row
 from .descriptors import ManyRelatedObjectsHistoryDescriptor, ReverseManyRelatedObjectsHistoryDescriptor
+from .lookups import HistoryForeignKey
+from .summary import delete_related_summaries, rebuild_summaries
+
+try:
+    from django.apps import apps
+    get_models = apps.get_models
+except ImportError:
+    from django.db.models import get_models
+
+__all__ = ['ManyToManyHistoryField', 'get_history_fields']
 
-__all__ = ['ManyToManyHistoryField']
+
+def get_history_fields(labels=None):
+    """
+    Return list of all ManyToManyHistoryField of installed models, optionally filtered by labels
+    'app_label', 'app_label.Model' or 'app_label.Model.field'
+    """
+    fields = []
+    for model in get_models():
+        for field in model._meta.many_to_many:
+            if isinstance(field, ManyToManyHistoryField):
+                names = [model._meta.app_label, model._meta.object_name.lower(), field.name.lower()]
+                if not labels or any([label.lower().split('.') == names[:len(label.split('.'))] for label in labels]):
+                    fields.append(field)
+    return fields
 
 
 class ManyToManyHistoryField(models.ManyToManyField):
 
     def __init__(self, *args, **kwargs):
         self.versions = kwargs.pop('versions', False)
+        # keep versions of items at the reverse side too, see models.save_reverse_versions
+        self.reverse_versions = kwargs.pop('reverse_versions', False)
+        # keep tstzrange column `time_range` in through table (PostgreSQL only), see operations.AddTimeRange
+        self.time_range = kwargs.pop('time_range', False)
+        # make index of open rows unique, see operations.AddHistoryIndexes. On PostgreSQL items are added
+        # by one INSERT ... ON CONFLICT DO NOTHING without reading of current items
+        self.unique_open = kwargs.pop('unique_open', False)
+        # cache current items in cache with alias (or 'default' if True) for timeout, see cache.get_cached_ids
+        self.cache = kwargs.pop('cache', False)
+        self.cache_timeout = kwargs.pop('cache_timeout', None)
+        # cache results of history methods before the last update without timeout, see cache.cached_history
+        self.history_cache = kwargs.pop('history_cache', False)
+        # keep count and times of changes of every instance in one row, see models.ManyToManyHistorySummary
+        self.summary = kwargs.pop('summary', False)
+        # make checkpoint of items every N versions or every timedelta, see models.ManyToManyHistoryCheckpoint
+        self.checkpoints_every = kwargs.pop('checkpoints_every', None)
+        self.checkpoints_interval = kwargs.pop('checkpoints_interval', None)
+        if (self.checkpoints_every or self.checkpoints_interval) and not self.versions:
+            raise ValueError("Checkpoints of ManyToManyHistoryField require argument `versions` to be True")
         super(ManyToManyHistoryField, self).__init__(*args, **kwargs)
 
+    def deconstruct(self):
+        name, path, args, kwargs = super(ManyToManyHistoryField, self).deconstruct()
+        if self.reverse_versions:
+            kwargs['reverse_versions'] = True
+        if self.time_range:
+            kwargs['time_range'] = True
+        if self.unique_open:
+            kwargs['unique_open'] = True
+        if self.cache:
+            kwargs['cache'] = self.cache
+            if self.cache_timeout is not None:
+                kwargs['cache_timeout'] = self.cache_timeout
+        if self.history_cache:
+            kwargs['history_cache'] = self.history_cache
+        if self.summary:
+            kwargs['summary'] = True
+        if self.checkpoints_every or self.checkpoints_interval:
+            # checkpoints can not be declared without versions
+            kwargs['versions'] = True
+            for option in ['checkpoints_every', 'checkpoints_interval']:
+                if getattr(self, option):
+                    kwargs[option] = getattr(self, option)
+        return name, path, args, kwargs
+
     def contribute_to_class(self, cls, name):
         """
         Call super method and remove unique_together, add time fields and change descriptor class
         """
         super(ManyToManyHistoryField, self).contribute_to_class(cls, name)
+        # `rel.field` is not present before Django 1.8, manager needs it to get options of the field
+        self.rel.field = self
 
-        try:
-            self.rel.through._meta.unique_together = ()
-            self.rel.through.add_to_class('time_from', models.DateTimeField(u'Datetime from',
-                                                                            null=True, db_index=True))
-            self.rel.through.add_to_class('time_to',  models.DateTimeField(u'Datetime to', null=True, db_index=True))
-        except AttributeError:
-            pass
+        if isinstance(self.rel.through, six.string_types):
+            # explicit through model, declared by name, is resolved later
+            add_lazy_relation(cls, self, self.rel.through, lambda field, model, cls: field.prepare_through(model))
+        elif self.rel.through is not None:
+            self.prepare_through(self.rel.through)
         # wrong behaviour of south
 #        self.rel.through._meta.auto_created = False
 
         setattr(cls, self.name, ReverseManyRelatedObjectsHistoryDescriptor(self))
 
+    def prepare_through(self, through):
+        """
+        Add time fields to auto created through model and connect receivers of changes of its rows
+        """
+        opts = through._meta
+        # explicit through model should declare time fields and HistoryForeignKey for lookups itself
+        if opts.auto_created:
+            opts.unique_together = ()
+            through.add_to_class('time_from', models.DateTimeField(u'Datetime from', null=True, db_index=True))
+            through.add_to_class('time_to',  models.DateTimeField(u'Datetime to', null=True, db_index=True))
+            # lookups of history, see lookups.HistoryForeignKey
+            for field in opts.local_fields:
+                if isinstance(field, models.ForeignKey):
+                    field.__class__ = HistoryForeignKey
+        if self.cache or self.history_cache:
+            # rows are deleted with related instances and rows of explicit through model are written
+            # by its own manager without signals of the field
+            post_save.connect(invalidate_saved_row, sender=through, weak=False)
+            post_delete.connect(invalidate_deleted_row, sender=through, weak=False)
+
+    def get_history_indexes(self):
+        """
+        Return indexes of the through table, created by operations.AddHistoryIndexes, as list of tuples
+        (suffix, columns, condition, unique). Index with condition is partial and covers only open rows
+        """
+        opts = self.rel.through._meta
+        source = opts.get_field(self.m2m_field_name()).column
+        target = opts.get_field(self.m2m_reverse_field_name()).column
+        indexes = [
+            # current members of the instance and checks of presence before adding and removing
+            ('_open', [source, target], 'time_to IS NULL', self.unique_open),
+            # temporal queries of the instance
+            ('_history', [source, 'time_from', 'time_to'], None, False),
+        ]
+        if self.reverse_versions:
+            # temporal queries and versions of items
+            indexes.append(('_reverse_history', [target, 'time_from', 'time_to'], None, False))
+        return indexes
+
+    def compact(self, before, granularity=None, expire=None, batch_size=100):
+        """
+        Compact history of all instances by batches, history of every instance in own transaction.
+        See compaction.compact(). Return dictionary with total numbers of changes
+        """
+        result = {'expired': 0, 'merged': 0, 'joined': 0}
+        for batch in iter_batches(self.rel.through._default_manager.all(), self.m2m_field_name(), batch_size):
+            for instance in self.model._default_manager.filter(pk__in=batch):
+                for key, value in getattr(instance, self.name).compact(before, granularity, expire).items():
+                    result[key] += value
+        return result
+
+    def churn(self, period, time_from=None, time_to=None):
+        """
+        Return numbers of added and removed items of all instances per period from the through table,
+        see analytics.through_churn()
+        """
+        return through_churn(self, period, time_from=time_from, time_to=time_to,
+                             using=router.db_for_read(self.rel.through))
+
+    def tenure(self, group_by=None, now=None, percentiles=(), min_duration=None):
+        """
+        Return aggregates of durations of intervals of all instances in seconds, grouped by 'source' or 'target',
+        see analytics.through_tenure()
+        """
+        return through_tenure(self, group_by=group_by, now=now, percentiles=percentiles, min_duration=min_duration,
+                              using=router.db_for_read(self.rel.through))
+
+    def rebuild_summaries(self, batch_size=1000):
+        """
+        Make summaries of all instances again, see summary.rebuild_summaries(). Return number of summaries
+        """
+        return rebuild_summaries(self, batch_size=batch_size)
+
+    def delete_related_summaries(self, sender, instance, **kwargs):
+        """
+        Receiver of `pre_delete` signal of related model, see summary.delete_related_summaries()
+        """
+        delete_related_summaries(self, instance)
+
     def contribute_to_related_class(self, cls, related):
         """
         Change descriptor class
         """
         super(ManyToManyHistoryField, self).contribute_to_related_class(cls, related)
+        if self.summary:
+            pre_delete.connect(self.delete_related_summaries, sender=cls, weak=False)
 
         # `swapped` attribute is not present before Django 1.5
         if not self.rel.is_hidden() and not getattr(related.model._meta, 'swapped', None):
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in instrumentation of hot paths of managers of ManyToManyHistoryField: writes (add, remove, clear, set, sync),
+temporal reads and writes of versions. It's disabled until a collector is enabled, then every operation makes
+a record with model, field name, method, number of changed or read rows, number of queries, SQL and Python time.
+Records are passed to enabled collectors and sent by `m2m_history_instrumented` signal:
+
+    >>> with instrument() as collector:
+    ...     article.publications.add(publication)
+    >>> collector.stats()
+    [{'model': 'test_app.Article', 'field_name': 'publications', 'method': 'add', 'calls': 1, ...}]
+
+Querysets of temporal reads are lazy, so their records are made on the first evaluation of the returned queryset
+with queries of both preparing (cache, checkpoints) and evaluation. Queries by COPY are counted too
+"""
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from timeit import default_timer
+
+from django.conf import settings
+from django.db import connections
+from django.db.models.query import QuerySet
+
+from .signals import m2m_history_instrumented
+
+__all__ = ['AggregatingCollector', 'enable', 'disable', 'instrument', 'instrumented', 'record_rows']
+
+collectors = []
+
+# stack of active records of the current thread, nested operations count queries and rows of outer ones too
+local = threading.local()
+
+
+class AggregatingCollector(object):
+    """
+    In-memory collector, which sums records by model, field name and method
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.aggregates = {}
+
+    def __call__(self, record):
+        key = (record['model'], record['field_name'], record['method'])
+        time = record['sql_time'] + record['python_time']
+        with self.lock:
+            aggregate = self.aggregates.setdefault(key, {
+                'calls': 0, 'rows': 0, 'queries': 0, 'sql_time': 0., 'python_time': 0., 'max_time': 0.})
+            aggregate['calls'] += 1
+            aggregate['rows'] += record['rows'] or 0
+            aggregate['queries'] += record['queries']
+            aggregate['sql_time'] += record['sql_time']
+            aggregate['python_time'] += record['python_time']
+            aggregate['max_time'] = max(aggregate['max_time'], time)
+
+    def stats(self):
+        """
+        Return list of aggregates, the slowest methods first
+        """
+        with self.lock:
+            stats = [dict(aggregate, model='%s.%s' % (model._meta.app_label, model._meta.object_name),
+                          field_name=field_name, method=method)
+                     for (model, field_name, method), aggregate in self.aggregates.items()]
+        return sorted(stats, key=lambda stat: stat['sql_time'] + stat['python_time'], reverse=True)
+
+
+def enable(collector=None):
+    """
+    Enable instrumentation with collector, callable with record argument, in-memory aggregating one by default.
+    Return the collector
+    """
+    if collector is None:
+        collector = AggregatingCollector()
+    collectors.append(collector)
+    return collector
+
+
+def disable(collector=None):
+    """
+    Disable the collector or all of them. Instrumentation stops without enabled collectors
+    """
+    if collector is None:
+        del collectors[:]
+    elif collector in collectors:
+        collectors.remove(collector)
+
+
+@contextmanager
+def instrument(collector=None):
+    collector = enable(collector)
+    try:
+        yield collector
+    finally:
+        disable(collector)
+
+
+def record_rows(count):
+    """
+    Add number of changed rows to active records of the current thread
+    """
+    for record in getattr(local, 'records', []):
+        record['rows'] = (record['rows'] or 0) + count
+
+
+def get_queries_log(connection):
+    # Django < 1.8 keeps list of queries
+    return connection.queries_log if hasattr(connection, 'queries_log') else connection.queries
+
+
+def queries_logged(connection):
+    if hasattr(connection, 'queries_logged'):
+        return connection.queries_logged
+    return connection.use_debug_cursor or (connection.use_debug_cursor is None and settings.DEBUG)
+
+
+@contextmanager
+def debug_cursor(connection):
+    """
+    Log queries of the connection regardless of DEBUG setting
+    """
+    name = 'force_debug_cursor' if hasattr(connection, 'force_debug_cursor') else 'use_debug_cursor'
+    value = getattr(connection, name)
+    setattr(connection, name, True)
+    try:
+        yield
+    finally:
+        setattr(connection, name, value)
+
+
+def describe_manager(manager, *args, **kwargs):
+    return manager.instance.__class__, manager.prefetch_cache_name, manager.db
+
+
+def send(record):
+    for collector in list(collectors):
+        collector(record)
+    m2m_history_instrumented.send(sender=record['model'], record=record)
+
+
+def measure(record, function, *args, **kwargs):
+    """
+    Call function and add its queries, SQL and Python time to the record. Queries, logged only for the record,
+    are removed from the log after, it isn't limited on Django < 1.8
+    """
+    connection = connections[record['using']]
+    logged = queries_logged(connection)
+    queries_log = get_queries_log(connection)
+    last_query = queries_log[-1] if queries_log else None
+    started = default_timer()
+    with debug_cursor(connection):
+        result = function(*args, **kwargs)
+    time = default_timer() - started
+
+    queries = []
+    queries_log = get_queries_log(connection)
+    for query in reversed(queries_log):
+        if query is last_query:
+            break
+        queries.append(query)
+    if not logged:
+        for query in queries:
+            queries_log.pop()
+    sql_time = min(sum([float(query['time']) for query in queries]), time)
+    record['queries'] += len(queries)
+    record['sql_time'] += sql_time
+    record['python_time'] += time - sql_time
+    return result
+
+
+def measure_evaluation(queryset, record):
+    """
+    Make record of lazy queryset on its first evaluation: iteration, count() or exists().
+    Methods are replaced only in the instance and restored before the call, so evaluated queryset is usual one
+    """
+    names = ['iterator', 'count', 'exists']
+
+    def hook(name):
+        method = getattr(queryset, name)
+
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            for hooked_name in names:
+                queryset.__dict__.pop(hooked_name, None)
+            if name == 'iterator':
+                result = measure(record, lambda: list(method(*args, **kwargs)))
+                record['rows'] = len(result)
+                result = iter(result)
+            else:
+                result = measure(record, method, *args, **kwargs)
+                if name == 'count':
+                    record['rows'] = result
+            send(record)
+            return result
+        return wrapper
+
+    for name in names:
+        queryset.__dict__[name] = hook(name)
+
+
+def instrumented(method_name=None, describe=describe_manager):
+    """
+    Decorator of operation, which makes record of it if instrumentation is enabled. `describe` returns tuple
+    (model, field name, database alias) by arguments of the operation, manager is the first one by default.
+    If operation returns lazy queryset, the record is made, when the queryset is evaluated
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            if not collectors:
+                return method(*args, **kwargs)
+
+            model, field_name, using = describe(*args, **kwargs)
+            record = {
+                'model': model,
+                'field_name': field_name,
+                'method': method_name or method.__name__,
+                'rows': None,
+                'using': using,
+                'queries': 0,
+                'sql_time': 0.,
+                'python_time': 0.,
+            }
+            records = local.__dict__.setdefault('records', [])
+            records.append(record)
+            try:
+                result = measure(record, method, *args, **kwargs)
+            finally:
+                records.pop()
+
+            if isinstance(result, QuerySet) and result._result_cache is None:
+                measure_evaluation(result, record)
+                return result
+            # evaluated queryset or collection of primary keys
+            items = getattr(result, '_result_cache', result)
+            if record['rows'] is None and isinstance(items, (list, set, frozenset, tuple)):
+                record['rows'] = len(items)
+            send(record)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Lookups of instances by history of ManyToManyHistoryField. Conditions are compiled over rows of the through table,
+joined by filter of the relation, so the whole filtering is done by one query:
+
+    Article.objects.filter(publications__at=(time, publication)).distinct()
+    Article.objects.filter(publications__added_between=(time_from, time_to)).distinct()
+    Article.objects.filter(publications__count_at=(time, 2)).distinct()
+    Publication.objects.filter(article__at=(time, article)).distinct()
+"""
+from django.db.models import ForeignKey, Model
+from django.db.models.sql.where import AND
+
+__all__ = ['HistoryForeignKey', 'LOOKUPS']
+
+
+class HistoryLookup(object):
+    """
+    Condition over rows of the through table with alias. `field` is foreign key of the through table
+    to the model at the end of the relation (item), `owner_field` - foreign key to the filtered model
+    """
+    contains_aggregate = False
+
+    def __init__(self, alias, field, value):
+        self.alias = alias
+        self.field = field
+        self.value = value
+
+    @property
+    def owner_field(self):
+        return [field for field in self.field.model._meta.local_fields
+                if isinstance(field, ForeignKey) and field is not self.field][0]
+
+    def relabeled_clone(self, change_map):
+        return self.__class__(change_map.get(self.alias, self.alias), self.field, self.value)
+
+    def get_group_by_cols(self):
+        return []
+
+    def get_time_params(self, times, connection):
+        time_field = self.field.model._meta.get_field('time_from')
+        return [time_field.get_db_prep_value(time, connection) for time in times]
+
+    def get_item_param(self, item, connection):
+        if isinstance(item, Model):
+            item = item.pk
+        return self.field.rel.get_related_field().get_db_prep_value(item, connection)
+
+    def at_sql(self, table):
+        # row is open at the time, the same conditions as `were_at()` of manager
+        return '(%(table)s.time_from IS NULL OR %(table)s.time_from <= %%s) ' \
+               'AND (%(table)s.time_to IS NULL OR %(table)s.time_to > %%s)' % {'table': table}
+
+    def as_sql(self, compiler, connection):
+        raise NotImplementedError
+
+
+class AtLookup(HistoryLookup):
+    """
+    Item was in the relation at the time, value is tuple (time, item)
+    """
+    def as_sql(self, compiler, connection):
+        time, item = self.value
+        table = compiler.quote_name_unless_alias(self.alias)
+        sql = '%s.%s = %%s AND %s' % (table, connection.ops.quote_name(self.field.column), self.at_sql(table))
+        return sql, [self.get_item_param(item, connection)] + self.get_time_params([time, time], connection)
+
+
+class AddedBetweenLookup(HistoryLookup):
+    """
+    Any item was added between times, value is tuple (time_from, time_to)
+    """
+    column = 'time_from'
+
+    def as_sql(self, compiler, connection):
+        table = compiler.quote_name_unless_alias(self.alias)
+        sql = '%s.%s >= %%s AND %s.%s <= %%s' % (table, self.column, table, self.column)
+        return sql, self.get_time_params(self.value, connection)
+
+
+class RemovedBetweenLookup(AddedBetweenLookup):
+    """
+    Any item was removed between times, value is tuple (time_from, time_to)
+    """
+    column = 'time_to'
+
+
+class CountAtLookup(HistoryLookup):
+    """
+    Number of items in the relation at the time, value is tuple (time, count).
+    Only instances with any rows in the through table are joined, so zero count matches only them
+    """
+    def as_sql(self, compiler, connection):
+        time, count = self.value
+        qn = connection.ops.quote_name
+        params = {
+            'through': qn(self.field.model._meta.db_table),
+            'counted': qn('m2m_history_counted'),
+            'table': compiler.quote_name_unless_alias(self.alias),
+            'item': qn(self.field.column),
+            'owner': qn(self.owner_field.column),
+        }
+        sql = '''(SELECT COUNT(DISTINCT %(counted)s.%(item)s) FROM %(through)s %(counted)s
+            WHERE %(counted)s.%(owner)s = %(table)s.%(owner)s AND ''' % params
+        sql += self.at_sql(params['counted']) + ') = %s'
+        return sql, self.get_time_params([time, time], connection) + [count]
+
+
+LOOKUPS = {
+    'at': AtLookup,
+    'added_between': AddedBetweenLookup,
+    'removed_between': RemovedBetweenLookup,
+    'count_at': CountAtLookup,
+}
+
+
+class HistoryForeignKey(ForeignKey):
+    """
+    Foreign key of the through table of ManyToManyHistoryField. Filters of relation end by the last foreign key
+    of the path, so lookups of history are compiled here
+    """
+    def get_lookup_constraint(self, constraint_class, alias, targets, sources, lookups, raw_value):
+        if len(lookups) == 1 and lookups[0] in LOOKUPS:
+            root_constraint = constraint_class()
+            root_constraint.add(LOOKUPS[lookups[0]](alias, self, raw_value), AND)
+            return root_constraint
+        return super(HistoryForeignKey, self).get_lookup_constraint(constraint_class, alias, targets, sources,
+                                                                    lookups, raw_value)
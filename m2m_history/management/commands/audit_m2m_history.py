@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from m2m_history.audit import audit
+from m2m_history.fields import get_history_fields
+
+
+class Command(BaseCommand):
+    args = '[app_label[.Model[.field]] ...]'
+    help = 'Audit through tables and versions of ManyToManyHistoryFields: open and closed rows, the largest ' \
+           'histories, duplicate open rows, versions and indexes of temporal queries'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Number of instances in one batch, 1000 by default'),
+        make_option('--sample', type='float', dest='sample', default=1.,
+                    help='Part of batches to examine, all of them by default'),
+        make_option('--seed', type='int', dest='seed', help='Seed of random sampling of batches'),
+        make_option('--top', type='int', dest='top', default=10,
+                    help='Number of the largest histories, 10 by default'),
+        make_option('--no-explain', action='store_false', dest='explain', default=True,
+                    help='Do not EXPLAIN temporal queries'),
+        make_option('--json', action='store_true', dest='json', default=False, help='Output results as JSON'),
+    )
+
+    def handle(self, *labels, **options):
+        fields = get_history_fields(labels)
+        if not fields:
+            raise CommandError("There are no ManyToManyHistoryFields for labels: %s" % ', '.join(labels))
+        if not 0 < options['sample'] <= 1:
+            raise CommandError("Option sample should be more than 0 and not more than 1")
+
+        results = {}
+        for field in fields:
+            label = '%s.%s.%s' % (field.model._meta.app_label, field.model._meta.object_name, field.name)
+            result = audit(field, batch_size=options['batch_size'], sample=options['sample'], seed=options['seed'],
+                           top=options['top'], explain_queries=options['explain'])
+            results[label] = result
+            if not options['json']:
+                self.write_result(label, result)
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True, default=str))
+
+    def write_result(self, label, result):
+        ratio = result['closed_to_open_ratio']
+        self.stdout.write('%s: %d of %d instances sampled, %d with history' % (
+            label, result['sampled_instances'], result['instances'], result['instances_with_history']))
+        self.stdout.write('  rows: %d (~%d total), open: %d (~%d total), closed to open ratio: %s' % (
+            result['rows'], result['estimated_rows'], result['open_rows'], result['estimated_open_rows'],
+            'n/a' if ratio is None else '%.2f' % ratio))
+        self.stdout.write('  duplicate open pairs: %d (~%d total)' % (
+            result['duplicate_open_pairs'], result['estimated_duplicate_open_pairs']))
+        self.stdout.write('  versions: %d (~%d total), max per instance: %d' % (
+            result['versions'], result['estimated_versions'], result['max_versions']))
+        self.stdout.write('  largest histories: %s' % ', '.join(
+            ['%s (%d rows)' % (history['id'], history['rows']) for history in result['largest_histories']]))
+        for name, explained in sorted(result['explain'].items()):
+            status = {True: 'uses index', False: 'NO INDEX', None: 'not supported'}[explained['index']]
+            self.stdout.write('  %s: %s' % (name, status))
+            for line in explained['plan']:
+                self.stdout.write('    %s' % line)
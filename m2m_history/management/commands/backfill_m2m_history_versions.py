@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from m2m_history.backfill import backfill_versions
+from m2m_history.fields import get_history_fields
+
+
+class Command(BaseCommand):
+    args = '[app_label[.Model[.field]] ...]'
+    help = 'Backfill versions of ManyToManyHistoryFields with argument `versions` from through tables'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=10000,
+                    help='Number of instances in one range, 10000 by default'),
+        make_option('--processes', type='int', dest='processes', default=1,
+                    help='Number of processes of pool, 1 by default'),
+    )
+
+    def handle(self, *labels, **options):
+        fields = [field for field in get_history_fields(labels) if field.versions]
+        if not fields:
+            raise CommandError("There are no ManyToManyHistoryFields with versions for labels: %s" % ', '.join(labels))
+
+        for field in fields:
+            count = backfill_versions(field, batch_size=options['batch_size'], processes=options['processes'])
+            self.stdout.write('%s.%s.%s: %d versions' % (
+                field.model._meta.app_label, field.model._meta.object_name, field.name, count))
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from m2m_history.compaction import GRANULARITIES
+from m2m_history.fields import get_history_fields
+
+
+class Command(BaseCommand):
+    args = '[app_label[.Model[.field]] ...]'
+    help = 'Compact history of ManyToManyHistoryFields: merge old versions, drop expired and join adjacent intervals'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=30,
+                    help='Compact history older than number of days, 30 by default'),
+        make_option('--granularity', dest='granularity', choices=sorted(GRANULARITIES),
+                    help='Merge old versions into one per period: %s' % ', '.join(sorted(GRANULARITIES))),
+        make_option('--expire-days', type='int', dest='expire_days',
+                    help='Drop intervals of items closed earlier than number of days'),
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+                    help='Number of instances in one batch, 100 by default'),
+    )
+
+    def handle(self, *labels, **options):
+        fields = get_history_fields(labels)
+        if not fields:
+            raise CommandError("There are no ManyToManyHistoryFields for labels: %s" % ', '.join(labels))
+
+        now = timezone.now()
+        before = now - timedelta(days=options['days'])
+        expire = now - timedelta(days=options['expire_days']) if options.get('expire_days') else None
+
+        for field in fields:
+            result = field.compact(before, granularity=options.get('granularity'), expire=expire,
+                                   batch_size=options['batch_size'])
+            self.stdout.write('%s.%s.%s: %d expired intervals, %d merged versions, %d joined intervals' % (
+                field.model._meta.app_label, field.model._meta.object_name, field.name,
+                result['expired'], result['merged'], result['joined']))
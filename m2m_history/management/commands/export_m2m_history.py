@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import six, timezone
+from django.utils.dateparse import parse_datetime
+
+from m2m_history.export import FORMATS, THROUGH_COLUMNS, VERSION_COLUMNS, iter_through_rows, iter_version_rows, \
+    serialize
+from m2m_history.fields import get_history_fields
+
+
+class Command(BaseCommand):
+    args = '[app_label[.Model[.field]] ...]'
+    help = 'Export history of ManyToManyHistoryFields: rows of through tables or versions as NDJSON or CSV'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', choices=FORMATS, default='ndjson',
+                    help='Format of output: %s, ndjson by default' % ', '.join(FORMATS)),
+        make_option('--versions', action='store_true', dest='versions', default=False,
+                    help='Export versions instead of rows of through tables'),
+        make_option('--output', dest='output', help='File for output, stdout by default'),
+        make_option('--gzip', action='store_true', dest='gzip', default=False, help='Compress file by gzip'),
+        make_option('--instances', dest='instances', help='Comma separated primary keys of instances'),
+        make_option('--time-from', dest='time_from', help='Start of time window in ISO format'),
+        make_option('--time-to', dest='time_to', help='End of time window in ISO format'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=2000,
+                    help='Number of rows fetched from cursor at once, 2000 by default'),
+    )
+
+    def parse_time(self, value):
+        if value is None:
+            return None
+        time = parse_datetime(value)
+        if time is None:
+            raise CommandError("Time %s is not in ISO format" % value)
+        if settings.USE_TZ and timezone.is_naive(time):
+            time = timezone.make_aware(time, timezone.get_current_timezone())
+        return time
+
+    def handle(self, *labels, **options):
+        fields = get_history_fields(labels)
+        if options['versions']:
+            fields = [field for field in fields if field.versions]
+        if not fields:
+            raise CommandError("There are no ManyToManyHistoryFields for labels: %s" % ', '.join(labels))
+        if options['gzip'] and not options.get('output'):
+            raise CommandError("Option gzip requires option output")
+
+        iterate, columns = (iter_version_rows, VERSION_COLUMNS) if options['versions'] \
+            else (iter_through_rows, THROUGH_COLUMNS)
+        kwargs = {
+            'instances': options['instances'].split(',') if options.get('instances') else None,
+            'time_from': self.parse_time(options.get('time_from')),
+            'time_to': self.parse_time(options.get('time_to')),
+            'chunk_size': options['chunk_size'],
+        }
+
+        def rows():
+            for field in fields:
+                for row in iterate(field, **kwargs):
+                    yield row
+
+        lines = serialize(rows(), options['format'], columns)
+        if not options.get('output'):
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+
+        if options['gzip']:
+            output = io.TextIOWrapper(gzip.GzipFile(options['output'], 'wb'), encoding='utf-8')
+        else:
+            output = io.open(options['output'], 'w', encoding='utf-8')
+        with output:
+            for line in lines:
+                output.write(six.text_type(line))
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from m2m_history.fields import get_history_fields
+
+
+class Command(BaseCommand):
+    args = '[app_label[.Model[.field]] ...]'
+    help = 'Rebuild summaries of ManyToManyHistoryFields with argument `summary` from through tables and versions'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Number of instances in one batch, 1000 by default'),
+    )
+
+    def handle(self, *labels, **options):
+        fields = [field for field in get_history_fields(labels) if field.summary]
+        if not fields:
+            raise CommandError("There are no ManyToManyHistoryFields with summary for labels: %s" % ', '.join(labels))
+
+        for field in fields:
+            count = field.rebuild_summaries(batch_size=options['batch_size'])
+            self.stdout.write('%s.%s.%s: %d summaries' % (
+                field.model._meta.app_label, field.model._meta.object_name, field.name, count))
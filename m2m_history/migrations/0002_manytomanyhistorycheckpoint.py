@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('m2m_history', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ManyToManyHistoryCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('object_id', models.BigIntegerField(db_index=True)),
+                ('field_name', models.CharField(max_length=50, db_index=True)),
+                ('time', models.DateTimeField(db_index=True)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('data', models.BinaryField()),
+                ('content_type', models.ForeignKey(related_name='m2m_history_checkpoints', to='contenttypes.ContentType')),
+            ],
+            options={
+                'get_latest_by': 'time',
+            },
+        ),
+        migrations.AlterModelOptions(
+            name='manytomanyhistoryversion',
+            options={'get_latest_by': 'time'},
+        ),
+        migrations.AlterUniqueTogether(
+            name='manytomanyhistorycheckpoint',
+            unique_together=set([('content_type', 'object_id', 'field_name', 'time')]),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('m2m_history', '0002_manytomanyhistorycheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ManyToManyHistorySummary',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('object_id', models.BigIntegerField()),
+                ('field_name', models.CharField(max_length=50)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('versions_count', models.PositiveIntegerField(default=0)),
+                ('first_time', models.DateTimeField(null=True)),
+                ('last_update_time', models.DateTimeField(null=True)),
+                ('content_type', models.ForeignKey(related_name='m2m_history_summaries', to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='manytomanyhistorysummary',
+            unique_together=set([('content_type', 'object_id', 'field_name')]),
+        ),
+    ]
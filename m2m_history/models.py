@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
+import zlib
+
 from django.contrib.contenttypes.models import ContentType
-from django.db import models, connection
+from django.db import models, connections, router
+from django.db.models import Count, Min, Sum
+from django.db.models.query import QuerySet
 from django.dispatch import receiver
 
+from .analytics import get_period_sql, to_period
+from .bulk import atomic, temporary_table, to_datetime
+from .cache import get_accessor_name, get_other_side, get_through_field, invalidate_manager_history
+from .instrumentation import instrumented
 from .signals import m2m_history_changed
 
 try:
@@ -10,10 +18,95 @@ try:
 except ImportError:
     from django.contrib.contenttypes.generic import GenericForeignKey
 
-try:
-    from django.db.transaction import atomic
-except ImportError:
-    from django.db.transaction import commit_on_success as atomic
+
+def supports_window_functions(connection):
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 25)
+    elif connection.vendor == 'mysql':
+        return connection.mysql_version >= (8, 0)
+    return connection.vendor in ['postgresql', 'oracle']
+
+
+def describe_version(version, *args, **kwargs):
+    return ContentType.objects.get_for_id(version.content_type_id).model_class(), version.field_name, \
+        version._state.db or router.db_for_write(ManyToManyHistoryVersion)
+
+
+def describe_new_version(instance, field_name, *args):
+    return instance.__class__, field_name, router.db_for_write(ManyToManyHistoryVersion)
+
+
+class ManyToManyHistoryVersionQuerySet(QuerySet):
+
+    # fields of neighbor versions, attached by `with_neighbors` as `neighbor_prev_id`, `neighbor_next_time`, etc.
+    neighbor_fields = ['id', 'time', 'count', 'added_count', 'removed_count']
+
+    def delete(self):
+        """
+        Delete versions by the fixed number of set-based queries for every field, changes of items of every version
+        are moved to the next kept version. Neighbors, attached by `with_neighbors`, are not used
+        """
+        from .deletion import delete_versions
+        delete_versions(self)
+
+    def with_neighbors(self):
+        """
+        Attach fields of previous and next versions of the same field of the instance to every version by one query
+        and prefetch instances, so `neighbor_prev`, `neighbor_next` and `m2m` of versions don't make queries.
+        Neighbors are found by LAG and LEAD window functions among versions of the queryset (slicing is applied after
+        them), or by subqueries among all versions on backends without window functions. They are only for display,
+        `prev`, `next` and deleting of versions always read actual neighbors
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        partition = ', '.join(['%s.%s' % (table, qn(column))
+                               for column in ['content_type_id', 'object_id', 'field_name']])
+        select = {}
+        for name in self.neighbor_fields:
+            column = '%s.%s' % (table, qn(name))
+            for neighbor, function, operator, order in [('prev', 'LAG', '<', 'DESC'), ('next', 'LEAD', '>', 'ASC')]:
+                if supports_window_functions(connection):
+                    sql = '%s(%s) OVER (PARTITION BY %s ORDER BY %s.%s)' % (
+                        function, column, partition, table, qn('time'))
+                else:
+                    sql = '''(SELECT neighbor.%(name)s FROM %(table)s neighbor
+                        WHERE neighbor.content_type_id = %(table)s.content_type_id
+                            AND neighbor.object_id = %(table)s.object_id AND neighbor.field_name = %(table)s.field_name
+                            AND neighbor.time %(operator)s %(table)s.time
+                        ORDER BY neighbor.time %(order)s LIMIT 1)''' % {
+                        'name': qn(name), 'table': table, 'operator': operator, 'order': order}
+                select['neighbor_%s_%s' % (neighbor, name)] = sql
+        return self.extra(select=select).prefetch_related('object')
+
+    def churn(self, period, group_by=()):
+        """
+        Return list of dictionaries with start of period and totals of added and removed items of versions
+        per period: 'minute', 'hour', 'day', 'month' or 'year', optionally grouped by 'content_type' (id)
+        and 'field_name' too. Computed by one aggregate query
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        sql, params = get_period_sql(connection, period, '%s.%s' % (qn(self.model._meta.db_table), qn('time')))
+        group_by = ['content_type_id' if name == 'content_type' else name for name in group_by]
+        qs = self.extra(select={'period': sql}, select_params=params).values('period', *group_by) \
+            .annotate(added=Sum('added_count'), removed=Sum('removed_count')).order_by('period', *group_by)
+        return [dict(values, period=to_period(values['period'])) for values in qs]
+
+
+class ManyToManyHistoryVersionManager(models.Manager):
+
+    def get_queryset(self):
+        return ManyToManyHistoryVersionQuerySet(self.model, using=self._db)
+
+    # compatibility with Django 1.5
+    get_query_set = get_queryset
+
+    def with_neighbors(self):
+        return self.get_queryset().with_neighbors()
+
+    def churn(self, period, group_by=()):
+        return self.get_queryset().churn(period, group_by=group_by)
 
 
 class ManyToManyHistoryVersion(models.Model):
@@ -32,6 +125,8 @@ class ManyToManyHistoryVersion(models.Model):
     added_count = models.PositiveIntegerField(default=0)
     removed_count = models.PositiveIntegerField(default=0)
 
+    objects = ManyToManyHistoryVersionManager()
+
     @property
     def m2m(self):
         return getattr(self.object, self.field_name)
@@ -50,6 +145,35 @@ class ManyToManyHistoryVersion(models.Model):
         except IndexError:
             return None
 
+    @property
+    def neighbor_prev(self):
+        return self.get_neighbor('prev')
+
+    @property
+    def neighbor_next(self):
+        return self.get_neighbor('next')
+
+    def get_neighbor(self, neighbor):
+        """
+        Return unsaved previous or next version for display from fields, attached by `with_neighbors()` of queryset
+        """
+        if not hasattr(self, 'neighbor_%s_id' % neighbor):
+            raise AttributeError("Neighbors of version are attached by `with_neighbors()` of queryset")
+        if getattr(self, 'neighbor_%s_id' % neighbor) is None:
+            return None
+        version = ManyToManyHistoryVersion(content_type_id=self.content_type_id, object_id=self.object_id,
+                                           field_name=self.field_name)
+        for name in ManyToManyHistoryVersionQuerySet.neighbor_fields:
+            value = getattr(self, 'neighbor_%s_%s' % (neighbor, name))
+            if name == 'time':
+                # values of extra select are not converted by backend
+                value = to_datetime(value)
+            setattr(version, name, value)
+        cache_attr = ManyToManyHistoryVersion.object.cache_attr
+        if hasattr(self, cache_attr):
+            setattr(version, cache_attr, getattr(self, cache_attr))
+        return version
+
     def items(self, **kwargs):
         return self.m2m.were_at(self.time, **kwargs)
 
@@ -59,13 +183,30 @@ class ManyToManyHistoryVersion(models.Model):
     def removed(self, **kwargs):
         return self.m2m.removed_at(self.time, **kwargs)
 
+    @instrumented('version.delete', describe_version)
     @atomic
     def delete(self, *args, **kwargs):
-        self.delete_version_items()
+        # cached history of the instance and of items, changed in this version, is not valid anymore
+        invalidate_manager_history(self.m2m, self.m2m.queryset_through.filter(
+            models.Q(time_from=self.time) | models.Q(time_to=self.time)))
+        # checkpoints after this version are not valid anymore
+        self.m2m.checkpoints.filter(time__gte=self.time).delete()
+        # version is deleted before its items, so summaries, refreshed with them, don't count it
         super(ManyToManyHistoryVersion, self).delete(*args, **kwargs)
+        self.delete_version_items()
 
     def delete_version_items(self):
-        qs = self.m2m.queryset_through
+        from .summary import refresh_summaries
+        m2m = self.m2m
+        qs = m2m.queryset_through
+        field = get_through_field(m2m.through)
+        # summaries of instances with changed rows: of the instance or of its items at the reverse side
+        if m2m.has_summary:
+            summary_ids = [m2m._fk_val]
+        elif field.summary:
+            summary_ids = list(qs.values_list(m2m.target_field_name, flat=True).distinct())
+        else:
+            summary_ids = []
 
         next = self.next
         prev = self.prev
@@ -81,85 +222,260 @@ class ManyToManyHistoryVersion(models.Model):
             qs.filter(time_to=self.time).update(time_to=None)
         elif next and prev:
             # it's version in the middle
+            self.merge_items_into(next)
+        refresh_summaries(field, summary_ids, using=m2m.db)
+
+    def merge_items_into(self, next):
+        """
+        Move changes of items of this version to the next version by set-based queries of all backends.
+        Membership of the next version never leaves the database
+        """
+        m2m = self.m2m
+        qs = m2m.queryset_through
+        connection = connections[m2m.db]
+        qn = connection.ops.quote_name
+        opts = m2m.through._meta
+        time_field = opts.get_field('time_to')
+        params = {
+            'through': qn(opts.db_table),
+            'source': qn(opts.get_field(m2m.source_field_name).column),
+            'target': qn(opts.get_field(m2m.target_field_name).column),
+        }
+        object_id = m2m._fk_val
+        time = time_field.get_db_prep_value(self.time, connection)
+        next_time = time_field.get_db_prep_value(next.time, connection)
+
+        # all, who left now -> left in the next version or, if they entered in the next version, join both
+        # intervals of the item. New ends of intervals and rows of the next version, which are joined, are copied
+        # to temporary table, because MySQL can not select from the table in subquery of UPDATE and DELETE
+        # of the same table and can not refer to temporary table twice in one query
+        id_type = models.BigIntegerField().db_type(connection)
+        with temporary_table(connection, [('id', id_type), ('time_to', time_field.db_type(connection)),
+                                          ('reopened_id', id_type)]) as table:
+            params['merged'] = qn(table)
+            params['pk'] = qn(opts.pk.column)
             cursor = connection.cursor()
+            cursor.execute('''INSERT INTO %(merged)s (id, time_to, reopened_id)
+                SELECT closed.%(pk)s, CASE WHEN reopened.%(pk)s IS NULL THEN %%s ELSE reopened.time_to END,
+                    reopened.%(pk)s
+                FROM %(through)s closed LEFT JOIN %(through)s reopened ON reopened.%(source)s = closed.%(source)s
+                    AND reopened.%(target)s = closed.%(target)s AND reopened.time_from = %%s
+                WHERE closed.%(source)s = %%s AND closed.time_to = %%s''' % params,
+                           [next_time, next_time, object_id, time])
+            cursor.execute('''DELETE FROM %(through)s WHERE %(pk)s IN (
+                SELECT %(merged)s.reopened_id FROM %(merged)s)''' % params)
+            cursor.execute('''UPDATE %(through)s SET time_to = (
+                    SELECT %(merged)s.time_to FROM %(merged)s WHERE %(merged)s.id = %(through)s.%(pk)s)
+                WHERE %(source)s = %%s AND time_to = %%s''' % params, [object_id, time])
+
+        # all, who entered here and not exist in the next -> delete
+        qs.filter(time_from=self.time, time_to__lte=next.time).delete()
+        # all, who entered here and exist in the next -> entered in the next
+        qs.filter(time_from=self.time).update(time_from=next.time)
 
-            # all, who left now and exist in next version -> set right time_to value, which get from last part:
-            # 1. make temporary table, because of partial indexes cannot let do all operations in current table
-            # 2. remove second part of members, who left in first part
-            # 3. update time_to of first part of members using temp table
-            # 4. drop temp table
-            sql = '''
-                CREATE TEMPORARY TABLE m2m_history_items_temp AS
-                    SELECT second.%(m2m_object_name)s, second.%(m2m_item_name)s, second.time_from, second.time_to
-                    FROM %(m2m_table_name)s AS second
-                    WHERE (second.time_from = %(next_time_from)s
-                        AND second.%(m2m_object_name)s = %(object_id)s
-                        AND second.%(m2m_item_name)s IN (
-                            SELECT first.%(m2m_item_name)s FROM %(m2m_table_name)s AS first
-                                WHERE (first.%(m2m_object_name)s = second.%(m2m_object_name)s
-                                    AND first.time_to = %(time_to)s
-                                    AND first.%(m2m_item_name)s IN %(items)s)));
-
-                DELETE FROM %(m2m_table_name)s AS second WHERE (second.time_from = %(next_time_from)s
-                    AND second.%(m2m_object_name)s = %(object_id)s
-                    AND second.%(m2m_item_name)s IN (
-                        SELECT first.%(m2m_item_name)s FROM %(m2m_table_name)s AS first
-                            WHERE (first.%(m2m_object_name)s = second.%(m2m_object_name)s
-                                AND first.time_to = %(time_to)s
-                                AND first.%(m2m_item_name)s IN %(items)s)));
-
-                UPDATE %(m2m_table_name)s AS first
-                    SET time_to = second.time_to
-                    FROM "m2m_history_items_temp" AS second
-                    WHERE first.%(m2m_object_name)s = %(object_id)s
-                      AND first.time_to = %(time_to)s
-                      AND first.%(m2m_item_name)s IN %(items)s
-                      AND first.%(m2m_item_name)s = second.%(m2m_item_name)s
-                      AND second.%(m2m_object_name)s = first.%(m2m_object_name)s
-                      AND second.time_from = %(next_time_from)s;
-
-                DROP TABLE m2m_history_items_temp;
-                '''.replace('%(m2m_table_name)s', self.m2m.through._meta.db_table) \
-                .replace('%(m2m_object_name)s', self.m2m.source_field_name + '_id') \
-                .replace('%(m2m_item_name)s', self.m2m.target_field_name + '_id')
-
-            params = {
-                'object_id': self.object.pk,
-                'time_to': self.time,
-                'items': tuple(next.items(only_pk=True)),
-                'next_time_from': next.time
-            }
-            cursor.execute(sql, params)
-
-            users_next = {'%s_id__in' % self.m2m.target_field_name: next.items(only_pk=True)}
-
-            # all, who left here and not exist in the next -> left in the next
-            qs.filter(time_to=self.time).exclude(**users_next).update(time_to=next.time)
-            # all, who entered here and not exist in the next -> delete
-            qs.filter(time_from=self.time).exclude(**users_next).delete()
-            # all, who entered here and exist in the next -> entered in the next
-            qs.filter(time_from=self.time).filter(**users_next).update(time_from=next.time)
-
-            # update counts of the next version
-            next.added_count = next.added(only_pk=True).count()
-            next.removed_count = next.removed(only_pk=True).count()
-            next.save()
+        # update counts of the next version
+        next.added_count = next.added(only_pk=True).count()
+        next.removed_count = next.removed(only_pk=True).count()
+        next.save()
+
+
+class ManyToManyHistoryCheckpoint(models.Model):
+    """
+    Snapshot of primary keys of all items of the field at the moment. State at any time after it could be
+    restored from the nearest checkpoint and changes since it without scanning the whole history
+    """
+    class Meta:
+        unique_together = ('content_type', 'object_id', 'field_name', 'time')
+        get_latest_by = 'time'
+
+    content_type = models.ForeignKey(ContentType, related_name='m2m_history_checkpoints', db_index=True)
+    object_id = models.BigIntegerField(db_index=True)
+    object = GenericForeignKey('content_type', 'object_id')
+
+    field_name = models.CharField(max_length=50, db_index=True)
+    time = models.DateTimeField(db_index=True)
+
+    count = models.PositiveIntegerField(default=0)
+    # zlib compressed differences between sorted integer primary keys
+    data = models.BinaryField()
+
+    @property
+    def ids(self):
+        ids = set()
+        last = 0
+        for delta in zlib.decompress(bytes(self.data)).decode().split(','):
+            if delta:
+                last += int(delta)
+                ids.add(last)
+        return ids
+
+    @ids.setter
+    def ids(self, ids):
+        ids = sorted(ids)
+        deltas = [ids[i] - (ids[i - 1] if i else 0) for i in range(len(ids))]
+        self.data = zlib.compress(','.join(map(str, deltas)).encode())
+        self.count = len(ids)
+
+
+class ManyToManyHistorySummary(models.Model):
+    """
+    Denormalized state of the field of the instance: count of current items, times of the first and the last
+    changes and number of versions. Maintained by write methods of manager of the field with argument `summary`
+    """
+    class Meta:
+        unique_together = ('content_type', 'object_id', 'field_name')
+
+    content_type = models.ForeignKey(ContentType, related_name='m2m_history_summaries')
+    object_id = models.BigIntegerField()
+    object = GenericForeignKey('content_type', 'object_id')
+
+    field_name = models.CharField(max_length=50)
+
+    count = models.PositiveIntegerField(default=0)
+    versions_count = models.PositiveIntegerField(default=0)
+    first_time = models.DateTimeField(null=True)
+    last_update_time = models.DateTimeField(null=True)
+
+
+def get_pk_set_size(pk_set):
+    """
+    Return size of `pk_set` argument of signal, which is a lazy queryset after `sync` of manager
+    """
+    return pk_set.count() if isinstance(pk_set, QuerySet) else len(pk_set)
+
+
+@instrumented('version.save', describe_new_version)
+def save_version(instance, field_name, time, action, size):
+    """
+    Save version of the instance after changes of size items at the time
+    """
+    field = instance._meta.get_field(field_name)
+    defaults = {
+        # count of summary or cache without query of items
+        'count': getattr(instance, field_name).count(),
+    }
+    if action in ['post_add']:
+        defaults['added_count'] = size
+    elif action in ['post_remove', 'post_clear']:
+        defaults['removed_count'] = size
+    version, created = ManyToManyHistoryVersion.objects.get_or_create(
+        content_type=ContentType.objects.get_for_model(instance), object_id=instance.pk, field_name=field_name,
+        time=time, defaults=defaults)
+    if not created:
+        version.__dict__.update(defaults)
+        version.save()
+    elif field.summary:
+        ManyToManyHistorySummary.objects.filter(
+            content_type_id=version.content_type_id, object_id=instance.pk, field_name=field_name).update(
+            versions_count=models.F('versions_count') + 1)
 
 
 @receiver(m2m_history_changed)
 def save_m2m_history_version(sender, action, instance, reverse, pk_set, field_name, time, **kwargs):
     keep_version = not reverse and instance._meta.get_field(field_name).versions
-    if keep_version and action in ['post_add', 'post_remove', 'post_clear'] and len(pk_set):
-        defaults = {
-            'count': getattr(instance, field_name).get_queryset(only_pk=True).count(),
+    if not keep_version or action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+    size = get_pk_set_size(pk_set)
+    if size:
+        save_version(instance, field_name, time, action, size)
+
+
+def save_reverse_versions(field, ids, time):
+    """
+    Save versions of items with primary keys (list or queryset) at the reverse side of the field at the time.
+    Counts of all the items are read by grouped queries of the through table and new versions are inserted
+    by one query, so number of queries doesn't depend on number of items
+    """
+    source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    qs = field.rel.through._default_manager.filter(**{'%s__in' % target: ids})
+    added = dict(qs.filter(time_from=time).values_list(target).annotate(Count(source)))
+    removed = dict(qs.filter(time_to=time).values_list(target).annotate(Count(source)))
+    changed = set(added) | set(removed)
+    if not changed:
+        return
+    counts = dict(qs.filter(**{'%s__in' % target: changed, 'time_to': None}).values_list(target).annotate(
+        Count(source, distinct=True)))
+
+    lookup = {
+        'content_type': ContentType.objects.get_for_model(field.rel.to),
+        'field_name': get_accessor_name(field, True),
+        'time': time,
+    }
+    versions = dict([(version.object_id, version)
+                     for version in ManyToManyHistoryVersion.objects.filter(object_id__in=changed, **lookup)])
+    new_versions = []
+    for id in changed:
+        values = {
+            'count': counts.get(id, 0),
+            'added_count': added.get(id, 0),
+            'removed_count': removed.get(id, 0),
         }
-        if action in ['post_add']:
-            defaults['added_count'] = len(pk_set)
-        elif action in ['post_remove', 'post_clear']:
-            defaults['removed_count'] = len(pk_set)
-        version, created = ManyToManyHistoryVersion.objects.get_or_create(
-            content_type=ContentType.objects.get_for_model(instance), object_id=instance.pk, field_name=field_name,
-            time=time, defaults=defaults)
-        if not created:
-            version.__dict__.update(defaults)
-            version.save()
+        if id not in versions:
+            new_versions.append(ManyToManyHistoryVersion(object_id=id, **dict(lookup, **values)))
+        elif values != dict([(name, getattr(versions[id], name)) for name in values]):
+            ManyToManyHistoryVersion.objects.filter(pk=versions[id].pk).update(**values)
+    ManyToManyHistoryVersion.objects.bulk_create(new_versions)
+
+
+@receiver(m2m_history_changed)
+def save_m2m_history_reverse_versions(sender, action, instance, reverse, pk_set, time, **kwargs):
+    """
+    Save versions of items at the reverse side of field with argument `reverse_versions`: of the instance after
+    changes from the reverse side and of all the items of `pk_set` in batch after changes from the forward side
+    """
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+    if not isinstance(pk_set, QuerySet) and not pk_set:
+        return
+    field = get_through_field(sender)
+    # both sides of symmetrical relation are forward
+    if field is not None and field.reverse_versions and get_other_side(field, False):
+        save_reverse_versions(field, [instance.pk] if reverse else pk_set, time)
+
+
+@receiver(m2m_history_changed)
+def save_m2m_history_checkpoint(sender, action, instance, reverse, pk_set, field_name, time, **kwargs):
+    """
+    Make checkpoint after every `checkpoints_every` versions or `checkpoints_interval` since the last checkpoint.
+    Checkpoints of items at the forward side since the time of change are not valid anymore
+    """
+    if action not in ['post_add', 'post_remove', 'post_clear'] or not get_pk_set_size(pk_set):
+        return
+    field = get_through_field(sender)
+    if field is None or not field.checkpoints_every and not field.checkpoints_interval:
+        return
+    # both sides of symmetrical relation are forward
+    if not get_other_side(field, reverse):
+        ManyToManyHistoryCheckpoint.objects.filter(content_type=ContentType.objects.get_for_model(field.model),
+                                                   field_name=field.name, object_id__in=pk_set,
+                                                   time__gte=time).delete()
+    if reverse:
+        return
+
+    manager = getattr(instance, field_name)
+    if manager.last_update_time() > time:
+        # change in the past: snapshots since it are not valid anymore, the next changes make new ones
+        manager.checkpoints.filter(time__gte=time).delete()
+        return
+    try:
+        checkpoint = manager.checkpoints.latest()
+    except ManyToManyHistoryCheckpoint.DoesNotExist:
+        checkpoint = None
+
+    if checkpoint is None or checkpoint.time != time:
+        # versions before the change and version of the change, which could be saved by other receiver yet
+        versions = manager.versions.filter(time__lt=time)
+        if checkpoint:
+            versions = versions.filter(time__gt=checkpoint.time)
+            last_time = checkpoint.time
+        else:
+            last_time = versions.aggregate(Min('time'))['time__min'] or time
+        if not (field.checkpoints_every and versions.count() + 1 >= field.checkpoints_every) \
+                and not (field.checkpoints_interval and time - last_time >= field.checkpoints_interval):
+            return
+        checkpoint = ManyToManyHistoryCheckpoint(content_type=ContentType.objects.get_for_model(instance),
+                                                 object_id=instance.pk, field_name=field_name, time=time)
+
+    # checkpoint at the same time is updated, because the time could be shared by several changes
+    checkpoint.ids = manager.get_queryset(only_pk=True)
+    checkpoint.save()
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+from django.db.backends.utils import truncate_name
+from django.db.migrations.operations.base import Operation
+
+__all__ = ['AddTimeRange', 'AddHistoryIndexes', 'PartitionHistoryTable']
+
+
+class HistoryFieldOperation(Operation):
+    """
+    Base operation for backend specific changes of the through table of ManyToManyHistoryField,
+    that can not be expressed by Django schema editor. Usage in migration of the app with the field:
+
+        operations = [
+            AddTimeRange('article', 'publications'),
+        ]
+    """
+    # backends, where operation is applicable, None means all
+    vendors = None
+
+    def __init__(self, model_name, name):
+        self.model_name = model_name
+        self.name = name
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def get_field(self, app_label, state):
+        # `apps` attribute of state is not present before Django 1.8
+        apps = state.apps if hasattr(state, 'apps') else state.render()
+        return apps.get_model(app_label, self.model_name)._meta.get_field(self.name)
+
+    def get_columns(self, field):
+        """
+        Return source and target columns of the through table
+        """
+        opts = field.rel.through._meta
+        return opts.get_field(field.m2m_field_name()).column, opts.get_field(field.m2m_reverse_field_name()).column
+
+    def is_applicable(self, schema_editor, field):
+        return (self.vendors is None or schema_editor.connection.vendor in self.vendors) and \
+            self.allow_migrate_model(schema_editor.connection.alias, field.rel.through)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        field = self.get_field(app_label, to_state)
+        if self.is_applicable(schema_editor, field):
+            for sql in self.forwards_sql(schema_editor, field):
+                schema_editor.execute(sql)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        field = self.get_field(app_label, from_state)
+        if self.is_applicable(schema_editor, field):
+            for sql in self.backwards_sql(schema_editor, field):
+                schema_editor.execute(sql)
+
+    def forwards_sql(self, schema_editor, field):
+        raise NotImplementedError
+
+    def backwards_sql(self, schema_editor, field):
+        raise NotImplementedError
+
+
+class AddHistoryIndexes(HistoryFieldOperation):
+    """
+    Add composite indexes, declared by ManyToManyHistoryField.get_history_indexes(), to the through table.
+    Partial index of open rows keeps reading of current members independent of the size of history.
+    If backend doesn't support partial indexes, `time_to` column is added to the index instead of condition
+    and the index is not unique, because NULL values of `time_to` are not equal
+    """
+    partial_indexes_vendors = ('postgresql', 'sqlite')
+
+    def get_indexes(self, schema_editor, field):
+        for suffix, columns, condition, unique in field.get_history_indexes():
+            if condition and schema_editor.connection.vendor not in self.partial_indexes_vendors:
+                columns, condition, unique = columns[:1] + ['time_to'] + columns[1:], None, False
+            name = schema_editor._create_index_name(field.rel.through, columns, suffix)
+            yield name, columns, condition, unique
+
+    def forwards_sql(self, schema_editor, field):
+        sqls = []
+        for name, columns, condition, unique in self.get_indexes(schema_editor, field):
+            sqls.append('CREATE %(unique)sINDEX %(name)s ON %(table)s (%(columns)s)%(condition)s' % {
+                'unique': 'UNIQUE ' if unique else '',
+                'name': schema_editor.quote_name(name),
+                'table': schema_editor.quote_name(field.rel.through._meta.db_table),
+                'columns': ', '.join([schema_editor.quote_name(column) for column in columns]),
+                'condition': ' WHERE %s' % condition if condition else '',
+            })
+        return sqls
+
+    def backwards_sql(self, schema_editor, field):
+        return [schema_editor.sql_delete_index % {
+            'name': schema_editor.quote_name(name),
+            'table': schema_editor.quote_name(field.rel.through._meta.db_table),
+        } for name, columns, condition, unique in self.get_indexes(schema_editor, field)]
+
+    def describe(self):
+        return "Add history indexes to through table of %s.%s" % (self.model_name, self.name)
+
+
+class AddTimeRange(HistoryFieldOperation):
+    """
+    Add `time_range` tstzrange column to the through table, maintained by trigger from `time_from` and `time_to`,
+    and GiST index on (source, time_range). Field should be declared with argument `time_range=True` to use it
+    in `were_at` and `were_between` methods. PostgreSQL only, requires `btree_gist` extension.
+    """
+    vendors = ('postgresql',)
+
+    def forwards_sql(self, schema_editor, field):
+        through = field.rel.through
+        source_column = self.get_columns(field)[0]
+        params = {
+            'table': schema_editor.quote_name(through._meta.db_table),
+            'source': schema_editor.quote_name(source_column),
+            'trigger': schema_editor.quote_name(schema_editor._create_index_name(through, ['time_range'], '_trg')),
+            'index': schema_editor.quote_name(
+                schema_editor._create_index_name(through, [source_column, 'time_range'], '_gist')),
+        }
+        return [
+            'CREATE EXTENSION IF NOT EXISTS btree_gist',
+            'ALTER TABLE %(table)s ADD COLUMN time_range tstzrange' % params,
+            '''CREATE OR REPLACE FUNCTION m2m_history_time_range() RETURNS trigger AS $$
+                BEGIN
+                    IF NEW.time_to < NEW.time_from THEN
+                        NEW.time_range := 'empty'::tstzrange;
+                    ELSE
+                        NEW.time_range := tstzrange(NEW.time_from, NEW.time_to, '[)');
+                    END IF;
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql''',
+            '''CREATE TRIGGER %(trigger)s BEFORE INSERT OR UPDATE OF time_from, time_to ON %(table)s
+                FOR EACH ROW EXECUTE PROCEDURE m2m_history_time_range()''' % params,
+            # fire trigger for existing rows
+            'UPDATE %(table)s SET time_from = time_from' % params,
+            'CREATE INDEX %(index)s ON %(table)s USING gist (%(source)s, time_range)' % params,
+        ]
+
+    def backwards_sql(self, schema_editor, field):
+        through = field.rel.through
+        params = {
+            'table': schema_editor.quote_name(through._meta.db_table),
+            'trigger': schema_editor.quote_name(schema_editor._create_index_name(through, ['time_range'], '_trg')),
+        }
+        return [
+            'DROP TRIGGER %(trigger)s ON %(table)s' % params,
+            'ALTER TABLE %(table)s DROP COLUMN time_range' % params,
+        ]
+
+    def describe(self):
+        return "Add time_range column to through table of %s.%s" % (self.model_name, self.name)
+
+
+class PartitionHistoryTable(HistoryFieldOperation):
+    """
+    Replace the through table by partitioned by range of `time_to` table: open rows are stored in default partition
+    `<table>_open`, closed rows in partitions between `bounds` (dates or times, from MINVALUE to MAXVALUE).
+    Closing of item moves its row to the closed partition, reading of current items scans only the open one
+    and temporal queries are pruned by `time_to`. PostgreSQL 11+ only, `time_range` column requires PostgreSQL 13+.
+    Indexes and triggers of the table are kept. Primary keys are unique inside partitions, so unique index
+    of open rows (`unique_open` argument of field) is not supported:
+
+        operations = [
+            PartitionHistoryTable('article', 'publications', bounds=['2014-01-01', '2015-01-01']),
+        ]
+    """
+    vendors = ('postgresql',)
+
+    def __init__(self, model_name, name, bounds=()):
+        super(PartitionHistoryTable, self).__init__(model_name, name)
+        self.bounds = list(bounds)
+
+    def get_partitions(self, schema_editor, table):
+        """
+        Return list of tuples (name, sql of bounds) of partitions
+        """
+        max_length = schema_editor.connection.ops.max_name_length()
+        bounds = ['MINVALUE'] + [schema_editor.quote_value(str(bound)) for bound in self.bounds] + ['MAXVALUE']
+        partitions = [(truncate_name('%s_open' % table, max_length), 'DEFAULT')]
+        for i in range(len(bounds) - 1):
+            suffix = 'min' if i == 0 else str(self.bounds[i - 1]).split(' ')[0].replace('-', '')
+            partitions.append((truncate_name('%s_closed_%s' % (table, suffix), max_length),
+                               'FOR VALUES FROM (%s) TO (%s)' % (bounds[i], bounds[i + 1])))
+        return partitions
+
+    def get_constraints_sql(self, schema_editor, field):
+        """
+        Return indexes, triggers and foreign keys of the through table, dropped with the previous table.
+        Indexes and triggers are read from the table before the change, so the ones, added by AddHistoryIndexes
+        and AddTimeRange operations, are created again too
+        """
+        through = field.rel.through
+        table = schema_editor.quote_name(through._meta.db_table)
+        cursor = schema_editor.connection.cursor()
+        cursor.execute('''SELECT pg_get_indexdef(indexrelid) FROM pg_index
+            WHERE indrelid = %s::regclass AND NOT indisprimary ORDER BY indexrelid''', [table])
+        # index of partitioned table is defined only on it, index of the new table should cover partitions
+        sqls = [sql.replace(' ON ONLY ', ' ON ') for sql, in cursor.fetchall()]
+        cursor.execute('''SELECT pg_get_triggerdef(oid) FROM pg_trigger
+            WHERE tgrelid = %s::regclass AND NOT tgisinternal ORDER BY oid''', [table])
+        sqls += [sql for sql, in cursor.fetchall()]
+        return sqls + [
+            schema_editor._create_fk_sql(through, through._meta.get_field(name), '_fk_%(to_table)s_%(to_column)s')
+            for name in [field.m2m_field_name(), field.m2m_reverse_field_name()]]
+
+    def get_move_sql(self, schema_editor, field, old_table):
+        params = {
+            'table': schema_editor.quote_name(field.rel.through._meta.db_table),
+            'old_table': schema_editor.quote_name(old_table),
+            'sequence_table': schema_editor.quote_value(old_table),
+            'sequence_owner': schema_editor.quote_value('%s.%s' % (
+                schema_editor.quote_name(field.rel.through._meta.db_table),
+                schema_editor.quote_name(field.rel.through._meta.pk.column))),
+            'pk_value': schema_editor.quote_value(field.rel.through._meta.pk.column),
+        }
+        return [
+            'INSERT INTO %(table)s SELECT * FROM %(old_table)s' % params,
+            # sequence of primary key should not be dropped with the previous table
+            '''DO $$ BEGIN
+                EXECUTE 'ALTER SEQUENCE ' || pg_get_serial_sequence(%(sequence_table)s, %(pk_value)s)
+                    || ' OWNED BY ' || %(sequence_owner)s;
+            END $$''' % params,
+            'DROP TABLE %(old_table)s' % params,
+        ] + self.get_constraints_sql(schema_editor, field)
+
+    def forwards_sql(self, schema_editor, field):
+        table = field.rel.through._meta.db_table
+        old_table = truncate_name('%s_unpartitioned' % table, schema_editor.connection.ops.max_name_length())
+        params = {
+            'table': schema_editor.quote_name(table),
+            'old_table': schema_editor.quote_name(old_table),
+            'pk': schema_editor.quote_name(field.rel.through._meta.pk.column),
+        }
+        sqls = [
+            'ALTER TABLE %(table)s RENAME TO %(old_table)s' % params,
+            'CREATE TABLE %(table)s (LIKE %(old_table)s INCLUDING DEFAULTS) PARTITION BY RANGE (time_to)' % params,
+        ]
+        for name, bounds in self.get_partitions(schema_editor, table):
+            check = ' (CHECK (time_to IS NULL))' if bounds == 'DEFAULT' else ''
+            sqls += [
+                'CREATE TABLE %s PARTITION OF %s%s %s' % (
+                    schema_editor.quote_name(name), params['table'], check, bounds),
+                'ALTER TABLE %s ADD PRIMARY KEY (%s)' % (schema_editor.quote_name(name), params['pk']),
+            ]
+        return sqls + self.get_move_sql(schema_editor, field, old_table)
+
+    def backwards_sql(self, schema_editor, field):
+        table = field.rel.through._meta.db_table
+        old_table = truncate_name('%s_partitioned' % table, schema_editor.connection.ops.max_name_length())
+        params = {
+            'table': schema_editor.quote_name(table),
+            'old_table': schema_editor.quote_name(old_table),
+            'pk': schema_editor.quote_name(field.rel.through._meta.pk.column),
+        }
+        return [
+            'ALTER TABLE %(table)s RENAME TO %(old_table)s' % params,
+            'CREATE TABLE %(table)s (LIKE %(old_table)s INCLUDING DEFAULTS, PRIMARY KEY (%(pk)s))' % params,
+        ] + self.get_move_sql(schema_editor, field, old_table)
+
+    def describe(self):
+        return "Partition through table of %s.%s by time_to" % (self.model_name, self.name)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from django.db.models.constants import LOOKUP_SEP
+
+try:
+    from django.db.models import Prefetch
+except ImportError:
+    # Django < 1.7
+    Prefetch = None
+
+__all__ = ['HistoryPrefetch']
+
+
+def get_cache_name(name, window):
+    """
+    Return name of prefetch cache for the time window: ('at', time) or ('between', time_from, time_to)
+    """
+    return '%s@%s' % (name, ':'.join([window[0]] + [time.isoformat() for time in window[1:]]))
+
+
+def get_window(method, args):
+    """
+    Return time window, prefetched for the history method with the arguments
+    """
+    return ('at',) + tuple(args) if method.endswith('_at') else ('between',) + tuple(args)
+
+
+# conditions of history methods on `time_from` and `time_to` of through row, the same as SQL conditions of methods,
+# where any comparison with NULL is false
+PREDICATES = {
+    'were_at': lambda time_from, time_to, time:
+        (time_from is None or time_from <= time) and (time_to is None or time_to > time),
+    'added_at': lambda time_from, time_to, time: time_from == time,
+    'removed_at': lambda time_from, time_to, time: time_to == time,
+    'were_between': lambda time_from, time_to, start, end:
+        (time_from is None and time_to is None) or
+        (time_from is None and time_to is not None and time_to >= end) or
+        (time_from is not None and time_from <= start and time_to is None) or
+        (time_from is not None and time_to is not None and (
+            start <= time_from and time_to <= end or
+            time_from <= start and time_to >= end or
+            time_from < end and time_to > start)),
+    'added_between': lambda time_from, time_to, start, end: time_from is not None and start <= time_from <= end,
+    'removed_between': lambda time_from, time_to, start, end: time_to is not None and start <= time_to <= end,
+}
+
+
+class HistoryPrefetch(Prefetch or object):
+    """
+    Prefetch items of ManyToManyHistoryField at the time or during the period for all instances by one query:
+
+        Article.objects.prefetch_related(HistoryPrefetch('publications', at=time))
+        Article.objects.prefetch_related(HistoryPrefetch('publications', between=(time_from, time_to)))
+
+    After that `were_at`, `added_at` and `removed_at` methods with the same time (or `were_between`,
+    `added_between` and `removed_between` with the same period) of prefetched instances don't make queries.
+    Requires Django 1.7+
+    """
+    def __init__(self, lookup, at=None, between=None, queryset=None, to_attr=None):
+        if Prefetch is None:
+            raise NotImplementedError("HistoryPrefetch requires Django 1.7 or newer")
+        if (at is None) == (between is None):
+            raise ValueError("Exactly one of arguments `at` and `between` should be specified")
+        super(HistoryPrefetch, self).__init__(lookup, queryset=queryset, to_attr=to_attr)
+        self.window = ('at', at) if at is not None else ('between',) + tuple(between)
+        # prefetches of the same lookup with different windows should not be treated as duplicates
+        self.prefetch_to = get_cache_name(self.prefetch_to, self.window)
+
+    def get_current_to_attr(self, level):
+        to_attr, as_attr = super(HistoryPrefetch, self).get_current_to_attr(level)
+        return to_attr.split('@')[0], as_attr
+
+    def get_current_queryset(self, level):
+        """
+        Return prefetch itself for the last level, manager of the field gets queryset and window from it
+        """
+        if level == len(self.prefetch_through.split(LOOKUP_SEP)) - 1:
+            return self
+        return None
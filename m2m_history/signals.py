@@ -2,3 +2,6 @@ from django.dispatch import Signal
 
 m2m_history_changed = Signal(providing_args=["action", "instance", "reverse", "model", "pk_set", "using",
                                              "field_name", "time"])
+
+# record of operation of manager, made by instrumentation
+m2m_history_instrumented = Signal(providing_args=["record"])
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Summaries of ManyToManyHistoryField with argument `summary`: count of current items, times of the first and the last
+changes and number of versions of every instance in one row, so `count()` and `last_update_time()` don't scan
+the through table. Summary is saved by the first change and changed incrementally by write methods of manager,
+before it reads make it without saving.
+Changes of history without them (deleting of versions) refresh summaries, writes of raw SQL need rebuilding
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, Max, Min
+
+from .bulk import atomic, iter_batches
+from .models import ManyToManyHistorySummary, ManyToManyHistoryVersion
+
+__all__ = ['get_summaries', 'get_summary_values', 'refresh_summaries', 'rebuild_summaries']
+
+
+def get_summaries(field, ids):
+    """
+    Return queryset of summaries of the field of instances with primary keys
+    """
+    return ManyToManyHistorySummary.objects.filter(content_type=ContentType.objects.get_for_model(field.model),
+                                                   field_name=field.name, object_id__in=ids)
+
+
+def get_summary_values(field, ids, using=None):
+    """
+    Return dictionary with values of summaries of instances with primary keys, made from the through table
+    and versions by three grouped queries
+    """
+    source = field.m2m_field_name()
+    target = field.m2m_reverse_field_name()
+    qs = field.rel.through._default_manager.using(using).filter(**{'%s__in' % source: ids})
+    values = dict([(id, {'count': 0, 'versions_count': 0, 'first_time': None, 'last_update_time': None})
+                   for id in ids])
+
+    for id, count in qs.filter(time_to=None).values_list(source).annotate(Count(target, distinct=True)):
+        values[id]['count'] = count
+    # separate calls keep order of annotations on Django < 1.7
+    for id, first_time, time_from, time_to in qs.values_list(source).annotate(
+            Min('time_from')).annotate(Max('time_from')).annotate(Max('time_to')):
+        values[id]['first_time'] = first_time
+        values[id]['last_update_time'] = max(time_from, time_to) if time_from and time_to else time_from or time_to
+    if field.versions:
+        versions = ManyToManyHistoryVersion.objects.filter(
+            content_type=ContentType.objects.get_for_model(field.model), field_name=field.name, object_id__in=ids)
+        for id, count in versions.values_list('object_id').annotate(Count('pk')):
+            values[id]['versions_count'] = count
+    return values
+
+
+def refresh_summaries(field, ids, using=None):
+    """
+    Make summaries of instances with primary keys again from the through table and versions
+    """
+    if not field.summary or not ids:
+        return
+    content_type = ContentType.objects.get_for_model(field.model)
+    values = get_summary_values(field, ids, using=using)
+    get_summaries(field, ids).delete()
+    ManyToManyHistorySummary.objects.bulk_create([
+        ManyToManyHistorySummary(content_type=content_type, object_id=id, field_name=field.name, **values)
+        for id, values in values.items()])
+
+
+def rebuild_summaries(field, batch_size=1000):
+    """
+    Make summaries of all instances of the field again by batches, every batch in own transaction.
+    Return number of made summaries
+    """
+    source = field.m2m_field_name()
+    rows = field.rel.through._default_manager.all()
+    count = 0
+    for batch in iter_batches(rows, source, batch_size):
+        with atomic():
+            refresh_summaries(field, batch)
+        count += len(batch)
+
+    # summaries of instances without rows in the through table
+    ManyToManyHistorySummary.objects.filter(
+        content_type=ContentType.objects.get_for_model(field.model), field_name=field.name).exclude(
+        object_id__in=rows.values_list(source, flat=True)).delete()
+    return count
+
+
+def delete_related_summaries(field, instance):
+    """
+    Delete summaries of instances with rows of the through table, which are deleted with the related instance.
+    Rows of auto created through tables are deleted without signals, so it's called before deleting
+    """
+    source = field.m2m_field_name()
+    target = field.m2m_reverse_field_name()
+    get_summaries(field, field.rel.through._default_manager.filter(**{target: instance.pk}).values_list(
+        source, flat=True)).delete()
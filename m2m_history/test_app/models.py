@@ -1,13 +1,34 @@
 from django.db import models
 
 from ..fields import ManyToManyHistoryField
+from ..lookups import HistoryForeignKey
 
 
 class Publication(models.Model):
     title = models.CharField(max_length=30)
 
 
+class Authorship(models.Model):
+    article = models.ForeignKey('Article')
+    publication = HistoryForeignKey(Publication)
+    time_from = models.DateTimeField(null=True, db_index=True)
+    time_to = models.DateTimeField(null=True, db_index=True)
+
+
 class Article(models.Model):
     headline = models.CharField(max_length=100)
     publications = ManyToManyHistoryField(Publication, versions=True)
     publications_no_versions = ManyToManyHistoryField(Publication, related_name='articles_no_versions')
+    publications_time_range = ManyToManyHistoryField(Publication, related_name='articles_time_range', time_range=True)
+    publications_checkpoints = ManyToManyHistoryField(Publication, related_name='articles_checkpoints', versions=True,
+                                                      checkpoints_every=2)
+    publications_unique_open = ManyToManyHistoryField(Publication, related_name='articles_unique_open',
+                                                      unique_open=True)
+    publications_cache = ManyToManyHistoryField(Publication, related_name='articles_cache', cache=True,
+                                                history_cache=True, versions=True)
+    publications_summary = ManyToManyHistoryField(Publication, related_name='articles_summary', summary=True,
+                                                  versions=True)
+    publications_reverse_versions = ManyToManyHistoryField(Publication, related_name='articles_reverse_versions',
+                                                           versions=True, reverse_versions=True)
+    publications_through = ManyToManyHistoryField(Publication, related_name='articles_through', through=Authorship,
+                                                  history_cache=True)
@@ -3,18 +3,66 @@ Improved tests based on Django docs: https://docs.djangoproject.com/en/dev/topic
 """
 
 import time
+from datetime import timedelta
+from unittest import skipUnless
 
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import ForeignKey
+from django.db.models.query import QuerySet
 from django.test import TransactionTestCase
 from django.utils import timezone
+from django.utils.six import StringIO
 
-from .models import ManyToManyHistoryVersion
-from .test_app.models import Publication, Article
+from .algebra import HistorySet
+from .audit import audit
+from .backfill import backfill_versions
+from .bulk import atomic
+from .cache import get_prefix, get_through_field
+from .compaction import join_intervals
+from .export import iter_through_rows, iter_version_rows
+from .instrumentation import get_queries_log, instrument
+from .models import ManyToManyHistoryCheckpoint, ManyToManyHistorySummary, ManyToManyHistoryVersion
+from .signals import m2m_history_changed, m2m_history_instrumented
+from .prefetch import PREDICATES, HistoryPrefetch, Prefetch
+from .test_app.models import Authorship, Publication, Article
+
+try:
+    from django.test.utils import CaptureQueriesContext
+except ImportError:
+    # Django 1.5
+    CaptureQueriesContext = None
+
+try:
+    from django.db.migrations.state import ProjectState
+    from .operations import AddHistoryIndexes, AddTimeRange, PartitionHistoryTable
+except ImportError:
+    # migrations are not present before Django 1.7
+    ProjectState = None
+
+
+def postgresql_extension_available(name):
+    if connection.vendor != 'postgresql':
+        return False
+    cursor = connection.cursor()
+    cursor.execute('SELECT 1 FROM pg_available_extensions WHERE name = %s', [name])
+    return cursor.fetchone() is not None
 
 
 class ManyToManyHistoryTest(TransactionTestCase):
     def assertPublicationsEqual(self, a, b):
         return self.assertListEqual(list(a.order_by('id').values_list('id', flat=True)), sorted([p.id for p in b]))
 
+    def _build_history(self, owner, states, start, field_name='publications', step=timedelta(hours=1)):
+        """
+        Set items of the field of owner to states one by one, every next state a step after the previous one
+        """
+        for i, state in enumerate(states):
+            manager = getattr(owner, field_name)
+            manager.time = start + step * i
+            manager.set(state)
+
     def test_m2m_fields_and_methods(self):
         self.assertListEqual(
             sorted([field.name for field in Article._meta.get_field('publications').rel.through._meta.local_fields]),
@@ -29,8 +77,8 @@ class ManyToManyHistoryTest(TransactionTestCase):
 
         article = Article.objects.create(headline='Article1')
         state_time1 = timezone.now()
-        # we need to use sleep here to pass travis mysql tests, becouse Django + mysql doesn't support storing microseconds
-        # and as result our state_timeX will be equal
+        # we need to use sleep here to pass travis mysql tests, becouse Django + mysql doesn't support storing
+        # microseconds and as result our state_timeX will be equal
         time.sleep(1)
 
         article.publications = [p1, p2]
@@ -186,6 +234,961 @@ class ManyToManyHistoryTest(TransactionTestCase):
         self.assertEqual(version.added_count, 1)
         self.assertEqual(version.removed_count, 0)
 
+    def test_m2m_history_cache(self):
+        cache.clear()
+        p1, p2, p3 = [Publication.objects.create(title='Pub%d' % i) for i in range(3)]
+        article = Article.objects.create(headline='Article1')
+        article.publications_cache = [p1, p2]
+        cache.clear()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(article.publications_cache.count(), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(article.publications_cache.count(), 2)
+            self.assertEqual(set(article.publications_cache.get_queryset(only_pk=True)), set([p1.pk, p2.pk]))
+        self.assertEqual(p3.articles_cache.count(), 0)
+
+        # invalidated at both sides
+        article.publications_cache.add(p3)
+        self.assertPublicationsEqual(article.publications_cache.all(), [p1, p2, p3])
+        self.assertEqual(p3.articles_cache.count(), 1)
+        p3.articles_cache.remove(article)
+        self.assertEqual(article.publications_cache.count(), 2)
+
+        # rows are deleted with item
+        p2.delete()
+        self.assertPublicationsEqual(article.publications_cache.all(), [p1])
+
+        # generation, made inside of transaction, is changed after commit or has short living values
+        prefix = get_prefix(Article.publications_cache.through, False, article.pk)
+        with atomic():
+            article.publications_cache.add(p3)
+            generation = cache.get(prefix + ':generation')
+            self.assertEqual(article.publications_cache.count(), 2)
+        if hasattr(transaction, 'on_commit') or hasattr(connection, 'on_commit'):
+            self.assertNotEqual(cache.get(prefix + ':generation'), generation)
+        else:
+            self.assertEqual(cache.get(prefix + ':generation'), generation)
+            self.assertTrue(cache.get(prefix + ':generation:uncommitted'))
+
+    def test_m2m_history_cache_history(self):
+        cache.clear()
+        p1, p2, p3 = [Publication.objects.create(title='Pub%d' % i) for i in range(3)]
+        article = Article.objects.create(headline='Article1')
+        time1 = timezone.now() - timedelta(days=1)
+        self._build_history(article, [[p1], [p1, p2], [p2, p3]], time1, 'publications_cache')
+
+        time2 = time1 + timedelta(hours=1)
+        self.assertPublicationsEqual(article.publications_cache.were_at(time2), [p1, p2])
+        self.assertEqual(list(p3.articles_cache.added_between(time1, time2, only_pk=True)), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(set(article.publications_cache.were_at(time2, only_pk=True)), set([p1.pk, p2.pk]))
+            self.assertEqual(list(p3.articles_cache.added_between(time1, time2, only_pk=True)), [])
+        self.assertPublicationsEqual(article.publications_cache.added_between(time1, time2), [p1, p2])
+        # only query of items by primary keys
+        with self.assertNumQueries(1):
+            self.assertPublicationsEqual(article.publications_cache.added_between(time1, time2), [p1, p2])
+
+        # the last state is not cached
+        time3 = time1 + timedelta(hours=2)
+        with self.assertNumQueries(1):
+            article.publications_cache.were_at(time3, only_pk=True).count()
+
+        # change in the past and deleting of version invalidate history
+        p4 = Publication.objects.create(title='Pub4')
+        manager = article.publications_cache
+        manager.time = time1 + timedelta(minutes=30)
+        manager.add(p4)
+        self.assertPublicationsEqual(article.publications_cache.were_at(time2), [p1, p2, p4])
+        self.assertPublicationsEqual(article.publications_cache.were_at(time1 + timedelta(minutes=45)), [p1, p4])
+        article.publications_cache.versions.get(time=time1 + timedelta(minutes=30)).delete()
+        self.assertPublicationsEqual(article.publications_cache.were_at(time1 + timedelta(minutes=45)), [p1])
+
+    def test_m2m_history_explicit_through(self):
+        cache.clear()
+        p1, p2 = [Publication.objects.create(title='Pub%d' % i) for i in range(2)]
+        article = Article.objects.create(headline='Article1')
+        time1 = timezone.now() - timedelta(days=2)
+        time2 = time1 + timedelta(days=1)
+        Authorship.objects.create(article=article, publication=p1, time_from=time1)
+        Authorship.objects.create(article=article, publication=p2, time_from=time1, time_to=time2)
+
+        self.assertEqual(get_through_field(Authorship), Article._meta.get_field('publications_through'))
+        self.assertPublicationsEqual(article.publications_through.all(), [p1])
+        self.assertPublicationsEqual(article.publications_through.were_at(time1 + timedelta(hours=1)), [p1, p2])
+        self.assertPublicationsEqual(p2.articles_through.were_at(time2 + timedelta(hours=1)), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(set(article.publications_through.were_at(time1 + timedelta(hours=1), only_pk=True)),
+                             set([p1.pk, p2.pk]))
+
+        # rows, written by manager of through model, invalidate cached history of both sides
+        p3 = Publication.objects.create(title='Pub3')
+        Authorship.objects.create(article=article, publication=p3, time_from=time1)
+        self.assertPublicationsEqual(article.publications_through.were_at(time1 + timedelta(hours=1)), [p1, p2, p3])
+        self.assertEqual(list(p3.articles_through.were_at(time1 + timedelta(hours=1), only_pk=True)), [article.pk])
+        authorship = Authorship.objects.get(publication=p1)
+        authorship.time_to = time2 + timedelta(hours=12)
+        authorship.save()
+        self.assertPublicationsEqual(article.publications_through.were_at(time2 + timedelta(hours=6)), [p1, p3])
+        self.assertPublicationsEqual(article.publications_through.were_at(time2 + timedelta(hours=13)), [p3])
+        self.assertPublicationsEqual(article.publications_through.all(), [p3])
+
+        # declared foreign keys are not changed, lookups of history are compiled by HistoryForeignKey
+        if hasattr(ForeignKey, 'get_lookup'):
+            self.assertEqual(Authorship._meta.get_field('article').deconstruct()[1], 'django.db.models.ForeignKey')
+            self.assertEqual(list(Article.objects.filter(publications_through__at=(time2 + timedelta(hours=6), p1))
+                                  .distinct().values_list('pk', flat=True)), [article.pk])
+
+    def test_m2m_history_versions_with_neighbors(self):
+        p1, p2, p3 = [Publication.objects.create(title='Pub%d' % i) for i in range(3)]
+        article = Article.objects.create(headline='Article1')
+        time1 = timezone.now() - timedelta(days=1)
+        self._build_history(article, [[p1], [p1, p2], [p2, p3], [p3]], time1)
+        expected = [(version.prev, version.next) for version in article.publications.versions.order_by('time')]
+
+        with self.assertNumQueries(2):
+            versions = list(article.publications.versions.with_neighbors().order_by('time'))
+            neighbors = [(version.neighbor_prev, version.neighbor_next) for version in versions]
+            [version.m2m for version in versions + [version.neighbor_prev for version in versions[1:]]]
+
+        self.assertEqual(neighbors[0][0], None)
+        self.assertEqual(neighbors[-1][1], None)
+        self.assertEqual(neighbors, expected)
+        self.assertEqual([(v.time, v.count, v.added_count, v.removed_count) for v in versions[1:]],
+                         [(v.neighbor_next.time, v.neighbor_next.count, v.neighbor_next.added_count,
+                           v.neighbor_next.removed_count) for v in versions[:-1]])
+
+        # neighbors of window of filtered queryset are not used for deleting
+        article.publications.versions.with_neighbors().get(time=time1 + timedelta(hours=1)).delete()
+        self.assertPublicationsEqual(article.publications.were_at(time1 + timedelta(hours=2)), [p2, p3])
+        self.assertEqual(article.publications.versions.with_neighbors().filter(
+            time__gte=time1 + timedelta(hours=2)).delete(), None)
+        self.assertPublicationsEqual(article.publications.were_at(time1 + timedelta(hours=2)), [p1])
+        self.assertPublicationsEqual(article.publications.all(), [p1])
+        self.assertEqual(article.publications.versions.count(), 1)
+
+    def test_m2m_history_iter_states(self):
+        p1, p2, p3, p4 = [Publication.objects.create(title='Pub%d' % i) for i in range(4)]
+        article = Article.objects.create(headline='Article1')
+        time1 = timezone.now() - timedelta(days=1)
+        for i, state in enumerate([[p1], [p1, p2, p3], [p2, p3], [p3, p4], []]):
+            manager = article.publications
+            manager.time = time1 + timedelta(hours=i)
+            manager.set(state)
+            if i == 2:
+                # adjacent intervals of p3 are not a change
+                manager.remove(p3)
+                manager.add(p3)
+
+        states = [(state_time, added, removed, set(items)) for state_time, added, removed, items
+                  in article.publications.iter_states(chunk_size=2)]
+        expected = []
+        for version in article.publications.versions.order_by('time'):
+            added, removed = set(version.added(only_pk=True)), set(version.removed(only_pk=True))
+            expected.append((version.time, added - removed, removed - added, set(version.items(only_pk=True))))
+        self.assertEqual(states, expected)
+        self.assertEqual(list(article.publications.iter_diffs())[2], (time1 + timedelta(hours=2), set(), set([p1.pk])))
+
+    def test_m2m_history_summary(self):
+        p1, p2, p3 = [Publication.objects.create(title='Pub%d' % i) for i in range(3)]
+        article = Article.objects.create(headline='Article1')
+        time1 = timezone.now() - timedelta(days=1)
+        self._build_history(article, [[p1], [p1, p2, p3], [p2]], time1, 'publications_summary')
+
+        def assertSummaryEqual(count, first_time, last_update_time, versions_count):
+            summary = article.publications_summary.summary
+            self.assertEqual((summary.count, summary.first_time, summary.last_update_time, summary.versions_count),
+                             (count, first_time, last_update_time, versions_count))
+
+        assertSummaryEqual(1, time1, time1 + timedelta(hours=2), 3)
+        with self.assertNumQueries(1):
+            self.assertEqual(article.publications_summary.count(), 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(article.publications_summary.last_update_time(), time1 + timedelta(hours=2))
+        self.assertEqual([version.count for version in article.publications_summary.versions.order_by('time')],
+                         [1, 3, 1])
+
+        # reads make summary without saving, the first change saves it
+        ManyToManyHistorySummary.objects.all().delete()
+        assertSummaryEqual(1, time1, time1 + timedelta(hours=2), 3)
+        self.assertEqual(ManyToManyHistorySummary.objects.count(), 0)
+
+        # changes of the instance and of items
+        time2 = time1 + timedelta(hours=3)
+        manager = article.publications_summary
+        manager.time = time2
+        manager.add(p1, p3)
+        self.assertEqual(ManyToManyHistorySummary.objects.count(), 1)
+        assertSummaryEqual(3, time1, time2, 4)
+        p1.articles_summary.remove(article)
+        self.assertEqual(article.publications_summary.count(), 2)
+        p3.delete()
+        self.assertEqual(article.publications_summary.count(), 1)
+        article.publications_summary.sync([p1.pk, p2.pk])
+        self.assertEqual(article.publications_summary.count(), 2)
+        self.assertEqual(article.publications_summary.last_update_time(),
+                         article.publications_summary.versions.latest().time)
+
+        # deleting of versions refreshes summary
+        def assertSummaryRefreshed(count):
+            summary = ManyToManyHistorySummary.objects.get(object_id=article.pk, field_name='publications_summary')
+            self.assertEqual((summary.count, summary.versions_count),
+                             (count, article.publications_summary.versions.count()))
+
+        article.publications_summary.versions.latest().delete()
+        assertSummaryRefreshed(1)
+        self.assertEqual(article.publications_summary.count(), 1)
+        article.publications_summary.versions.filter(time__gt=time1).delete()
+        assertSummaryRefreshed(1)
+        self.assertEqual(article.publications_summary.last_update_time(), time1)
+
+        # rebuilding
+        ManyToManyHistorySummary.objects.update(count=100)
+        out = StringIO()
+        call_command('rebuild_m2m_history_summaries', 'test_app.article', stdout=out)
+        self.assertIn('test_app.Article.publications_summary: 1 summaries', out.getvalue())
+        self.assertEqual(article.publications_summary.count(), 1)
+
+    @skipUnless(CaptureQueriesContext is not None, 'Django 1.6+ is required')
+    def test_m2m_history_reverse_versions(self):
+        p1, p2, p3 = [Publication.objects.create(title='Pub%d' % i) for i in range(3)]
+        a1, a2 = [Article.objects.create(headline='Article%d' % i) for i in range(2)]
+        time1 = timezone.now() - timedelta(days=1)
+        time2, time3, time4 = [time1 + timedelta(hours=i) for i in range(1, 4)]
+        for article, change_time, state in [(a1, time1, [p1, p2]), (a2, time2, [p1]), (a1, time3, [p2, p3])]:
+            self._build_history(article, [state], change_time, 'publications_reverse_versions')
+        manager = p2.articles_reverse_versions
+        manager.time = time4
+        manager.add(a2)
+
+        def get_versions(publication):
+            return [(version.time, version.count, version.added_count, version.removed_count)
+                    for version in publication.articles_reverse_versions.versions.order_by('time')]
+        self.assertEqual(get_versions(p1), [(time1, 1, 1, 0), (time2, 2, 1, 0), (time3, 1, 0, 1)])
+        self.assertEqual(get_versions(p2), [(time1, 1, 1, 0), (time4, 2, 1, 0)])
+        self.assertEqual(get_versions(p3), [(time3, 1, 1, 0)])
+        version = p1.articles_reverse_versions.versions.get(time=time2)
+        self.assertEqual(set(version.items(only_pk=True)), set([a1.pk, a2.pk]))
+        self.assertEqual(version.next.time, time3)
+        self.assertEqual(set(p1.articles_reverse_versions.were_at(time3, only_pk=True)), set([a2.pk]))
+        self.assertEqual(Article._meta.get_field('publications_reverse_versions').get_history_indexes()[-1][:2],
+                         ('_reverse_history', ['publication_id', 'time_from', 'time_to']))
+
+        # versions of all the items are saved by the same number of queries
+        items = [Publication.objects.create(title='Pub') for i in range(5)]
+        with CaptureQueriesContext(connection) as context1:
+            a1.publications_reverse_versions.add(*items[:2])
+        with CaptureQueriesContext(connection) as context2:
+            a2.publications_reverse_versions.add(*items[2:])
+        self.assertEqual(len(context1), len(context2))
+        self.assertEqual(ManyToManyHistoryVersion.objects.filter(field_name='articles_reverse_versions',
+                                                                 object_id__in=[p.pk for p in items]).count(), 5)
+
+    @skipUnless(hasattr(ForeignKey, 'get_lookup'), 'Django 1.7+ is required')
+    def test_m2m_history_lookups(self):
+        p1, p2, p3 = [Publication.objects.create(title='Pub%d' % i) for i in range(3)]
+        a1, a2, a3 = [Article.objects.create(headline='Article%d' % i) for i in range(3)]
+        time1 = timezone.now() - timedelta(days=1)
+        time2, time3 = time1 + timedelta(hours=1), time1 + timedelta(hours=2)
+        for article, change_time, state in [(a1, time1, [p1, p2]), (a2, time2, [p1]), (a1, time3, [p3])]:
+            self._build_history(article, [state], change_time)
+
+        def assertArticlesEqual(qs, articles):
+            self.assertEqual(sorted(qs.distinct().values_list('pk', flat=True)), sorted([a.pk for a in articles]))
+
+        with self.assertNumQueries(1):
+            assertArticlesEqual(Article.objects.filter(publications__at=(time2, p1)), [a1, a2])
+        assertArticlesEqual(Article.objects.filter(publications__at=(time3, p1.pk)), [a2])
+        assertArticlesEqual(Article.objects.filter(publications__at=(time1 - timedelta(hours=1), p1)), [])
+        assertArticlesEqual(Article.objects.exclude(publications__at=(time2, p1)), [a3])
+        assertArticlesEqual(Article.objects.filter(publications__added_between=(time2, time3)), [a1, a2])
+        assertArticlesEqual(Article.objects.filter(publications__removed_between=(time1, time3)), [a1])
+        assertArticlesEqual(Article.objects.filter(publications__count_at=(time2, 2)), [a1])
+        assertArticlesEqual(Article.objects.filter(publications__count_at=(time3, 1)), [a1, a2])
+        assertArticlesEqual(Article.objects.filter(publications__at=(time3, p3), publications__count_at=(time2, 2)),
+                            [a1])
+        self.assertEqual(sorted(Publication.objects.filter(article__at=(time2, a1)).distinct().values_list(
+            'pk', flat=True)), [p1.pk, p2.pk])
+
+    def test_m2m_history_churn(self):
+        p1, p2, p3 = [Publication.objects.create(title='Pub%d' % i) for i in range(3)]
+        a1, a2 = [Article.objects.create(headline='Article%d' % i) for i in range(2)]
+        day1 = (timezone.now() - timedelta(days=2)).replace(hour=10, minute=0, second=0, microsecond=0)
+        day2 = day1 + timedelta(days=1)
+        for article, change_time, state in [(a1, day1, [p1, p2]), (a2, day1 + timedelta(minutes=30), [p1]),
+                                            (a1, day1 + timedelta(hours=1), [p3]), (a2, day2, [p2, p3])]:
+            self._build_history(article, [state], change_time)
+
+        expected = [
+            {'period': day1.replace(hour=0), 'added': 4, 'removed': 2},
+            {'period': day2.replace(hour=0), 'added': 2, 'removed': 1},
+        ]
+        field = Article._meta.get_field('publications')
+        with self.assertNumQueries(1):
+            self.assertEqual(ManyToManyHistoryVersion.objects.filter(field_name='publications').churn('day'), expected)
+        with self.assertNumQueries(1):
+            self.assertEqual(field.churn('day'), expected)
+        self.assertEqual(field.churn('day', time_from=day2), expected[1:])
+        self.assertEqual([(values['period'], values['added'], values['removed']) for values in field.churn('hour')],
+                         [(day1, 3, 0), (day1 + timedelta(hours=1), 1, 2), (day2, 2, 1)])
+        self.assertEqual(ManyToManyHistoryVersion.objects.churn('day', group_by=['field_name']),
+                         [dict(values, field_name='publications') for values in expected])
+        with self.assertRaises(ValueError):
+            field.churn('week')
+
+    def test_m2m_history_tenure(self):
+        p1, p2, p3 = [Publication.objects.create(title='Pub%d' % i) for i in range(3)]
+        a1, a2 = [Article.objects.create(headline='Article%d' % i) for i in range(2)]
+        time1 = (timezone.now() - timedelta(days=10)).replace(microsecond=0)
+        for article, change_time, state in [(a1, time1, [p1, p2]), (a2, time1, [p1]),
+                                            (a1, time1 + timedelta(days=2), [p1]),
+                                            (a1, time1 + timedelta(days=3), [p1, p3]),
+                                            (a1, time1 + timedelta(days=4), [])]:
+            self._build_history(article, [state], change_time)
+        now = time1 + timedelta(days=5)
+        day = 86400.0
+
+        with self.assertNumQueries(1):
+            self.assertEqual(a1.publications.tenure(now=now), {p1.pk: 4 * day, p2.pk: 2 * day, p3.pk: day})
+        self.assertEqual(p1.article_set.tenure(now=now), {a1.pk: 4 * day, a2.pk: 5 * day})
+        stats = a1.publications.tenure_stats(now=now)
+        self.assertEqual(stats, {'count': 3, 'sum': 7 * day, 'avg': 7 * day / 3, 'min': day, 'max': 4 * day})
+        self.assertPublicationsEqual(a1.publications.longer_than(timedelta(days=2), now=now), [p1, p2])
+        self.assertEqual(Publication.objects.create(title='Pub').article_set.tenure_stats(), {'count': 0})
+
+        field = Article._meta.get_field('publications')
+        self.assertEqual([(values['id'], values['count'], values['sum']) for values in field.tenure('target', now=now)],
+                         [(p1.pk, 2, 9 * day), (p2.pk, 1, 2 * day), (p3.pk, 1, day)])
+        self.assertEqual([values['id'] for values in field.tenure('source', now=now, min_duration=timedelta(days=6))],
+                         [a1.pk])
+        if connection.vendor == 'postgresql':
+            self.assertEqual(field.tenure(now=now, percentiles=[0.5])[0]['p50'], 3 * day)
+        else:
+            with self.assertRaises(NotImplementedError):
+                field.tenure(now=now, percentiles=[0.5])
+
+    def test_m2m_history_algebra(self):
+        p1, p2, p3 = [Publication.objects.create(title='Pub%d' % i) for i in range(3)]
+        a1, a2 = [Article.objects.create(headline='Article%d' % i) for i in range(2)]
+        time1 = timezone.now() - timedelta(days=1)
+        time2 = time1 + timedelta(hours=1)
+        for article, change_time, state in [(a1, time1, [p1, p2]), (a2, time1, [p2, p3]), (a1, time2, [p3]),
+                                            (a2, time2, [p1, p3])]:
+            self._build_history(article, [state], change_time)
+
+        set1, set2 = HistorySet(a1.publications, time1), HistorySet(a2.publications, time1)
+        with self.assertNumQueries(1):
+            self.assertPublicationsEqual((set1 & set2).queryset(), [p2])
+        self.assertPublicationsEqual((set1 | set2).queryset(), [p1, p2, p3])
+        self.assertPublicationsEqual((set1 - set2).queryset(), [p1])
+        # moved from the first article to the second one
+        moved = set1 & HistorySet(a2.publications, time2) - set2
+        with self.assertNumQueries(1):
+            self.assertEqual(list(moved.queryset(only_pk=True)), [p1.pk])
+        self.assertPublicationsEqual((HistorySet(a1.publications) | HistorySet(a1.publications_cache)).queryset(),
+                                     [p3])
+        self.assertEqual(list((HistorySet(p3.article_set, time1) & HistorySet(p2.article_set, time1)).queryset(
+            only_pk=True)), [a2.pk])
+        with self.assertRaises(ValueError):
+            set1 & HistorySet(p1.article_set, time1)
+
+    @skipUnless(CaptureQueriesContext is not None, 'Django 1.6+ is required')
+    def test_m2m_history_instrumentation(self):
+        p1, p2, p3 = [Publication.objects.create(title='Pub%d' % i) for i in range(3)]
+        article = Article.objects.create(headline='Article1')
+        time1 = timezone.now() - timedelta(days=1)
+        records = []
+
+        def receiver(sender, record, **kwargs):
+            records.append(record)
+        m2m_history_instrumented.connect(receiver)
+
+        # disabled without collectors
+        article.publications.add(p1)
+        self.assertEqual(records, [])
+
+        try:
+            with instrument() as collector:
+                manager = article.publications
+                manager.time = time1
+                with CaptureQueriesContext(connection) as context:
+                    manager.add(p2, p3)
+                # queries, logged only for the record, don't stay in the log
+                log_length = len(get_queries_log(connection))
+                manager.remove(p1)
+                self.assertEqual(len(get_queries_log(connection)), log_length)
+                items = article.publications.were_at(time1)
+                with CaptureQueriesContext(connection) as read_context:
+                    list(items)
+                article.publications.versions.get(time=time1).delete()
+        finally:
+            m2m_history_instrumented.disconnect(receiver)
+
+        self.assertEqual([(record['field_name'], record['method']) for record in records], [
+            ('publications', 'version.save'), ('publications', 'add'),
+            ('publications', 'version.save'), ('publications', 'remove'),
+            ('publications', 'were_at'),
+            ('publications', 'version.delete')])
+        add = records[1]
+        self.assertEqual(add['model'], Article)
+        self.assertEqual(add['rows'], 2)
+        self.assertEqual(add['queries'], len(context.captured_queries))
+        self.assertTrue(add['queries'] > records[0]['queries'] > 0)
+        self.assertTrue(add['sql_time'] >= 0 and add['python_time'] >= 0)
+        self.assertEqual(records[3]['rows'], 1)
+        # lazy queryset is recorded on evaluation
+        self.assertEqual(records[4]['queries'], len(read_context.captured_queries))
+        self.assertTrue(records[4]['queries'] > 0)
+        self.assertEqual(records[4]['rows'], 2)
+
+        stats = dict([((stat['field_name'], stat['method']), stat) for stat in collector.stats()])
+        self.assertEqual(stats[('publications', 'version.save')]['calls'], 2)
+        self.assertEqual(stats[('publications', 'add')]['model'], 'test_app.Article')
+        self.assertEqual(stats[('publications', 'add')]['queries'], add['queries'])
+
+    def test_m2m_history_audit(self):
+
+        p1, p2, p3 = [Publication.objects.create(title='Pub%d' % i) for i in range(3)]
+        a1, a2, a3 = [Article.objects.create(headline='Article%d' % i) for i in range(3)]
+        time1 = timezone.now() - timedelta(days=1)
+        for article, change_time, state in [(a1, time1, [p1, p2]), (a1, time1 + timedelta(hours=1), [p3]),
+                                            (a2, time1, [p1])]:
+            self._build_history(article, [state], change_time)
+        # duplicate open row
+        Article.publications.through.objects.create(article=a2, publication=p1, time_from=time1)
+
+        field = Article._meta.get_field('publications')
+        result = audit(field, batch_size=2)
+        self.assertEqual([result[name] for name in ['instances', 'sampled_instances', 'instances_with_history']],
+                         [3, 3, 2])
+        self.assertEqual([result[name] for name in ['rows', 'open_rows', 'closed_rows', 'duplicate_open_pairs']],
+                         [5, 3, 2, 1])
+        self.assertEqual(result['closed_to_open_ratio'], 2. / 3)
+        self.assertEqual(result['largest_histories'], [{'id': a1.pk, 'rows': 3}, {'id': a2.pk, 'rows': 2}])
+        self.assertEqual([result['versions'], result['max_versions'], result['versions_per_instance']], [3, 2, 1.5])
+        self.assertEqual(sorted(result['explain']), ['added_between', 'current', 'removed_between', 'were_at'])
+        self.assertTrue(all([explained['plan'] for explained in result['explain'].values()]))
+
+        # the first batch of two instances with all the history is sampled
+        result = audit(field, batch_size=2, sample=0.5, seed=1, explain_queries=False)
+        self.assertEqual([result['sampled_instances'], result['rows'], result['estimated_rows']], [2, 5, 8])
+        self.assertEqual(result['explain'], {})
+
+        out = StringIO()
+        call_command('audit_m2m_history', 'test_app.article.publications', stdout=out)
+        self.assertIn('test_app.Article.publications: 3 of 3 instances sampled, 2 with history', out.getvalue())
+        self.assertIn('duplicate open pairs: 1', out.getvalue())
+
+    def test_m2m_history_export(self):
+        import gzip
+        import json
+        import os
+        import tempfile
+
+        p1, p2, p3 = [Publication.objects.create(title='Pub%d' % i) for i in range(3)]
+        a1, a2 = [Article.objects.create(headline='Article%d' % i) for i in range(2)]
+        time1 = timezone.now() - timedelta(days=1)
+        time2 = time1 + timedelta(hours=1)
+        for article, change_time, state in [(a1, time1, [p1, p2]), (a1, time2, [p3]), (a2, time2, [p1])]:
+            self._build_history(article, [state], change_time)
+
+        field = Article._meta.get_field('publications')
+        rows = list(iter_through_rows(field, chunk_size=2))
+        # items of the same change are inserted in order of set
+        self.assertEqual(sorted([(row['instance'], row['item'], row['time_from'], row['time_to']) for row in rows]), [
+            (a1.pk, p1.pk, time1, time2), (a1.pk, p2.pk, time1, time2), (a1.pk, p3.pk, time2, None),
+            (a2.pk, p1.pk, time2, None)])
+        self.assertEqual(rows[0]['field'], 'test_app.Article.publications')
+        # intervals intersecting the window
+        rows = iter_through_rows(field, instances=Article.objects.filter(pk=a1.pk),
+                                 time_to=time1 + timedelta(minutes=1))
+        self.assertEqual(sorted([row['item'] for row in rows]), [p1.pk, p2.pk])
+        rows = iter_through_rows(field, instances=[a1.pk], time_from=time2 + timedelta(minutes=1))
+        self.assertEqual([row['item'] for row in rows], [p3.pk])
+        versions = list(iter_version_rows(field, instances=[a1.pk], time_from=time2))
+        self.assertEqual([(row['time'], row['count'], row['added_count'], row['removed_count']) for row in versions],
+                         [(time2, 1, 1, 2)])
+
+        out = StringIO()
+        call_command('export_m2m_history', 'test_app.article.publications', instances=str(a2.pk), stdout=out)
+        self.assertEqual([json.loads(line) for line in out.getvalue().splitlines()], [{
+            'field': 'test_app.Article.publications', 'instance': a2.pk, 'item': p1.pk,
+            'time_from': time2.isoformat(), 'time_to': None}])
+
+        handle, filename = tempfile.mkstemp(suffix='.csv.gz')
+        os.close(handle)
+        try:
+            call_command('export_m2m_history', 'test_app.article.publications', versions=True, format='csv',
+                         output=filename, gzip=True)
+            lines = gzip.open(filename).read().decode('utf-8').splitlines()
+        finally:
+            os.remove(filename)
+        self.assertEqual(lines[0], 'field,instance,time,count,added_count,removed_count')
+        self.assertEqual(len(lines), 1 + ManyToManyHistoryVersion.objects.filter(field_name='publications').count())
+
+    def test_m2m_history_backfill(self):
+
+        p1, p2, p3 = [Publication.objects.create(title='Pub%d' % i) for i in range(3)]
+        a1, a2 = [Article.objects.create(headline='Article%d' % i) for i in range(2)]
+        time1 = timezone.now() - timedelta(days=1)
+        states = [(a1, [p1, p2]), (a2, [p1]), (a1, [p3]), (a2, [p1, p2, p3]), (a1, [p1, p3]), (a2, [])]
+        for i, (article, state) in enumerate(states):
+            self._build_history(article, [state], time1 + timedelta(hours=i // 2))
+        # item without time of adding
+        Article.publications.through.objects.create(article=a1, publication=p2)
+
+        def get_versions():
+            return list(ManyToManyHistoryVersion.objects.filter(field_name='publications').order_by(
+                'object_id', 'time').values_list('object_id', 'time', 'count', 'added_count', 'removed_count'))
+
+        def delete_versions(**kwargs):
+            # rows without changes of history of items, as if versions were never kept
+            QuerySet.delete(ManyToManyHistoryVersion.objects.filter(field_name='publications', **kwargs))
+
+        expected = [(object_id, version_time, count + (object_id == a1.pk), added, removed)
+                    for object_id, version_time, count, added, removed in get_versions()]
+        self.assertEqual(len(expected), 6)
+        delete_versions(object_id=a2.pk)
+        delete_versions(object_id=a1.pk, time=time1)
+
+        field = Article._meta.get_field('publications')
+        self.assertEqual(backfill_versions(field, batch_size=1), 4)
+        versions = get_versions()
+        # existing versions of the first article are kept as is
+        self.assertEqual([version for version in versions if version[0] == a2.pk or version[1] == time1],
+                         [version for version in expected if version[0] == a2.pk or version[1] == time1])
+        self.assertEqual(backfill_versions(field), 0)
+
+        if connection.vendor == 'postgresql':
+            delete_versions()
+            self.assertEqual(backfill_versions(field, batch_size=1, processes=2), 6)
+            self.assertEqual(get_versions(), expected)
+
+        out = StringIO()
+        call_command('backfill_m2m_history_versions', 'test_app.article.publications', stdout=out)
+        self.assertEqual(out.getvalue(), 'test_app.Article.publications: 0 versions\n')
+
+    def test_m2m_history_checkpoints(self):
+        p1, p2, p3, p4 = [Publication.objects.create(title='Pub%d' % i) for i in range(4)]
+        article = Article.objects.create(headline='Article1')
+        time1 = timezone.now()
+        states = [[p1, p2], [p2, p3], [p3], [p1, p3, p4], [p4], [p1, p2, p3, p4]]
+        for i, state in enumerate(states):
+            manager = article.publications_checkpoints
+            manager.time = time1 + timedelta(hours=i)
+            manager.clear(*state)
+            manager.add(*state)
+
+        self.assertEqual(ManyToManyHistoryCheckpoint.objects.count(), 3)
+        self.assertEqual(article.publications_checkpoints.checkpoints.latest().ids, set([p.pk for p in states[-1]]))
+        self.assertPublicationsEqual(article.publications_checkpoints.were_at(time1 - timedelta(hours=1)), [])
+        for i, state in enumerate(states):
+            for moment in [time1 + timedelta(hours=i), time1 + timedelta(hours=i, minutes=30)]:
+                self.assertPublicationsEqual(article.publications_checkpoints.were_at(moment), state)
+                self.assertListEqual(sorted(article.publications_checkpoints.were_at(moment, only_pk=True)),
+                                     sorted([p.pk for p in state]))
+
+        # deleting of version removes checkpoints after it
+        article.publications_checkpoints.versions.get(time=time1 + timedelta(hours=5)).delete()
+        self.assertEqual(ManyToManyHistoryCheckpoint.objects.count(), 2)
+        self.assertPublicationsEqual(article.publications_checkpoints.were_at(time1 + timedelta(hours=5)), [p4])
+
+        # change in the past removes checkpoints after it
+        p5 = Publication.objects.create(title='Pub5')
+        article = Article.objects.create(headline='Article2')
+        self._build_history(article, states, time1, 'publications_checkpoints')
+        self.assertTrue(article.publications_checkpoints.checkpoints.filter(time__gt=time1 + timedelta(hours=2)))
+        manager = article.publications_checkpoints
+        manager.time = time1 + timedelta(hours=2, minutes=30)
+        manager.add(p5)
+        self.assertFalse(article.publications_checkpoints.checkpoints.filter(time__gte=manager.time))
+        for i, state in enumerate(states[3:], 3):
+            self.assertPublicationsEqual(article.publications_checkpoints.were_at(time1 + timedelta(hours=i)),
+                                         state + [p5])
+
+        # change in the past from the reverse side removes checkpoints of items after it
+        article = Article.objects.create(headline='Article3')
+        self._build_history(article, states, time1, 'publications_checkpoints')
+        manager = p5.articles_checkpoints
+        manager.time = time1 + timedelta(hours=2, minutes=30)
+        manager.add(article)
+        self.assertFalse(article.publications_checkpoints.checkpoints.filter(time__gte=manager.time))
+        self.assertTrue(article.publications_checkpoints.checkpoints.filter(time__lt=manager.time))
+        for i, state in enumerate(states[3:], 3):
+            self.assertPublicationsEqual(article.publications_checkpoints.were_at(time1 + timedelta(hours=i)),
+                                         state + [p5])
+
+    @skipUnless(Prefetch is not None, 'Django 1.7+ is required')
+    def test_m2m_history_prefetch(self):
+        publications = [Publication.objects.create(title='Pub%d' % i) for i in range(4)]
+        time1 = timezone.now()
+        times = [time1 + timedelta(hours=i) for i in range(4)]
+        for i in range(3):
+            article = Article.objects.create(headline='Article%d' % i)
+            for j, moment in enumerate(times):
+                manager = article.publications
+                manager.time = moment
+                state = publications[i:i + j + 1:2]
+                manager.clear(*state)
+                manager.add(*state)
+
+        def assertPrefetchedEqual(lookup, methods, args):
+            expected = {}
+            for article in Article.objects.order_by('id'):
+                for method in methods:
+                    expected[(article.pk, method)] = sorted(
+                        getattr(article.publications, method)(*args).values_list('id', flat=True))
+            with self.assertNumQueries(2):
+                articles = list(Article.objects.prefetch_related(lookup).order_by('id'))
+            with self.assertNumQueries(0):
+                for article in articles:
+                    for method in methods:
+                        self.assertListEqual(expected[(article.pk, method)],
+                                             sorted([p.pk for p in getattr(article.publications, method)(*args)]))
+                        if args:
+                            self.assertListEqual(expected[(article.pk, method)],
+                                                 sorted(getattr(article.publications, method)(*args, only_pk=True)))
+
+        assertPrefetchedEqual('publications', ['all'], [])
+        for moment in times[1:] + [time1 + timedelta(minutes=30)]:
+            assertPrefetchedEqual(HistoryPrefetch('publications', at=moment),
+                                  ['were_at', 'added_at', 'removed_at'], [moment])
+        for period in [(times[0], times[2]), (times[1], times[2]), (times[1], times[3] + timedelta(hours=1))]:
+            assertPrefetchedEqual(HistoryPrefetch('publications', between=period),
+                                  ['were_between', 'added_between', 'removed_between'], period)
+
+    @skipUnless(CaptureQueriesContext is not None, 'Django 1.6+ is required')
+    def test_m2m_history_set(self):
+        publications = [Publication.objects.create(title='Pub%d' % i) for i in range(10)]
+        article = Article.objects.create(headline='Article1')
+        article.publications_no_versions = publications[:6]
+
+        manager = article.publications_no_versions
+        # read current items, close removed and insert added, by COPY on PostgreSQL
+        with CaptureQueriesContext(connection) as context:
+            manager.set(publications[3:] + [p.pk for p in publications[3:]])
+        self.assertEqual(len([query for query in context.captured_queries if 'BEGIN' not in query['sql']]), 3)
+        self.assertPublicationsEqual(article.publications_no_versions.all(), publications[3:])
+        self.assertPublicationsEqual(article.publications_no_versions.removed_at(manager.time), publications[:3])
+        self.assertPublicationsEqual(article.publications_no_versions.added_at(manager.time), publications[6:])
+
+        with CaptureQueriesContext(connection) as context:
+            article.publications_no_versions.set(publications[3:])
+        self.assertEqual(len([query for query in context.captured_queries if 'BEGIN' not in query['sql']]), 1)
+        self.assertEqual(article.publications_no_versions.through.objects.count(), 10)
+
+    def test_m2m_history_sync(self):
+        publications = [Publication.objects.create(title='Pub%d' % i) for i in range(10)]
+        article = Article.objects.create(headline='Article1')
+        article.publications = publications[:6]
+
+        manager = article.publications
+        # generator with duplicates, staged by several chunks
+        manager.sync((p.pk for p in publications[3:] + publications[3:5]), chunk_size=3)
+        self.assertPublicationsEqual(article.publications.all(), publications[3:])
+        self.assertPublicationsEqual(article.publications.removed_at(manager.time), publications[:3])
+        self.assertPublicationsEqual(article.publications.added_at(manager.time), publications[6:])
+
+        version = article.publications.versions.latest()
+        self.assertEqual((version.count, version.added_count, version.removed_count), (7, 4, 3))
+
+        article.publications.sync(iter([]))
+        self.assertEqual(article.publications.count(), 0)
+        self.assertEqual(article.publications.through.objects.count(), 10)
+
+        # only its own changes are reported, not earlier ones at the same time
+        p1, p2 = publications[:2]
+        article = Article.objects.create(headline='Article2')
+        changes = []
+
+        def receiver(sender, action, pk_set, **kwargs):
+            if action.startswith('post_'):
+                changes.append((action, sorted(pk_set)))
+        m2m_history_changed.connect(receiver)
+        try:
+            for name in ['publications', 'publications_summary']:
+                manager = getattr(article, name)
+                manager.time = timezone.now()
+                manager.add(p1)
+                manager.sync([p2.pk])
+        finally:
+            m2m_history_changed.disconnect(receiver)
+        self.assertEqual(changes, [('post_add', [p1.pk]), ('post_clear', [p1.pk]), ('post_add', [p2.pk])] * 2)
+        version = article.publications.versions.latest()
+        self.assertEqual((version.count, version.added_count, version.removed_count), (1, 1, 1))
+        self.assertEqual(article.publications_summary.summary.count, 1)
+
+        # lazy primary keys invalidate cache of the other side
+        self.assertEqual(p2.articles_cache.count(), 0)
+        article.publications_cache.sync([p2.pk])
+        self.assertEqual(p2.articles_cache.count(), 1)
+
+    @skipUnless(CaptureQueriesContext is not None, 'Django 1.6+ is required')
+    def test_m2m_history_delete_versions(self):
+        p1, p2, p3, p4 = [Publication.objects.create(title='Pub%d' % i) for i in range(4)]
+        article = Article.objects.create(headline='Article1')
+        time1 = timezone.now()
+        states = [[p1, p2], [p3], [p1, p3, p4], [p1, p4]]
+        self._build_history(article, states, time1)
+
+        # delete versions in the middle by one call
+        article.publications.versions.filter(time__gt=time1, time__lt=time1 + timedelta(hours=3)).delete()
+
+        self.assertEqual(article.publications.versions.count(), 2)
+        self.assertPublicationsEqual(article.publications.were_at(time1), [p1, p2])
+        self.assertPublicationsEqual(article.publications.were_at(time1 + timedelta(hours=2)), [p1, p2])
+        self.assertPublicationsEqual(article.publications.all(), [p1, p4])
+        version = article.publications.versions.latest()
+        self.assertEqual((version.count, version.added_count, version.removed_count), (2, 1, 1))
+        # interval of p1 is joined
+        self.assertEqual(article.publications.through.objects.filter(publication=p1).count(), 1)
+
+        # the same result as deleting one by one from the latest, by the same number of queries for any number
+        # of versions: p1 leaves and enters again many times, the last versions are reverted
+        states = [[p1, p2], [p3], [p1], [p2], [p1, p3], [p4], [p1, p4], [p2], [p3]]
+        articles = [Article.objects.create(headline='Article%d' % i) for i in range(3)]
+        for article in articles:
+            self._build_history(article, states, time1)
+        deleted = [time1 + timedelta(hours=i) for i in [1, 2, 3, 5, 7, 8]]
+        for version in articles[0].publications.versions.filter(time__in=deleted).order_by('-time'):
+            version.delete()
+        with CaptureQueriesContext(connection) as context1:
+            articles[1].publications.versions.filter(time__in=deleted).delete()
+        with CaptureQueriesContext(connection) as context2:
+            articles[2].publications.versions.filter(time__in=deleted[:2]).delete()
+        self.assertEqual(len(context1), len(context2))
+
+        def get_history(article):
+            return sorted(article.publications.through.objects.filter(article=article).values_list(
+                'publication', 'time_from', 'time_to'), key=repr), \
+                list(article.publications.versions.order_by('time').values_list(
+                    'time', 'count', 'added_count', 'removed_count'))
+        self.assertEqual(get_history(articles[0]), get_history(articles[1]))
+        for i in [0, 4, 6]:
+            self.assertPublicationsEqual(articles[1].publications.were_at(time1 + timedelta(hours=i)), states[i])
+        self.assertPublicationsEqual(articles[1].publications.all(), [p1, p4])
+        self.assertEqual(Article.publications.through.objects.filter(article=articles[1], publication=p1).count(), 1)
+
+    def test_m2m_history_compact(self):
+        p1, p2, p3 = [Publication.objects.create(title='Pub%d' % i) for i in range(3)]
+        article = Article.objects.create(headline='Article1')
+        time1 = (timezone.now() - timedelta(days=10)).replace(hour=1)
+        states = [[p1, p2], [p1], [p1, p2], [p1, p3]]
+        self._build_history(article, states, time1)
+        manager = article.publications
+        manager.time = time1 + timedelta(days=1)
+        manager.set([p3])
+        # adjacent intervals of p3
+        manager = article.publications
+        manager.time = time1 + timedelta(days=2)
+        manager.remove(p3)
+        manager.add(p3)
+
+        out = StringIO()
+        call_command('compact_m2m_history', 'test_app.article.publications', granularity='day', days=1, stdout=out)
+        self.assertIn('0 expired intervals, 2 merged versions, 1 joined intervals', out.getvalue())
+
+        self.assertEqual([version.time for version in article.publications.versions.order_by('time')],
+                         [time1, time1 + timedelta(hours=3), time1 + timedelta(days=1), time1 + timedelta(days=2)])
+        self.assertPublicationsEqual(article.publications.were_at(time1 + timedelta(hours=1)), [p1, p2])
+        self.assertPublicationsEqual(article.publications.were_at(time1 + timedelta(hours=3)), [p1, p3])
+        self.assertPublicationsEqual(article.publications.all(), [p3])
+        self.assertEqual(article.publications.through.objects.filter(article=article).count(), 3)
+        self.assertEqual([(version.count, version.added_count, version.removed_count)
+                          for version in article.publications.versions.order_by('time')],
+                         [(2, 2, 0), (2, 1, 1), (1, 0, 1), (1, 0, 0)])
+
+        result = article.publications.compact(timezone.now(), expire=time1 + timedelta(days=1, hours=1))
+        self.assertEqual(result, {'expired': 2, 'merged': 0, 'joined': 0})
+        self.assertEqual(article.publications.versions.count(), 1)
+        self.assertPublicationsEqual(article.publications.all(), [p3])
+
+        # chain of adjacent intervals is joined into one open interval
+        article = Article.objects.create(headline='Article2')
+        for i in range(3):
+            manager = article.publications
+            manager.time = time1 + timedelta(hours=i)
+            if i:
+                manager.remove(p1)
+            manager.add(p1)
+        self.assertEqual(join_intervals(article.publications, timezone.now()), 2)
+        self.assertEqual(list(article.publications.through.objects.filter(article=article).values_list(
+            'time_from', 'time_to')), [(time1, None)])
+
+    @skipUnless(ProjectState is not None, 'Django 1.7+ is required')
+    def test_m2m_history_indexes(self):
+        state = ProjectState.from_apps(Article._meta.apps)
+        operation = AddHistoryIndexes('article', 'publications')
+        table = Article.publications.through._meta.db_table
+
+        def get_indexes():
+            return set([name for name, constraint in connection.introspection.get_constraints(
+                connection.cursor(), table).items() if constraint['index']])
+
+        indexes = get_indexes()
+        with connection.schema_editor() as schema_editor:
+            operation.database_forwards('test_app', schema_editor, state, state)
+            field = Article._meta.get_field('publications')
+            names = [index[0] for index in operation.get_indexes(schema_editor, field)]
+        self.assertEqual(get_indexes() - indexes, set(names))
+        self.assertEqual(len(names), 2)
+
+        with connection.schema_editor() as schema_editor:
+            operation.database_backwards('test_app', schema_editor, state, state)
+        self.assertEqual(get_indexes(), indexes)
+
+    @skipUnless(ProjectState is not None, 'Django 1.7+ is required')
+    def test_m2m_history_unique_open(self):
+        from django.db import IntegrityError
+        state = ProjectState.from_apps(Article._meta.apps)
+        operation = AddHistoryIndexes('article', 'publications_unique_open')
+        with connection.schema_editor() as schema_editor:
+            operation.database_forwards('test_app', schema_editor, state, state)
+        try:
+            publications = [Publication.objects.create(title='Pub%d' % i) for i in range(5)]
+            article = Article.objects.create(headline='Article1')
+            article.publications_unique_open.add(*publications[:3])
+
+            manager = article.publications_unique_open
+            with CaptureQueriesContext(connection) as context:
+                manager.add(*publications[1:])
+            # without reading of current items on PostgreSQL
+            queries = [query for query in context.captured_queries if 'BEGIN' not in query['sql']]
+            self.assertEqual(len(queries), 1 if connection.vendor == 'postgresql' else 2)
+            self.assertPublicationsEqual(manager.added_at(manager.time), publications[3:])
+            self.assertPublicationsEqual(article.publications_unique_open.all(), publications)
+
+            # set() inserts rows of known new items
+            article.publications_unique_open = publications[:2]
+            article.publications_unique_open = publications[:4]
+            self.assertPublicationsEqual(article.publications_unique_open.all(), publications[:4])
+            self.assertEqual(article.publications_unique_open.through.objects.count(), 7)
+
+            with self.assertRaises(IntegrityError):
+                article.publications_unique_open.through.objects.create(
+                    article=article, publication=publications[0], time_from=timezone.now())
+        finally:
+            with connection.schema_editor() as schema_editor:
+                operation.database_backwards('test_app', schema_editor, state, state)
+
+    @skipUnless(connection.vendor == 'postgresql', 'PostgreSQL is required')
+    @skipUnless(ProjectState is not None, 'Django 1.7+ is required')
+    def test_m2m_history_time_range(self):
+        state = ProjectState.from_apps(Article._meta.apps)
+        operation = AddTimeRange('article', 'publications_time_range')
+        gist = postgresql_extension_available('btree_gist')
+        with connection.schema_editor() as schema_editor:
+            if gist:
+                operation.database_forwards('test_app', schema_editor, state, state)
+            else:
+                # column and trigger without GiST index
+                for sql in operation.forwards_sql(schema_editor, Article._meta.get_field('publications_time_range')):
+                    if 'gist' not in sql:
+                        schema_editor.execute(sql)
+        try:
+            p1, p2, p3 = [Publication.objects.create(title='Pub%d' % i) for i in range(3)]
+            article = Article.objects.create(headline='Article1')
+            time1 = timezone.now()
+            time2, time3 = time1 + timedelta(hours=1), time1 + timedelta(hours=2)
+
+            manager = article.publications_time_range
+            manager.time = time1
+            manager.add(p1, p2)
+            manager = article.publications_time_range
+            manager.time = time2
+            manager.remove(p1)
+            manager.add(p3)
+
+            self.assertTrue(article.publications_time_range.time_range)
+            self.assertPublicationsEqual(article.publications_time_range.were_at(time1 - timedelta(hours=1)), [])
+            self.assertPublicationsEqual(article.publications_time_range.were_at(time1), [p1, p2])
+            self.assertPublicationsEqual(article.publications_time_range.were_at(time2), [p2, p3])
+            self.assertPublicationsEqual(article.publications_time_range.were_between(time1, time2), [p1, p2])
+            self.assertPublicationsEqual(article.publications_time_range.were_between(time2, time3), [p2, p3])
+
+            # the same items as by conditions over time columns and prefetching, for all kinds of intervals
+            article = Article.objects.create(headline='Article2')
+            time0, time_in = time1 - timedelta(hours=1), time1 + timedelta(minutes=10)
+            intervals = [(None, None), (None, time_in), (time_in, None), (time0, None), (time_in, time_in),
+                         (time0, time1), (time2, time3), (time0, time3), (None, time2),
+                         (time_in, time1 + timedelta(minutes=20))]
+            rows = []
+            for time_from, time_to in intervals:
+                publication = Publication.objects.create(title='Pub')
+                Article.publications_time_range.through.objects.create(
+                    article=article, publication=publication, time_from=time_from, time_to=time_to)
+                rows.append((publication.pk, time_from, time_to))
+            for period in [(time1, time2), (time1 - timedelta(hours=2), time1 - timedelta(hours=1)),
+                           (time1 + timedelta(minutes=30), time1 + timedelta(hours=3))]:
+                self.assertEqual(set(article.publications_time_range.were_between(*period, only_pk=True)),
+                                 set([pk for pk, time_from, time_to in rows
+                                      if PREDICATES['were_between'](time_from, time_to, *period)]))
+            for moment in [time1, time1 + timedelta(minutes=10), time2, time3]:
+                self.assertEqual(set(article.publications_time_range.were_at(moment, only_pk=True)),
+                                 set([pk for pk, time_from, time_to in rows
+                                      if PREDICATES['were_at'](time_from, time_to, moment)]))
+        finally:
+            with connection.schema_editor() as schema_editor:
+                operation.database_backwards('test_app', schema_editor, state, state)
+
+    @skipUnless(connection.vendor == 'postgresql' and connection.pg_version >= 110000, 'PostgreSQL 11+ is required')
+    @skipUnless(ProjectState is not None, 'Django 1.7+ is required')
+    def test_m2m_history_partitions(self):
+        state = ProjectState.from_apps(Article._meta.apps)
+        time1 = timezone.now() - timedelta(days=400)
+        operation = PartitionHistoryTable('article', 'publications', bounds=[(time1 + timedelta(days=200)).date()])
+        through = Article.publications.through
+        p1, p2, p3 = [Publication.objects.create(title='Pub%d' % i) for i in range(3)]
+        article = Article.objects.create(headline='Article1')
+        manager = article.publications
+        manager.time = time1
+        manager.add(p1, p2)
+
+        def get_partitions_counts():
+            cursor = connection.cursor()
+            cursor.execute('SELECT tableoid::regclass::text, COUNT(*) FROM %s GROUP BY 1' % through._meta.db_table)
+            return dict(cursor.fetchall())
+
+        def get_indexes():
+            cursor = connection.cursor()
+            cursor.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s', [through._meta.db_table])
+            return set([name for name, in cursor.fetchall()])
+
+        # indexes of other operations are kept by partitioning
+        operations = [AddHistoryIndexes('article', 'publications')]
+        if postgresql_extension_available('btree_gist'):
+            operations.append(AddTimeRange('article', 'publications'))
+        with connection.schema_editor() as schema_editor:
+            for other_operation in operations:
+                other_operation.database_forwards('test_app', schema_editor, state, state)
+        indexes = get_indexes()
+        self.assertTrue(len(indexes) > 2)
+
+        with connection.schema_editor() as schema_editor:
+            operation.database_forwards('test_app', schema_editor, state, state)
+        try:
+            table = through._meta.db_table
+            self.assertEqual(get_indexes(), indexes - set(['%s_pkey' % table]))
+            self.assertEqual(get_partitions_counts(), {'%s_open' % table: 2})
+            manager = article.publications
+            manager.time = time1 + timedelta(days=100)
+            manager.remove(p1)
+            article.publications.add(p3)
+            # closed row is moved to partition by time_to
+            self.assertEqual(get_partitions_counts(), {'%s_open' % table: 2, '%s_closed_min' % table: 1})
+            self.assertPublicationsEqual(article.publications.all(), [p2, p3])
+            self.assertPublicationsEqual(article.publications.were_at(time1), [p1, p2])
+        finally:
+            with connection.schema_editor() as schema_editor:
+                operation.database_backwards('test_app', schema_editor, state, state)
+        self.assertEqual(get_indexes(), indexes)
+        self.assertEqual(through.objects.count(), 3)
+        article.publications.add(p1)
+        self.assertPublicationsEqual(article.publications.all(), [p1, p2, p3])
+        with connection.schema_editor() as schema_editor:
+            for other_operation in reversed(operations):
+                other_operation.database_backwards('test_app', schema_editor, state, state)
+
     def test_m2m_default_features(self):
         """
         Build-in test from https://docs.djangoproject.com/en/dev/topics/db/examples/many_to_many/